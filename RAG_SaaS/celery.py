@@ -0,0 +1,36 @@
+"""
+Celery application for RAG_SaaS.
+
+Workers are started with::
+
+    celery -A RAG_SaaS worker -l info
+
+Tasks are discovered from the ``tasks.py`` module of every installed app.
+
+With WORKER_METRICS_PORT set, the worker serves its ingestion metrics on that
+port. Metrics are kept per process, so the exporter only sees the tasks run
+by the process that serves it: use a thread pool (``--pool threads``) or
+``--pool solo`` rather than the default prefork pool.
+"""
+
+import os
+
+from celery import Celery
+from celery.signals import worker_ready
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'RAG_SaaS.settings')
+
+app = Celery('RAG_SaaS')
+
+# Lee la configuración de Django con el prefijo CELERY_
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
+
+
+@worker_ready.connect
+def start_worker_metrics(**kwargs):
+    from django.conf import settings
+    from rag_app_apis.metrics import start_metrics_server
+
+    if settings.WORKER_METRICS_PORT:
+        start_metrics_server(settings.WORKER_METRICS_PORT)
@@ -51,6 +51,7 @@ INSTALLED_APPS = [
 
 
 MIDDLEWARE = [
+    'rag_app_apis.tracing.TraceMiddleware',  # Trace id y métricas HTTP; primero para medir toda la request
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -168,12 +169,189 @@ LOGIN_URL = '/login/'  # Redirects to your defined login page
 
 
 
-CELERY_BROKER_URL = 'redis://localhost:6379/0'  # Usamos Redis como broker
+CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://localhost:6379/0')  # Usamos Redis como broker
 CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
+CELERY_TASK_ACKS_LATE = True  # Si el worker muere a mitad de la ingesta, la tarea se reintenta
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1  # Las ingestas son largas, no acaparar tareas
+# Modo en proceso para tests/desarrollo: CELERY_TASK_ALWAYS_EAGER=1 ejecuta la tarea en el mismo
+# proceso, y CELERY_BROKER_URL=memory:// sirve como broker local sin Redis.
+CELERY_TASK_ALWAYS_EAGER = os.getenv('CELERY_TASK_ALWAYS_EAGER', '0') == '1'
+# Sin propagar, como en el worker: los reintentos de la tarea también se ejecutan en modo eager
+# (en el acto, sin countdown) y el error final queda en el documento
+CELERY_TASK_EAGER_PROPAGATES = False
+
+# LLM para el chat: 'openai' o 'fake' (respuesta simulada en streaming, sin red, para tests)
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'openai')
+LLM_MODEL_NAME = os.getenv('LLM_MODEL_NAME', 'gpt-4o-mini')
+EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'text-embedding-3-small')
+# Proveedor de embeddings: 'openai' (EMBEDDING_MODEL_NAME), 'local' (sentence-transformers en CPU, con un pool
+# de LOCAL_EMBEDDING_WORKERS procesos; 0 = en el proceso actual) o 'fake' (hash determinístico, sin red)
+EMBEDDING_BACKEND = os.getenv('EMBEDDING_BACKEND', 'openai')
+LOCAL_EMBEDDING_MODEL = os.getenv('LOCAL_EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+LOCAL_EMBEDDING_WORKERS = int(os.getenv('LOCAL_EMBEDDING_WORKERS', 2))
+LOCAL_EMBEDDING_BATCH_SIZE = int(os.getenv('LOCAL_EMBEDDING_BATCH_SIZE', 32))
+FAKE_EMBEDDING_DIM = int(os.getenv('FAKE_EMBEDDING_DIM', 256))
+
+# Perfilado de memoria con tracemalloc (ralentiza cada asignación; solo para diagnóstico)
+MEMORY_PROFILING = os.getenv('MEMORY_PROFILING', '0') == '1'
+
+# Logging de la app (antes logging.basicConfig al importar utils)
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'filters': {
+        'trace': {'()': 'rag_app_apis.tracing.TraceIdFilter'},
+    },
+    'formatters': {
+        'simple': {'format': '%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s'},
+    },
+    'handlers': {
+        'file': {
+            'class': 'logging.handlers.RotatingFileHandler',
+            'filename': os.getenv('LOG_FILE', 'document_processing.log'),
+            'maxBytes': int(os.getenv('LOG_MAX_BYTES', 50 * 1024 * 1024)),
+            'backupCount': int(os.getenv('LOG_BACKUP_COUNT', 5)),
+            'formatter': 'simple',
+            'filters': ['trace'],
+            'delay': True,
+        },
+        'console': {
+            'class': 'logging.StreamHandler',
+            'level': os.getenv('LOG_CONSOLE_LEVEL', 'WARNING'),
+            'formatter': 'simple',
+            'filters': ['trace'],
+        },
+    },
+    'root': {
+        'handlers': ['file', 'console'],
+        'level': os.getenv('LOG_LEVEL', 'INFO'),
+    },
+}
+
+# Fracción de requests cuyos mensajes del camino caliente (chunks elegidos, contexto, LLM) se loguean;
+# los warnings y errores se loguean siempre
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.1))
+
+# Métricas Prometheus en /metrics (con METRICS_TOKEN se exige "Authorization: Bearer <token>");
+# el worker de Celery las sirve en WORKER_METRICS_PORT si está definido
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', 0))
+
+# Chunking por tokens (ver rag_app_apis/chunking.py): estrategia por defecto,
+# estrategias extra {'nombre': {'class': 'tokens', 'max_tokens': ..., ...}} y estrategia por usuario {'<user id>': 'nombre'}
+CHUNKING_DEFAULT_STRATEGY = os.getenv('CHUNKING_DEFAULT_STRATEGY', 'default')
+CHUNKING_STRATEGIES = {}
+CHUNKING_TENANT_STRATEGIES = {}
+
+# Búsqueda híbrida: BM25 + vectores fusionados con RRF; si BM25 es concluyente se omite el embedding de la consulta
+LEXICAL_SEARCH = os.getenv('LEXICAL_SEARCH', '1') == '1'
+LEXICAL_CACHE_MAX_BYTES = int(os.getenv('LEXICAL_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 20))  # Resultados de cada ranking antes de fusionar
+RRF_K = int(os.getenv('RRF_K', 60))
+LEXICAL_FAST_PATH = os.getenv('LEXICAL_FAST_PATH', '1') == '1'
+LEXICAL_FAST_PATH_MIN_COVERAGE = float(os.getenv('LEXICAL_FAST_PATH_MIN_COVERAGE', 1.0))  # Todos los términos de la pregunta
+LEXICAL_FAST_PATH_MARGIN = float(os.getenv('LEXICAL_FAST_PATH_MARGIN', 2.0))  # Score del primero / score del segundo
+# Términos de la pregunta necesarios para el atajo, salvo que alguno sea un identificador ("12.3", "ACC-0042")
+LEXICAL_FAST_PATH_MIN_TERMS = int(os.getenv('LEXICAL_FAST_PATH_MIN_TERMS', 3))
+
+# Búsqueda sobre todos los documentos de un usuario (índice IVF a partir de CORPUS_IVF_MIN_ROWS chunks)
+CORPUS_CACHE_MAX_BYTES = int(os.getenv('CORPUS_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+CORPUS_IVF_MIN_ROWS = int(os.getenv('CORPUS_IVF_MIN_ROWS', 20000))
+CORPUS_IVF_NPROBE = int(os.getenv('CORPUS_IVF_NPROBE', 8))
+CORPUS_EXACT_MAX_ROWS = int(os.getenv('CORPUS_EXACT_MAX_ROWS', 5000))  # Filtros que dejan menos filas se buscan exacto
+# Segundos que se reutiliza la firma de los documentos de un usuario sin consultar la base de datos
+# (documentos completados en otro proceso, como el worker, aparecen a más tardar tras este tiempo)
+CORPUS_SIGNATURE_TTL = float(os.getenv('CORPUS_SIGNATURE_TTL', 10))
+
+# Contexto del chat: chunks candidatos que se recuperan y presupuesto de tokens del contexto
+CONTEXT_CANDIDATES = int(os.getenv('CONTEXT_CANDIDATES', 6))
+CONTEXT_MAX_TOKENS = int(os.getenv('CONTEXT_MAX_TOKENS', 1500))
+
+# Ingesta en streaming: memoria acotada por ventana, no por tamaño del documento
+MAX_UPLOAD_SIZE_MB = int(os.getenv('MAX_UPLOAD_SIZE_MB', 50))
+EXTRACTION_WINDOW_CHARS = int(os.getenv('EXTRACTION_WINDOW_CHARS', 200000))  # Texto en memoria antes de dividir
+INGEST_CHUNK_WINDOW = int(os.getenv('INGEST_CHUNK_WINDOW', 64))  # Chunks embebidos y guardados por ventana
+
+# Reanudación de ingestas (manage.py resume_ingestion): cada ventana se confirma en una transacción,
+# y un documento pendiente o en proceso sin checkpoint en INGEST_STALE_MINUTES se considera colgado
+INGEST_STALE_MINUTES = float(os.getenv('INGEST_STALE_MINUTES', 30))
+INGEST_RESUME_CONCURRENCY = int(os.getenv('INGEST_RESUME_CONCURRENCY', 4))
+# Errores transitorios (rate limit, timeouts, conexión perdida): la tarea se reintenta con backoff exponencial
+# y el documento solo queda fallido cuando se agotan los reintentos
+INGEST_TASK_MAX_RETRIES = int(os.getenv('INGEST_TASK_MAX_RETRIES', 3))
+INGEST_RETRY_BASE_DELAY = float(os.getenv('INGEST_RETRY_BASE_DELAY', 30))  # Segundos, se duplica en cada reintento
+INGEST_RETRY_MAX_DELAY = float(os.getenv('INGEST_RETRY_MAX_DELAY', 600))
+
+# Extracción de PDF en paralelo con un pool de procesos (1 = secuencial)
+PDF_EXTRACT_WORKERS = int(os.getenv('PDF_EXTRACT_WORKERS', os.cpu_count() or 1))
+PDF_PAGES_PER_TASK = int(os.getenv('PDF_PAGES_PER_TASK', 16))  # Páginas por tarea enviada a cada proceso
+PDF_PARALLEL_MIN_PAGES = int(os.getenv('PDF_PARALLEL_MIN_PAGES', 32))  # Por debajo no compensa arrancar el pool
+
+# Embeddings durante la ingesta
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv('EMBEDDING_BATCH_MAX_TOKENS', 20000))  # Tokens por request a OpenAI
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv('EMBEDDING_BATCH_MAX_ITEMS', 256))  # Chunks por request
+# Concurrencia adaptativa (AIMD) de los batches: arranca en EMBEDDING_INITIAL_CONCURRENCY, se reduce a la mitad
+# con cada 429 y sube de a uno mientras las respuestas son sanas, entre el mínimo y el máximo
+EMBEDDING_INITIAL_CONCURRENCY = int(os.getenv('EMBEDDING_INITIAL_CONCURRENCY', 4))
+EMBEDDING_MIN_CONCURRENCY = int(os.getenv('EMBEDDING_MIN_CONCURRENCY', 1))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', 16))  # Requests en paralelo como máximo
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', 5))
+EMBEDDING_RETRY_BASE_DELAY = 1.0  # Segundos, se duplica en cada reintento
+EMBEDDING_RETRY_MAX_DELAY = 30.0
+EMBEDDING_STORAGE_FORMAT = os.getenv('EMBEDDING_STORAGE_FORMAT', 'f32')  # 'f32', 'f16' o 'i8' (cuantizado)
+
+# Límites por minuto de la cuenta de OpenAI (0 = sin límite). Cada llamada espera a que quepan sus requests
+# y sus tokens; con 'redis' los buckets se comparten entre todos los procesos (web y workers)
+RATE_LIMIT_BACKEND = os.getenv('RATE_LIMIT_BACKEND', 'local')  # 'local' (por proceso) o 'redis'
+RATE_LIMIT_REDIS_URL = os.getenv('RATE_LIMIT_REDIS_URL', CELERY_BROKER_URL)
+RATE_LIMIT_BURST_SECONDS = float(os.getenv('RATE_LIMIT_BURST_SECONDS', 1))  # Ráfaga máxima; la API aplica la cuota por segundo
+EMBEDDING_RPM = int(os.getenv('EMBEDDING_RPM', 0))
+EMBEDDING_TPM = int(os.getenv('EMBEDDING_TPM', 0))
+LLM_RPM = int(os.getenv('LLM_RPM', 0))
+LLM_TPM = int(os.getenv('LLM_TPM', 0))
+LLM_COMPLETION_TOKENS_ESTIMATE = int(os.getenv('LLM_COMPLETION_TOKENS_ESTIMATE', 500))  # Tokens de respuesta reservados por llamada
+
+# Índice vectorial para la recuperación: 'numpy' (exacto) o 'hnsw' (aproximado, requiere hnswlib)
+VECTOR_INDEX_BACKEND = os.getenv('VECTOR_INDEX_BACKEND', 'numpy')
+VECTOR_INDEX_OPTIONS = {}  # Ej. {'ef_search': 64, 'm': 16} para hnsw
+
+# Caché de matrices de embeddings por documento (LRU acotado por bytes, por proceso)
+DOCUMENT_CACHE_MAX_BYTES = int(os.getenv('DOCUMENT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# Opcional: compartir las matrices entre procesos vía Redis, ej. 'redis://localhost:6379/1'
+DOCUMENT_CACHE_REDIS_URL = os.getenv('DOCUMENT_CACHE_REDIS_URL')
+
+# Caché de embeddings de consultas: 'memory' (LRU por proceso) o 'redis' (compartido)
+QUERY_CACHE_BACKEND = os.getenv('QUERY_CACHE_BACKEND', 'memory')
+QUERY_CACHE_REDIS_URL = os.getenv('QUERY_CACHE_REDIS_URL', 'redis://localhost:6379/1')
+QUERY_CACHE_MAX_BYTES = int(os.getenv('QUERY_CACHE_MAX_BYTES', 32 * 1024 * 1024))  # ~5000 vectores de 1536 dims
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', 24 * 3600))  # Segundos
+
+# Historial de conversaciones: tamaño de página y máximo de mensajes recientes por conversación
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', 20))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv('HISTORY_MAX_PAGE_SIZE', 100))
+HISTORY_MAX_MESSAGES = int(os.getenv('HISTORY_MAX_MESSAGES', 20))
+
+# Caché semántico de respuestas: misma pregunta (o una muy parecida) con los mismos chunks recuperados
+ANSWER_CACHE = os.getenv('ANSWER_CACHE', '1') == '1'
+ANSWER_CACHE_MAX_BYTES = int(os.getenv('ANSWER_CACHE_MAX_BYTES', 16 * 1024 * 1024))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 3600))  # Segundos
+ANSWER_CACHE_MIN_SIMILARITY = float(os.getenv('ANSWER_CACHE_MIN_SIMILARITY', 0.95))  # Coseno entre las preguntas
+ANSWER_CACHE_MAX_PER_CONTEXT = int(os.getenv('ANSWER_CACHE_MAX_PER_CONTEXT', 8))  # Respuestas por conjunto de chunks
 
 # Google Cloud Storage settings
 DEFAULT_FILE_STORAGE = 'rag_app_apis.storage.UniqueFilenameGoogleCloudStorage'
+# Subidas en una sola pasada: el archivo va a GCS y a la copia local mientras llega, calculando hash y tamaño
+UPLOAD_STREAMING = os.getenv('UPLOAD_STREAMING', '1') == '1'
+# Archivos más grandes se suben a GCS de forma resumable en partes de este tamaño (múltiplo de 256 KiB)
+GCS_UPLOAD_CHUNK_SIZE = int(os.getenv('GCS_UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024))
+# Cliente de GCS compartido: conexiones reutilizables por proceso (hilos de ingesta y de subidas)
+GCS_HTTP_POOL_SIZE = int(os.getenv('GCS_HTTP_POOL_SIZE', 32))
+# Caché de metadatos (tamaño, content type, etag): exists() y size() sin round trip mientras no expiren
+GCS_METADATA_CACHE_TTL = int(os.getenv('GCS_METADATA_CACHE_TTL', 300))  # Segundos
+GCS_METADATA_CACHE_MAX_BYTES = int(os.getenv('GCS_METADATA_CACHE_MAX_BYTES', 4 * 1024 * 1024))
+# Bucket falso en disco en lugar de GCS (pruebas y desarrollo sin credenciales)
+GCS_LOCAL_BUCKET_DIR = os.getenv('GCS_LOCAL_BUCKET_DIR', '')
 GCP_BUCKET_NAME = 'rag-saas-archives'
 GCP_PROJECT_ID = 'uniandes-452002'
 GCP_CREDENTIALS = {
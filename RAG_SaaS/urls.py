@@ -20,12 +20,14 @@ from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
 from rest_framework.documentation import include_docs_urls
+from rag_app_apis.views import metrics_view
 
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('rag_app_apis.urls')),
-    path('docs/', include_docs_urls(title='RAG SaaS documentation'))
+    path('docs/', include_docs_urls(title='RAG SaaS documentation')),
+    path('metrics', metrics_view, name='metrics'),
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
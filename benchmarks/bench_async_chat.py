@@ -0,0 +1,159 @@
+"""
+Compares chat throughput of the WSGI path (SendMessageView) with the ASGI path
+(AsyncSendMessageView).
+
+OpenAI is replaced by fakes with a fixed latency, so the numbers show how many
+chats one worker keeps in flight while waiting on the network, not model speed.
+The WSGI side runs requests on a fixed thread pool (one worker with --threads
+threads, like gunicorn's gthread worker); the ASGI side runs them all on one
+event loop.
+
+Usage:
+    python benchmarks/bench_async_chat.py --requests 200 --concurrency 100 --latency 0.2
+
+Runs against a throwaway test database created from DJANGO_SETTINGS_MODULE.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "RAG_SaaS.settings")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+import numpy as np
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import AsyncClient, Client
+from django.test.utils import setup_test_environment
+from rest_framework.authtoken.models import Token
+
+from rag_app_apis.providers import FakeStreamingLLM, override_provider
+from rag_app_apis.embedding_codec import encode_embedding
+from rag_app_apis.models import APIChunk, APIConversation, APIDocument
+
+
+class FakeEmbeddings:
+    """Embedding client that only waits; sync and async entry points."""
+
+    def __init__(self, latency, dim=64):
+        self.latency = latency
+        self.dim = dim
+        self.model = "fake"
+
+    def _vector(self, text):
+        return np.random.default_rng(abs(hash(text)) % 2**32).standard_normal(self.dim).tolist()
+
+    def embed_query(self, text):
+        time.sleep(self.latency)
+        return self._vector(text)
+
+    def embed_documents(self, texts):
+        time.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.latency)
+        return self._vector(text)
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.latency)
+        return [self._vector(text) for text in texts]
+
+
+def seed(chunks, dim):
+    user = User.objects.create_user(username="bench", password="bench")
+    token = Token.objects.create(user=user)
+    conversation = APIConversation.objects.create(user=user, title="bench")
+    document = APIDocument.objects.create(
+        user=user, conversation=conversation, file="documents/bench.txt", title="bench",
+        processed=True, status=APIDocument.STATUS_COMPLETED, progress=100,
+    )
+    rng = np.random.default_rng(0)
+    APIChunk.objects.bulk_create([
+        APIChunk(document=document, content=f"chunk {i} " * 50, ordinal=i, embedding=encode_embedding(rng.standard_normal(dim)))
+        for i in range(chunks)
+    ])
+    return user, token.key, conversation
+
+
+def summarize(name, latencies, elapsed, concurrency):
+    latencies = sorted(latencies)
+    p95 = latencies[int(0.95 * (len(latencies) - 1))]
+    print(f"{name:<6} concurrency={concurrency:<4} requests={len(latencies):<5} "
+          f"time={elapsed:7.2f}s  throughput={len(latencies) / elapsed:7.1f} req/s  "
+          f"p50={statistics.median(latencies) * 1000:7.0f}ms  p95={p95 * 1000:7.0f}ms")
+
+
+def run_wsgi(user, token, conversation, requests, threads):
+    def one(i):
+        client = Client(headers={"Authorization": f"Token {token}"})
+        start = time.perf_counter()
+        response = client.post("/api/api_conversation/send/", {
+            "user": user.id, "conversation": conversation.id, "message": f"wsgi question {i}",
+        }, content_type="application/json")
+        assert response.status_code == 200, response.content
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = list(executor.map(one, range(requests)))
+    summarize("wsgi", latencies, time.perf_counter() - start, threads)
+
+
+async def run_asgi(user, token, conversation, requests, concurrency):
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await client.post("/api/api_conversation/send_async/", {
+                "user": user.id, "conversation": conversation.id, "message": f"asgi question {i}",
+            }, content_type="application/json", headers={"Authorization": f"Token {token}"})
+            assert response.status_code == 200, response.content
+            return time.perf_counter() - start
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(one(i) for i in range(requests)))
+    summarize("asgi", latencies, time.perf_counter() - start, concurrency)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=100, help="in-flight chats on the ASGI event loop")
+    parser.add_argument("--threads", type=int, default=8, help="threads of the simulated WSGI worker")
+    parser.add_argument("--latency", type=float, default=0.2, help="seconds per fake OpenAI call")
+    parser.add_argument("--chunks", type=int, default=500)
+    parser.add_argument("--dim", type=int, default=64)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    if connection.vendor == "sqlite":
+        # La base en memoria compartida se bloquea con escrituras concurrentes; usar un archivo
+        connection.settings_dict["TEST"]["NAME"] = os.path.join(tempfile.gettempdir(), "bench_async_chat.sqlite3")
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        override_provider("embeddings", FakeEmbeddings(args.latency, args.dim))
+        override_provider("llm", FakeStreamingLLM(response="ok", delay=args.latency))
+        user, token, conversation = seed(args.chunks, args.dim)
+
+        run_wsgi(user, token, conversation, args.requests, args.threads)
+        asyncio.run(run_asgi(user, token, conversation, args.requests, args.concurrency))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Offline comparison of the chunking strategies in rag_app_apis.chunking:
+chunk counts, token totals (what embedding the document costs), prompt tokens
+for the top-k chunks and retrieval hit-rate.
+
+Usage:
+    python benchmarks/bench_chunking.py                       # synthetic sample docs
+    python benchmarks/bench_chunking.py doc1.pdf doc2.md --strategies default fine legacy
+    python benchmarks/bench_chunking.py contract.pdf --queries qa.jsonl
+
+Retrieval is scored with BM25 over hashed terms, so no OpenAI calls are made;
+it ranks chunks the same way for every strategy and only the chunking varies.
+Hit-rate is the share of questions whose answer string appears in one of the
+top-k chunks. The synthetic docs carry their own questions; for real files pass
+--queries, a JSONL file of {"question": ..., "answer": ...} lines.
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "RAG_SaaS.settings")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+import numpy as np
+
+from rag_app_apis.chunking import get_chunker, get_strategies
+from rag_app_apis.tokens import count_tokens
+from rag_app_apis.utils import iter_text_segments
+
+WORDS = (
+    "agreement party obligation notice period termination liability clause schedule invoice "
+    "delivery warranty service level support report audit confidential data processor breach"
+).split()
+
+
+def filler(rng, sentences):
+    return " ".join(
+        " ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 25))).capitalize() + "."
+        for _ in range(sentences)
+    )
+
+
+def write_sample_docs(directory, docs=3, sections=12, seed=7):
+    """Writes Markdown and text files with one checkable fact per section; returns (paths, qa pairs)."""
+    rng = random.Random(seed)
+    paths, qa = [], []
+    for number in range(docs):
+        parts = []
+        for section in range(sections):
+            code = f"ACC-{number}{section:02d}{rng.randint(100, 999)}"
+            amount = rng.randint(100, 9999)
+            fact = f"The renewal fee for account {code} is {amount} euros."
+            qa.append({"question": f"What is the renewal fee for account {code}?", "answer": f"{code} is {amount}"})
+            paragraphs = [filler(rng, rng.randint(4, 12)) for _ in range(rng.randint(2, 6))]
+            paragraphs.insert(rng.randint(0, len(paragraphs)), fact)
+            parts.append(f"## Section {section + 1}\n\n" + "\n\n".join(paragraphs))
+        ext = ".md" if number % 2 == 0 else ".txt"
+        path = os.path.join(directory, f"sample_{number}{ext}")
+        with open(path, "w", encoding="utf-8") as out:
+            out.write("\n\n".join(parts) + "\n")
+        paths.append(path)
+    return paths, qa
+
+
+def term_counts(texts, dim=4096):
+    """Hashed term-count matrix."""
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in re.findall(r"[\w-]+", text.lower()):
+            matrix[row, zlib.crc32(word.encode()) % dim] += 1.0
+    return matrix
+
+
+def bm25_scores(query_counts, counts, k1=1.2, b=0.75):
+    """(questions, chunks) BM25 score matrix."""
+    lengths = counts.sum(axis=1, keepdims=True)
+    df = (counts > 0).sum(axis=0)
+    idf = np.log(1 + (len(counts) - df + 0.5) / (df + 0.5))
+    weights = counts * (k1 + 1) / (counts + k1 * (1 - b + b * lengths / max(lengths.mean(), 1)))
+    return (query_counts > 0).astype(np.float32) @ (weights * idf).T
+
+
+def evaluate(strategy, paths, qa, top_k):
+    chunker = get_chunker(strategy)
+    chunks = []
+    for path in paths:
+        chunks.extend(piece.text for piece, _ in chunker.iter_chunks(iter_text_segments(path)))
+    tokens = [count_tokens(chunk) for chunk in chunks]
+
+    hits, prompt_tokens = 0, []
+    if qa and chunks:
+        scores = bm25_scores(term_counts([item["question"] for item in qa]), term_counts(chunks))
+        for item, row in zip(qa, scores):
+            top = np.argsort(-row)[:top_k]
+            hits += any(item["answer"] in chunks[i] for i in top)
+            prompt_tokens.append(sum(tokens[i] for i in top))
+
+    return {
+        "chunks": len(chunks),
+        "tokens": sum(tokens),
+        "avg": sum(tokens) / len(tokens) if tokens else 0,
+        "max": max(tokens, default=0),
+        "prompt": sum(prompt_tokens) / len(prompt_tokens) if prompt_tokens else 0,
+        "hit_rate": hits / len(qa) if qa else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="documents to chunk (default: generated samples)")
+    parser.add_argument("--queries", help="JSONL with question/answer pairs for the given files")
+    parser.add_argument("--strategies", nargs="+", default=sorted(get_strategies()))
+    parser.add_argument("--top-k", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        if args.files:
+            paths = args.files
+            qa = []
+            if args.queries:
+                with open(args.queries, encoding="utf-8") as queries:
+                    qa = [json.loads(line) for line in queries if line.strip()]
+        else:
+            paths, qa = write_sample_docs(directory)
+
+        document_tokens = sum(
+            count_tokens("".join(segment.text for segment in iter_text_segments(path))) for path in paths
+        )
+        print(f"{len(paths)} documents, {document_tokens} tokens of text, {len(qa)} questions, top-k={args.top_k}\n")
+        print(f"{'strategy':<12}{'chunks':>8}{'tokens':>10}{'x text':>8}{'avg tok':>9}{'max tok':>9}{'prompt tok':>12}{'hit-rate':>10}")
+        for strategy in args.strategies:
+            result = evaluate(strategy, paths, qa, args.top_k)
+            hit_rate = f"{result['hit_rate']:.2f}" if result["hit_rate"] is not None else "-"
+            print(
+                f"{strategy:<12}{result['chunks']:>8}{result['tokens']:>10}"
+                f"{result['tokens'] / max(document_tokens, 1):>8.2f}{result['avg']:>9.0f}{result['max']:>9}"
+                f"{result['prompt']:>12.0f}{hit_rate:>10}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+Scaling benchmark for corpus retrieval (rag_app_apis.corpus_index) at 1k,
+10k and 100k chunks.
+
+Usage:
+    python benchmarks/bench_corpus_retrieval.py
+    python benchmarks/bench_corpus_retrieval.py --sizes 1000 10000 100000 --dim 1536 --nprobe 4 8 16
+
+For every corpus size it compares:
+  - exact:   a full scan of every chunk (what scanning all APIChunk rows costs)
+  - default: the corpus index as configured (IVF from CORPUS_IVF_MIN_ROWS rows)
+  - ivf:     the corpus index with the IVF partition forced on
+  - ivf + filter: the same search restricted to 10% of the documents
+
+Embeddings are synthetic and clustered by topic; recall@k is measured
+against the exact scan. No database or OpenAI calls are involved.
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "RAG_SaaS.settings")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+import numpy as np
+
+from rag_app_apis.corpus_index import build_corpus_entry, search_corpus_entry
+from rag_app_apis.vector_index import normalize_rows
+
+
+def synthetic_corpus(rows, dim, chunks_per_doc, topics, noise, rng):
+    """Chunks drawn around topic centers; each document mostly sticks to one topic."""
+    centers = normalize_rows(rng.standard_normal((topics, dim)))
+    doc_ids = np.arange(rows) // chunks_per_doc + 1
+    doc_topic = rng.integers(0, topics, size=doc_ids[-1] + 1)
+    topic = np.where(rng.random(rows) < 0.8, doc_topic[doc_ids], rng.integers(0, topics, size=rows))
+    matrix = normalize_rows(centers[topic] + noise * rng.standard_normal((rows, dim)) / np.sqrt(dim))
+    queries = normalize_rows(centers[rng.integers(0, topics, size=64)] + noise * rng.standard_normal((64, dim)) / np.sqrt(dim))
+    return np.arange(1, rows + 1, dtype=np.int64), doc_ids.astype(np.int64), matrix, queries
+
+
+def timed(search, queries):
+    times, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search(query))
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), results
+
+
+def recall(results, truth):
+    found = [len({hit[0] for hit in got} & {hit[0] for hit in want}) / max(len(want), 1) for got, want in zip(results, truth)]
+    return sum(found) / len(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--chunks-per-doc", type=int, default=50)
+    parser.add_argument("--topics", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=1.0, help="noise norm relative to the topic centers")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8])
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'chunks':>8}  {'mode':<22}{'build s':>9}{'p50 ms':>9}{'recall@k':>10}")
+    for rows in args.sizes:
+        ids, doc_ids, matrix, queries = synthetic_corpus(rows, args.dim, args.chunks_per_doc, args.topics, args.noise, rng)
+
+        exact = build_corpus_entry(ids, doc_ids, matrix, min_rows_for_ivf=rows + 1)
+        exact_ms, truth = timed(lambda q: search_corpus_entry(exact, q, args.top_k), queries)
+        print(f"{rows:>8}  {'exact (full scan)':<22}{0:>9.2f}{exact_ms:>9.3f}{1.0:>10.3f}")
+
+        # Lo que usa la app: exacto por debajo de CORPUS_IVF_MIN_ROWS, IVF por encima
+        start = time.perf_counter()
+        default = build_corpus_entry(ids, doc_ids, matrix)
+        build_s = time.perf_counter() - start
+        default_ms, found = timed(lambda q: search_corpus_entry(default, q, args.top_k), queries)
+        mode = "default (ivf)" if default.centroids is not None else "default (exact)"
+        print(f"{rows:>8}  {mode:<22}{build_s:>9.2f}{default_ms:>9.3f}{recall(found, truth):>10.3f}")
+
+        start = time.perf_counter()
+        ivf = build_corpus_entry(ids, doc_ids, matrix, min_rows_for_ivf=1)
+        build_s = time.perf_counter() - start
+        for nprobe in args.nprobe:
+            ivf_ms, found = timed(lambda q: search_corpus_entry(ivf, q, args.top_k, nprobe=nprobe), queries)
+            print(f"{rows:>8}  {f'ivf nprobe={nprobe}':<22}{build_s:>9.2f}{ivf_ms:>9.3f}{recall(found, truth):>10.3f}")
+
+        allowed = np.unique(doc_ids)[::10].tolist()
+        _, filtered_truth = timed(lambda q: search_corpus_entry(exact, q, args.top_k, document_ids=allowed), queries)
+        filtered_ms, found = timed(
+            lambda q: search_corpus_entry(ivf, q, args.top_k, document_ids=allowed, nprobe=args.nprobe[0]), queries
+        )
+        print(f"{rows:>8}  {'ivf + filter 10% docs':<22}{'':>9}{filtered_ms:>9.3f}{recall(found, filtered_truth):>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Offline throughput of the embedding providers on the ingestion path (embed_chunks).
+
+Usage:
+    python benchmarks/bench_embedding_providers.py
+    python benchmarks/bench_embedding_providers.py --chunks 2000 --workers 0 2 4
+
+Always measures the deterministic hash provider; the local sentence-transformers
+provider is measured in-process (--workers 0) and with process pools of the
+given sizes when sentence-transformers is installed. OpenAI is not called.
+"""
+
+import argparse
+import importlib.util
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "RAG_SaaS.settings")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+from django.conf import settings
+
+from rag_app_apis.providers import HashEmbeddings, LocalEmbeddings, override_provider, reset_providers
+from rag_app_apis.utils import embed_chunks
+
+
+def make_chunks(count, words, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    return [" ".join(rng.choice(vocabulary) for _ in range(words)) for _ in range(count)]
+
+
+def measure(provider, chunks):
+    override_provider("embeddings", provider)
+    embed_chunks(chunks[:8])  # Carga del modelo / arranque del pool fuera de la medición
+    start = time.perf_counter()
+    vectors = embed_chunks(chunks)
+    elapsed = time.perf_counter() - start
+    reset_providers()
+    return elapsed, len(vectors[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=1000)
+    parser.add_argument("--words", type=int, default=250, help="words per chunk (about 400 tokens)")
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2], help="local provider pool sizes")
+    parser.add_argument("--model", default=settings.LOCAL_EMBEDDING_MODEL)
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks, args.words)
+    configs = [("hash (fake)", HashEmbeddings(settings.FAKE_EMBEDDING_DIM))]
+    if importlib.util.find_spec("sentence_transformers"):
+        configs += [(f"local, {workers or 'no'} pool workers", LocalEmbeddings(args.model, workers=workers)) for workers in args.workers]
+    else:
+        print("sentence-transformers not installed: skipping the local provider\n")
+
+    print(f"{'provider':<30}{'dim':>6}{'seconds':>10}{'chunks/s':>11}")
+    for name, provider in configs:
+        elapsed, dim = measure(provider, chunks)
+        print(f"{name:<30}{dim:>6}{elapsed:>10.2f}{len(chunks) / elapsed:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
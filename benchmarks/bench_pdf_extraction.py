@@ -0,0 +1,89 @@
+"""
+Compares sequential PDF text extraction with the process-pool mode of
+rag_app_apis.utils.iter_pdf_pages.
+
+Usage:
+    python benchmarks/bench_pdf_extraction.py sample1.pdf sample2.pdf --workers 1 2 4 8
+
+Without PDF arguments a synthetic text-only PDF is generated (--pages pages).
+The output of every mode is checked against the sequential one, page by page.
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "RAG_SaaS.settings")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+from rag_app_apis.utils import iter_pdf_pages
+
+
+def write_synthetic_pdf(path, pages, lines_per_page=45):
+    """Writes a minimal PDF with Helvetica text on every page."""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for number in range(pages):
+        lines = [f"Page {number + 1} line {line}: clause {number}.{line} the parties agree to the terms." for line in range(lines_per_page)]
+        stream = "BT /F1 10 Tf 40 800 Td 14 TL " + " ".join(f"({text}) '" for text in lines) + " ET"
+        stream = stream.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_id = len(objects)
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id)
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {pages} >>".encode()
+
+    with open(path, "wb") as out:
+        out.write(b"%PDF-1.4\n")
+        offsets = []
+        for number, body in enumerate(objects, start=1):
+            offsets.append(out.tell())
+            out.write(b"%d 0 obj\n%s\nendobj\n" % (number, body))
+        xref = out.tell()
+        out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+        for offset in offsets:
+            out.write(b"%010d 00000 n \n" % offset)
+        out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+
+
+def timed_extract(path, workers):
+    start = time.perf_counter()
+    pages = list(iter_pdf_pages(path, workers=workers))
+    return time.perf_counter() - start, pages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("pdfs", nargs="*")
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4, os.cpu_count() or 1])
+    parser.add_argument("--pages", type=int, default=300, help="pages of the synthetic PDF")
+    parser.add_argument("--repeat", type=int, default=3, help="best of N runs per mode")
+    args = parser.parse_args()
+
+    paths = args.pdfs
+    if not paths:
+        path = os.path.join(tempfile.gettempdir(), f"bench_synthetic_{args.pages}p.pdf")
+        write_synthetic_pdf(path, args.pages)
+        paths = [path]
+
+    for path in paths:
+        baseline, expected = min(timed_extract(path, 1) for _ in range(args.repeat))
+        print(f"{os.path.basename(path)}: {len(expected)} pages, {os.cpu_count()} CPUs")
+        print(f"  sequential          {baseline:7.2f}s")
+        for workers in sorted(set(args.workers)):
+            if workers <= 1:
+                continue
+            elapsed, pages = min(timed_extract(path, workers) for _ in range(args.repeat))
+            assert pages == expected, "parallel extraction changed the page text or order"
+            print(f"  {workers:>2} processes         {elapsed:7.2f}s  speedup x{baseline / elapsed:.2f}")
+
+
+if __name__ == "__main__":
+    main()
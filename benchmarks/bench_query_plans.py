@@ -0,0 +1,203 @@
+"""
+Query plans and latency of the hot ORM queries before and after the composite
+indexes of migration 0010_composite_indexes.
+
+Usage:
+    python benchmarks/bench_query_plans.py
+    python benchmarks/bench_query_plans.py --users 50 --conversations 400 --messages 30 --chunks 60
+
+A throw-away SQLite database is migrated up to 0009, seeded through the
+historical models and measured; then 0010 is applied (including the chunk
+ordinal back-fill) and the same access paths are measured again. For every
+query it prints the EXPLAIN QUERY PLAN and the median latency. The configured
+database is never touched and the SQLite file is removed at the end.
+"""
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "RAG_SaaS.settings")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+from django.conf import settings
+
+DB_PATH = os.path.join(tempfile.mkdtemp(prefix="bench_plans_"), "bench.sqlite3")
+settings.DATABASES = {"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": DB_PATH}}
+
+import django
+
+django.setup()
+
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.loader import MigrationLoader
+from django.utils import timezone
+
+from rag_app_apis.models import APIChunk, APIConversation, APIDocument, APIMessage
+
+BEFORE = ("rag_app_apis", "0009_apidocument_file_type")
+AFTER = ("rag_app_apis", "0010_composite_indexes")
+
+
+def seed(args, rng):
+    """Fills the 0009 schema through its historical models; returns the ids used as query parameters."""
+    apps = MigrationLoader(connection).project_state(BEFORE).apps
+    User = apps.get_model("auth", "User")
+    Conversation = apps.get_model("rag_app_apis", "APIConversation")
+    Message = apps.get_model("rag_app_apis", "APIMessage")
+    Document = apps.get_model("rag_app_apis", "APIDocument")
+    Chunk = apps.get_model("rag_app_apis", "APIChunk")
+    # Fechas repartidas en el último año en lugar de todas "ahora"
+    for model, name in ((Conversation, "created_at"), (Message, "timestamp"), (Document, "uploaded_at")):
+        model._meta.get_field(name).auto_now_add = False
+
+    now = timezone.now()
+    User.objects.bulk_create([User(username=f"user{i}", password="!") for i in range(args.users)])
+    users = list(User.objects.values_list("id", flat=True))
+
+    Conversation.objects.bulk_create([
+        Conversation(user_id=user, title=f"conversation {i}", created_at=now - timedelta(minutes=rng.randint(0, 525600)))
+        for user in users for i in range(args.conversations)
+    ], batch_size=5000)
+    conversations = list(Conversation.objects.values_list("id", "user_id"))
+
+    Document.objects.bulk_create([
+        Document(
+            user_id=user, conversation_id=conversation, file=f"documents/doc{conversation}.pdf", title=f"doc {conversation}",
+            status=rng.choice(["completed"] * 9 + ["failed"]), file_type="pdf",
+            uploaded_at=now - timedelta(minutes=rng.randint(0, 525600)),
+        )
+        for conversation, user in conversations
+    ], batch_size=5000)
+    documents = list(Document.objects.values_list("id", flat=True))
+
+    batch = []
+    for conversation, user in conversations:
+        start = now - timedelta(minutes=rng.randint(0, 525600))
+        batch.extend(
+            Message(conversation_id=conversation, sender_id=user, role="user" if i % 2 == 0 else "assistant",
+                    text="message " * 20, timestamp=start + timedelta(seconds=30 * i))
+            for i in range(args.messages)
+        )
+        if len(batch) >= 20000:
+            Message.objects.bulk_create(batch, batch_size=5000)
+            batch = []
+    Message.objects.bulk_create(batch, batch_size=5000)
+
+    # Los primeros documentos se ingieren intercalados, como dos subidas a la vez: ids no consecutivos
+    interleaved = documents[:100]
+    Chunk.objects.bulk_create([
+        Chunk(document_id=document, content="chunk text " * 40, embedding=b"")
+        for _ in range(args.chunks) for document in interleaved
+    ], batch_size=5000)
+    batch = []
+    for document in documents[100:]:
+        batch.extend(Chunk(document_id=document, content="chunk text " * 40, embedding=b"") for _ in range(args.chunks))
+        if len(batch) >= 20000:
+            Chunk.objects.bulk_create(batch, batch_size=5000)
+            batch = []
+    Chunk.objects.bulk_create(batch, batch_size=5000)
+
+    return {
+        "users": users,
+        "conversations": [conversation for conversation, _ in conversations],
+        "documents": documents,
+        "since": now - timedelta(days=90),
+    }
+
+
+def hot_queries(ids, rng, ordinal):
+    """The access paths of the app, as (name, function returning a queryset)."""
+    chunk_order = "ordinal" if ordinal else "id"
+    return [
+        ("history page (user, -created_at, -id)", lambda: APIConversation.objects.filter(user_id=rng.choice(ids["users"]))
+            .order_by("-created_at", "-id").values_list("id", "title", "created_at")[:20]),
+        ("messages of a conversation", lambda: APIMessage.objects.filter(conversation_id=rng.choice(ids["conversations"]))
+            .order_by("timestamp", "id").values_list("id", "role", "text")),
+        ("latest 5 messages", lambda: APIMessage.objects.filter(conversation_id=rng.choice(ids["conversations"]))
+            .order_by("-timestamp", "-id").values_list("id", "text")[:5]),
+        ("document of a conversation", lambda: APIDocument.objects.filter(conversation_id=rng.choice(ids["conversations"]))
+            .order_by("id").values_list("id", "title", "index_version")[:1]),
+        ("corpus documents (user, status, date)", lambda: APIDocument.objects.filter(
+            user_id=rng.choice(ids["users"]), status="completed", uploaded_at__gte=ids["since"]).values_list("id", "title")),
+        ("chunk ids of a document in order", lambda: APIChunk.objects.filter(document_id=rng.choice(ids["documents"]))
+            .order_by(chunk_order).values_list("id", flat=True)),
+    ]
+
+
+def ordinals_in_id_order():
+    """Checks the back-fill: in every document, ordinals follow the ids from 0."""
+    previous, expected = None, 0
+    for document_id, ordinal in APIChunk.objects.order_by("document_id", "id").values_list("document_id", "ordinal").iterator(chunk_size=10000):
+        expected = expected + 1 if document_id == previous else 0
+        if ordinal != expected:
+            return False
+        previous = document_id
+    return True
+
+
+def measure(queries, repeat):
+    results = {}
+    for name, make in queries:
+        plan = make().explain()
+        times = []
+        for _ in range(repeat):
+            queryset = make()
+            start = time.perf_counter()
+            list(queryset)
+            times.append((time.perf_counter() - start) * 1000)
+        results[name] = (statistics.median(times), plan)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--conversations", type=int, default=500, help="conversations (and documents) per user")
+    parser.add_argument("--messages", type=int, default=20, help="messages per conversation")
+    parser.add_argument("--chunks", type=int, default=40, help="chunks per document")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    call_command("migrate", *BEFORE, verbosity=0)
+    start = time.perf_counter()
+    ids = seed(args, random.Random(0))
+    conversations = len(ids["conversations"])
+    print(f"seeded {conversations} conversations, {conversations * args.messages} messages, "
+          f"{len(ids['documents'])} documents, {len(ids['documents']) * args.chunks} chunks "
+          f"in {time.perf_counter() - start:.1f}s ({DB_PATH})")
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    before = measure(hot_queries(ids, random.Random(1), ordinal=False), args.repeat)
+
+    start = time.perf_counter()
+    call_command("migrate", *AFTER, verbosity=0)
+    print(f"migration {AFTER[1]} (indexes + ordinal back-fill): {time.perf_counter() - start:.1f}s")
+    print(f"chunk ordinals match id order: {ordinals_in_id_order()}\n")
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+    after = measure(hot_queries(ids, random.Random(1), ordinal=True), args.repeat)
+
+    print(f"{'query':<42}{'before ms':>11}{'after ms':>10}{'speedup':>9}")
+    for (name, (before_ms, _)), (_, (after_ms, _)) in zip(before.items(), after.items()):
+        print(f"{name:<42}{before_ms:>11.3f}{after_ms:>10.3f}{before_ms / max(after_ms, 1e-6):>8.1f}x")
+    print()
+    for (name, (_, before_plan)), (_, (_, after_plan)) in zip(before.items(), after.items()):
+        print(f"{name}\n  before: {before_plan.replace(chr(10), chr(10) + '          ')}"
+              f"\n  after:  {after_plan.replace(chr(10), chr(10) + '          ')}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    finally:
+        connection.close()
+        shutil.rmtree(os.path.dirname(DB_PATH), ignore_errors=True)
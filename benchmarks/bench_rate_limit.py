@@ -0,0 +1,123 @@
+"""
+Embedding ingestion against a simulated API that enforces a per-minute quota.
+
+Usage:
+    python benchmarks/bench_rate_limit.py
+    python benchmarks/bench_rate_limit.py --chunks 800 --rpm 3000 --tpm 1000000
+
+The fake API answers 429 when a call does not fit in its quota, which it
+applies per second like OpenAI does. Compares fixed concurrency without the
+client limiter, the AIMD gate alone, and the RPM/TPM limiter plus AIMD, on
+429s, retries, wall time and the share of the quota actually used. Nothing
+is sent over the network.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "RAG_SaaS.settings")
+os.environ.setdefault("OPENAI_API_KEY", "sk-benchmark")
+
+import django
+
+django.setup()
+
+from django.test import override_settings
+
+from rag_app_apis.providers import override_provider, reset_providers
+from rag_app_apis.rate_limit import LocalRateLimiter, reset_rate_limits
+from rag_app_apis.utils import count_tokens, embed_chunks
+
+
+class RateLimitError(Exception):
+    status_code = 429
+
+
+class QuotaAPI:
+    """Embeddings endpoint with server-side RPM/TPM buckets holding one second of quota."""
+
+    model = "quota-fake"
+
+    def __init__(self, rpm, tpm, latency):
+        self.quota = LocalRateLimiter(rpm, tpm, burst_seconds=1)
+        self.latency = latency
+        self.calls = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        tokens = sum(count_tokens(text) for text in texts)
+        with self._lock:
+            self.calls += 1
+            if self.quota.try_acquire(tokens=tokens):
+                self.rejected += 1
+                raise RateLimitError("Rate limit reached for requests")
+        time.sleep(self.latency + tokens / 200000)
+        return [[0.0] * 8 for _ in texts]
+
+
+def make_chunks(count, words, seed=0):
+    rng = random.Random(seed)
+    vocabulary = [f"term{i}" for i in range(5000)]
+    return [" ".join(rng.choice(vocabulary) for _ in range(words)) for _ in range(count)]
+
+
+def run(chunks, args, client_quota, initial, minimum):
+    api = QuotaAPI(args.rpm, args.tpm, args.latency)
+    rpm, tpm = client_quota
+    overrides = dict(
+        EMBEDDING_RPM=rpm, EMBEDDING_TPM=tpm, RATE_LIMIT_BACKEND="local",
+        EMBEDDING_INITIAL_CONCURRENCY=initial, EMBEDDING_MIN_CONCURRENCY=minimum,
+        EMBEDDING_MAX_CONCURRENCY=args.concurrency, EMBEDDING_BATCH_MAX_TOKENS=args.batch_tokens,
+        EMBEDDING_RETRY_BASE_DELAY=args.retry_delay,
+    )
+    with override_settings(**overrides):
+        reset_rate_limits()
+        override_provider("embeddings", api)
+        start = time.perf_counter()
+        try:
+            embed_chunks(chunks)
+            outcome = "ok"
+        except RateLimitError:
+            outcome = "failed"
+        elapsed = time.perf_counter() - start
+        reset_providers()
+        reset_rate_limits()
+    return api, elapsed, outcome
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=400)
+    parser.add_argument("--words", type=int, default=250, help="words per chunk (about 400 tokens)")
+    parser.add_argument("--rpm", type=int, default=3000, help="requests per minute of the simulated API")
+    parser.add_argument("--tpm", type=int, default=1000000, help="tokens per minute of the simulated API")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per call, plus 5us per token")
+    parser.add_argument("--concurrency", type=int, default=16, help="maximum batches in flight")
+    parser.add_argument("--batch-tokens", type=int, default=2000)
+    parser.add_argument("--retry-delay", type=float, default=1.0, help="base backoff after an error, in seconds")
+    args = parser.parse_args()
+
+    chunks = make_chunks(args.chunks, args.words)
+    tokens = sum(count_tokens(chunk) for chunk in chunks)
+    ideal = tokens / args.tpm * 60
+    print(f"{len(chunks)} chunks, {tokens} tokens; the quota allows it in {ideal:.1f}s at best\n")
+
+    configs = [
+        (f"fixed concurrency {args.concurrency}", (0, 0), args.concurrency, args.concurrency),
+        ("AIMD only", (0, 0), 4, 1),
+        ("RPM/TPM limiter + AIMD", (args.rpm, args.tpm), 4, 1),
+    ]
+    print(f"{'client':<28}{'calls':>7}{'429s':>7}{'seconds':>9}{'quota used':>12}  result")
+    for name, client_quota, initial, minimum in configs:
+        api, elapsed, outcome = run(chunks, args, client_quota, initial, minimum)
+        print(f"{name:<28}{api.calls:>7}{api.rejected:>7}{elapsed:>9.1f}{ideal / elapsed:>11.0%}  {outcome}")
+
+
+if __name__ == "__main__":
+    main()
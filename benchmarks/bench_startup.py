@@ -0,0 +1,91 @@
+"""
+Measures the cost of starting a process that imports the API: wall time and
+peak RSS of ``django.setup()`` followed by ``import rag_app_apis.views``.
+
+Usage:
+    python benchmarks/bench_startup.py --runs 5
+    python benchmarks/bench_startup.py --importtime 15   # slowest modules (python -X importtime)
+
+Every run is a fresh interpreter, so nothing is cached between runs. The
+"django.setup() only" row is the floor that manage.py commands pay anyway.
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = """
+import resource, sys, time
+start = time.perf_counter()
+import django
+django.setup()
+setup_done = time.perf_counter()
+if {import_views}:
+    import rag_app_apis.views
+end = time.perf_counter()
+rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+heavy = sorted(m for m in ("langchain", "langchain_openai", "openai", "tiktoken", "docx", "PyPDF2") if m in sys.modules)
+print(f"{{end - start:.4f}} {{setup_done - start:.4f}} {{rss_kb}} {{','.join(heavy) or '-'}}")
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    env.setdefault("DJANGO_SETTINGS_MODULE", "RAG_SaaS.settings")
+    env.setdefault("OPENAI_API_KEY", "sk-benchmark")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, env.get("PYTHONPATH")]))
+    return env
+
+
+def probe(import_views):
+    """Runs one fresh interpreter and returns (seconds, setup seconds, peak RSS MB, heavy modules)."""
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE.format(import_views=import_views)],
+        cwd=ROOT, env=child_env(), capture_output=True, text=True, check=True,
+    ).stdout.strip().splitlines()[-1]
+    total, setup, rss_kb, heavy = output.split()
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    rss_mb = int(rss_kb) / (1024 * 1024 if sys.platform == "darwin" else 1024)
+    return float(total), float(setup), rss_mb, heavy
+
+
+def import_time(top):
+    """Prints the modules with the highest cumulative import time."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE.format(import_views=True)],
+        cwd=ROOT, env=child_env(), capture_output=True, text=True, check=True,
+    )
+    rows = []
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s+(.*)", line)
+        if match:
+            rows.append((int(match.group(1)), match.group(2)))
+    print(f"\nTop {top} imports by cumulative time:")
+    for cumulative, module in sorted(rows, reverse=True)[:top]:
+        print(f"  {cumulative / 1000:9.1f} ms  {module}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--importtime", type=int, default=0, metavar="N", help="also list the N slowest imports")
+    args = parser.parse_args()
+
+    print(f"{'mode':<32}{'median s':>10}{'min s':>10}{'peak RSS MB':>14}  heavy modules loaded")
+    for label, import_views in (("django.setup() only", False), ("django.setup() + views", True)):
+        runs = [probe(import_views) for _ in range(args.runs)]
+        times = [run[0] for run in runs]
+        rss = statistics.median(run[2] for run in runs)
+        print(f"{label:<32}{statistics.median(times):>10.3f}{min(times):>10.3f}{rss:>14.1f}  {runs[-1][3]}")
+
+    if args.importtime:
+        import_time(args.importtime)
+
+
+if __name__ == "__main__":
+    main()
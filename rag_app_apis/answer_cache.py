@@ -0,0 +1,178 @@
+"""Semantic cache of chat answers.
+
+A question is answered from the cache when an earlier question retrieved
+exactly the same chunks and its embedding is close enough (cosine similarity
+of at least ANSWER_CACHE_MIN_SIMILARITY). Answers are grouped by the retrieved
+(document ids and index versions, chunk ids), so a lookup only compares the
+question with the few earlier questions that were answered from the same
+context. Re-processing a document bumps its index_version, so its old answers
+never match in any process, even when a resumed ingestion keeps the chunk ids;
+the explicit invalidation only frees the memory sooner.
+"""
+
+from collections import namedtuple
+from django.conf import settings
+from .cache import LRUCache, normalize_query
+from .tracing import log_sampled
+import numpy as np
+import threading
+import time
+import logging
+
+AnswerEntry = namedtuple("AnswerEntry", ["question", "embedding", "answer", "expires_at"])
+
+# Resultado de una consulta al caché; se pasa luego a store() para guardar la respuesta nueva
+AnswerLookup = namedtuple("AnswerLookup", ["key", "question", "embedding", "answer", "similarity"])
+
+
+def context_key(chunks):
+    """((document id, index version) pairs, chunk ids) of the retrieved chunks, or None when nothing was retrieved."""
+    if not chunks:
+        return None
+    return (
+        tuple(sorted({(chunk['document_id'], chunk.get('index_version', 0)) for chunk in chunks})),
+        tuple(sorted(chunk['chunk_id'] for chunk in chunks)),
+    )
+
+
+class AnswerCache:
+    """LRU of answers bounded by bytes, with a TTL per answer and hit-rate counters."""
+
+    def __init__(self, max_bytes, ttl, min_similarity, max_per_context=8):
+        self.cache = LRUCache(max_bytes)
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self.max_per_context = max_per_context
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.near_misses = 0
+        self.stores = 0
+        self.invalidations = 0
+
+    def _entries(self, key):
+        now = time.monotonic()
+        return [entry for entry in self.cache.get(key) or () if entry.expires_at > now]
+
+    def lookup(self, chunks, question, embedding=None):
+        """Returns an AnswerLookup; its answer is None on a miss.
+
+        Without an embedding (the lexical fast path skips it) only the same
+        normalized question can match.
+        """
+        key = context_key(chunks)
+        question = normalize_query(question)
+        query = None
+        if embedding is not None:
+            query = np.asarray(embedding, dtype=np.float32)
+            query = query / (np.linalg.norm(query) or 1.0)
+        if key is None:
+            return AnswerLookup(None, question, query, None, None)
+
+        best, best_similarity = None, -1.0
+        for entry in self._entries(key):
+            if entry.question == question:
+                best, best_similarity = entry, 1.0
+                break
+            if query is not None and entry.embedding is not None:
+                similarity = float(entry.embedding @ query)
+                if similarity > best_similarity:
+                    best, best_similarity = entry, similarity
+
+        with self._lock:
+            self.lookups += 1
+            if best is not None and best_similarity >= self.min_similarity:
+                if best.question == question:
+                    self.exact_hits += 1
+                else:
+                    self.semantic_hits += 1
+            elif best is not None and best_similarity >= self.min_similarity - 0.05:
+                self.near_misses += 1  # Casi acierto: sirve para ajustar el umbral
+        if best is None or best_similarity < self.min_similarity:
+            return AnswerLookup(key, question, query, None, None)
+        log_sampled(logging.INFO, f"Respuesta servida desde el caché (similitud {best_similarity:.3f}) para '{question}'")
+        return AnswerLookup(key, question, query, best.answer, best_similarity)
+
+    def store(self, lookup, answer):
+        """Caches the answer generated after a missed lookup."""
+        if lookup.key is None or lookup.answer is not None or not answer:
+            return
+        entry = AnswerEntry(lookup.question, lookup.embedding, answer, time.monotonic() + self.ttl)
+        with self._lock:
+            entries = [e for e in self._entries(lookup.key) if e.question != lookup.question]
+            entries = (entries + [entry])[-self.max_per_context:]
+            size = sum(
+                len(e.answer.encode("utf-8")) + len(e.question.encode("utf-8"))
+                + (e.embedding.nbytes if e.embedding is not None else 0) + 64
+                for e in entries
+            )
+            self.cache.set(lookup.key, entries, size)
+            self.stores += 1
+
+    def remove_document(self, document_id):
+        """Drops the answers built from chunks of a document."""
+        with self._lock:
+            self.cache.discard(lambda key: any(document == document_id for document, _ in key[0]))
+            self.invalidations += 1
+
+    def clear(self):
+        self.cache.clear()
+
+    def stats(self):
+        stats = self.cache.stats()
+        with self._lock:
+            hits = self.exact_hits + self.semantic_hits
+            stats.update({
+                "lookups": self.lookups,
+                "answer_hits": hits,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "near_misses": self.near_misses,
+                "stores": self.stores,
+                "invalidations": self.invalidations,
+                "answer_hit_rate": hits / self.lookups if self.lookups else 0.0,
+                "min_similarity": self.min_similarity,
+            })
+        return stats
+
+
+class DisabledAnswerCache:
+    """Stand-in used when ANSWER_CACHE is off: every lookup misses and nothing is stored."""
+
+    def lookup(self, chunks, question, embedding=None):
+        return AnswerLookup(None, question, None, None, None)
+
+    def store(self, lookup, answer):
+        pass
+
+    def remove_document(self, document_id):
+        pass
+
+    def clear(self):
+        pass
+
+    def stats(self):
+        return {"enabled": False}
+
+
+_answer_cache = None
+_answer_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """Returns the process-wide answer cache."""
+    global _answer_cache
+    if _answer_cache is None:
+        with _answer_lock:
+            if _answer_cache is None:
+                if settings.ANSWER_CACHE:
+                    _answer_cache = AnswerCache(
+                        settings.ANSWER_CACHE_MAX_BYTES,
+                        settings.ANSWER_CACHE_TTL,
+                        settings.ANSWER_CACHE_MIN_SIMILARITY,
+                        settings.ANSWER_CACHE_MAX_PER_CONTEXT,
+                    )
+                else:
+                    _answer_cache = DisabledAnswerCache()
+    return _answer_cache
@@ -4,3 +4,11 @@ from django.apps import AppConfig
 class RagAppApisConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'rag_app_apis'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from django.conf import settings
+        if settings.MEMORY_PROFILING:
+            # tracemalloc ralentiza cada asignación: solo en modo de perfilado
+            import tracemalloc
+            tracemalloc.start()
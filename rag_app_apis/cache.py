@@ -0,0 +1,281 @@
+from collections import OrderedDict
+from .embedding_codec import decode_embedding, encode_embedding
+import numpy as np
+import threading
+import hashlib
+import struct
+import time
+import logging
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+class LRUCache:
+    """Thread-safe LRU cache bounded by the total size of its values, with optional TTL."""
+
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[2] is not None and item[2] < time.monotonic():
+                self.current_bytes -= self._data.pop(key)[1]
+                self.expirations += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, size):
+        with self._lock:
+            if key in self._data:
+                self.current_bytes -= self._data.pop(key)[1]
+            if size > self.max_bytes:
+                return False  # Nunca cabría; no vaciar el caché por un solo valor
+            expires_at = time.monotonic() + self.ttl if self.ttl else None
+            self._data[key] = (value, size, expires_at)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.current_bytes -= evicted[1]
+                self.evictions += 1
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self.current_bytes -= item[1]
+
+    def discard(self, predicate):
+        """Removes every entry whose key matches the predicate."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                self.current_bytes -= self._data.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+class RedisCache:
+    """Byte-valued cache in Redis with the same get/set/delete/stats interface as LRUCache."""
+
+    def __init__(self, url, prefix, ttl=None):
+        if redis is None:
+            raise RuntimeError("The redis package is required for Redis caches.")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    def _key(self, key):
+        return f"{self.prefix}:{key}"
+
+    def get(self, key):
+        try:
+            value = self.client.get(self._key(key))
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"Redis no disponible para el caché {self.prefix}: {e}")
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value, size=None):
+        try:
+            self.client.set(self._key(key), value, ex=self.ttl)
+            return True
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"No se pudo escribir en el caché {self.prefix}: {e}")
+            return False
+
+    def delete(self, key):
+        try:
+            self.client.delete(self._key(key))
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"No se pudo borrar del caché {self.prefix}: {e}")
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "errors": self.errors,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class RedisMatrixStore:
+    """Shares document matrices between processes through Redis.
+
+    Each document is one key holding a small header (version, rows, dim)
+    followed by the int64 chunk ids and the float32 matrix bytes.
+    """
+
+    _HEADER = struct.Struct('<QQQ')
+
+    def __init__(self, url, prefix='rag:docmatrix', ttl=24 * 3600):
+        if redis is None:
+            raise RuntimeError("The redis package is required for the shared document cache.")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.errors = 0
+
+    def _key(self, document_id):
+        return f"{self.prefix}:{document_id}"
+
+    def get(self, document_id, version):
+        try:
+            data = self.client.get(self._key(document_id))
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"Redis no disponible para el caché de documentos: {e}")
+            return None
+        if not data:
+            return None
+        stored_version, rows, dim = self._HEADER.unpack_from(data)
+        if stored_version != version:
+            return None
+        offset = self._HEADER.size
+        ids = np.frombuffer(data, dtype='<i8', count=rows, offset=offset)
+        matrix = np.frombuffer(data, dtype='<f4', count=rows * dim, offset=offset + rows * 8).reshape(rows, dim)
+        return ids, matrix
+
+    def set(self, document_id, version, ids, matrix):
+        rows = len(ids)
+        dim = matrix.shape[1] if rows else 0
+        payload = self._HEADER.pack(version, rows, dim) + ids.astype('<i8').tobytes() + matrix.astype('<f4').tobytes()
+        try:
+            self.client.set(self._key(document_id), payload, ex=self.ttl)
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"No se pudo guardar el documento {document_id} en Redis: {e}")
+
+    def delete(self, document_id):
+        try:
+            self.client.delete(self._key(document_id))
+        except Exception as e:
+            self.errors += 1
+            logging.warning(f"No se pudo invalidar el documento {document_id} en Redis: {e}")
+
+
+class DocumentMatrixCache:
+    """Per-document (chunk ids, normalized embedding matrix) cache.
+
+    A process-local LRU bounded by bytes sits in front of an optional shared
+    Redis store. Entries carry ``APIDocument.index_version`` so a re-processed
+    document is never served from an older entry.
+    """
+
+    def __init__(self, max_bytes, shared=None):
+        self.local = LRUCache(max_bytes)
+        self.shared = shared
+        self.shared_hits = 0
+
+    def get(self, document_id, version):
+        entry = self.local.get((document_id, version))
+        if entry is not None:
+            return entry
+        if self.shared is not None:
+            found = self.shared.get(document_id, version)
+            if found is not None:
+                self.shared_hits += 1
+                self._set_local(document_id, version, *found)
+                return found
+        return None
+
+    def put(self, document_id, version, ids, matrix):
+        self._set_local(document_id, version, ids, matrix)
+        if self.shared is not None:
+            self.shared.set(document_id, version, ids, matrix)
+
+    def _set_local(self, document_id, version, ids, matrix):
+        # Una sola versión por documento en memoria
+        self.local.discard(lambda key: key[0] == document_id and key[1] != version)
+        self.local.set((document_id, version), (ids, matrix), ids.nbytes + matrix.nbytes)
+
+    def invalidate(self, document_id):
+        self.local.discard(lambda key: key[0] == document_id)
+        if self.shared is not None:
+            self.shared.delete(document_id)
+
+    def stats(self):
+        stats = self.local.stats()
+        stats["shared_hits"] = self.shared_hits
+        stats["shared_errors"] = self.shared.errors if self.shared is not None else 0
+        return stats
+
+
+def normalize_query(text):
+    """Collapses whitespace and case so trivially different questions share a key."""
+    return " ".join(text.split()).casefold()
+
+
+class QueryEmbeddingCache:
+    """Query embeddings keyed by SHA-256 of (model, normalized text).
+
+    Vectors are stored as float32 bytes so the in-memory and Redis backends
+    hold the same payload.
+    """
+
+    def __init__(self, backend, model_name):
+        self.backend = backend
+        self.model_name = model_name
+
+    @property
+    def is_local(self):
+        """True when lookups never block on the network."""
+        return isinstance(self.backend, LRUCache)
+
+    def key(self, text):
+        return hashlib.sha256(f"{self.model_name}\n{normalize_query(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, text):
+        data = self.backend.get(self.key(text))
+        return decode_embedding(data) if data is not None else None
+
+    def set(self, text, vector):
+        data = encode_embedding(vector)
+        self.backend.set(self.key(text), data, len(data))
+
+    def stats(self):
+        return self.backend.stats()
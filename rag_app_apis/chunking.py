@@ -0,0 +1,208 @@
+"""Chunking strategies: how extracted text is cut into the chunks that get embedded.
+
+A chunker consumes the TextSegment stream of ``utils.iter_text_segments`` and
+yields (ChunkPiece, progress) pairs, holding only a window of text in memory.
+Segments that open a structural unit (a PDF page, a DOCX or Markdown heading)
+close the current chunk, so chunks do not straddle sections.
+"""
+
+from bisect import bisect_right
+from collections import namedtuple
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from .tokens import count_tokens
+import re
+import threading
+
+ChunkPiece = namedtuple("ChunkPiece", ["text", "page", "offset", "token_count"])
+
+# Cortes preferidos: párrafos, fin de línea y fin de oración
+_UNIT_BREAK = re.compile(r"\n\s*\n|\n|(?<=[.!?;:])\s+")
+
+
+class Chunker:
+    """Base class; subclasses implement split_section(text) -> [(start, end)] spans."""
+
+    def __init__(self, split_on=("page", "heading")):
+        self.split_on = frozenset(split_on)
+
+    def split_section(self, text):
+        raise NotImplementedError
+
+    def iter_chunks(self, segments, window_chars=None):
+        """Yields (ChunkPiece, progress); offsets are positions in the extracted document text."""
+        window_chars = window_chars or settings.EXTRACTION_WINDOW_CHARS
+        buffer = []
+        buffered = 0
+        base = 0  # Posición en el documento del inicio del buffer
+        position = 0
+        pages = ([], [])  # (posiciones, números) donde empieza cada página
+        progress = 0.0
+
+        for segment in segments:
+            if segment.boundary in self.split_on and buffered:
+                yield from self._pieces("".join(buffer), base, pages, progress, final=True)
+                buffer, buffered, base = [], 0, position
+            if segment.page is not None and (not pages[1] or pages[1][-1] != segment.page):
+                pages[0].append(position)
+                pages[1].append(segment.page)
+            buffer.append(segment.text)
+            buffered += len(segment.text)
+            position += len(segment.text)
+            progress = segment.progress
+
+            if buffered >= window_chars:
+                # Se emite todo menos el último chunk, que todavía puede crecer
+                text = "".join(buffer)
+                keep = yield from self._pieces(text, base, pages, progress, final=False)
+                buffer = [text[keep:]]
+                buffered = len(buffer[0])
+                base += keep
+
+        if buffered:
+            yield from self._pieces("".join(buffer), base, pages, progress, final=True)
+
+    def _pieces(self, text, base, pages, progress, final):
+        spans = self.split_section(text)
+        keep = len(text)
+        if not final and spans:
+            keep = spans[-1][0]
+            spans = spans[:-1]
+        for start, end in spans:
+            piece = text[start:end]
+            stripped = piece.strip()
+            if not stripped:
+                continue
+            offset = base + start + (len(piece) - len(piece.lstrip()))
+            index = bisect_right(pages[0], offset) - 1
+            page = pages[1][index] if index >= 0 else None
+            yield ChunkPiece(stripped, page, offset, count_tokens(stripped)), progress
+        return keep
+
+
+class TokenChunker(Chunker):
+    """Packs paragraphs and sentences into chunks of at most max_tokens tokens.
+
+    Consecutive chunks share up to overlap_tokens tokens of whole sentences;
+    a single sentence longer than max_tokens is cut into token-sized pieces.
+    """
+
+    def __init__(self, max_tokens=400, overlap_tokens=40, split_on=("page", "heading")):
+        super().__init__(split_on)
+        if overlap_tokens >= max_tokens:
+            raise ImproperlyConfigured("overlap_tokens must be smaller than max_tokens.")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def _units(self, text):
+        """Returns (start, end, tokens) for every sentence-sized unit of text."""
+        units = []
+        start = 0
+        for match in _UNIT_BREAK.finditer(text):
+            if match.end() > start:
+                units.extend(self._measure(text, start, match.end()))
+                start = match.end()
+        if start < len(text):
+            units.extend(self._measure(text, start, len(text)))
+        return units
+
+    def _measure(self, text, start, end):
+        tokens = count_tokens(text[start:end])
+        if tokens <= self.max_tokens:
+            return [(start, end, tokens)]
+        # Oración demasiado larga: cortes por caracteres con el tamaño estimado de max_tokens
+        step = max(1, int((end - start) * self.max_tokens * 0.9 / tokens))
+        return [
+            (i, min(i + step, end), count_tokens(text[i:min(i + step, end)]))
+            for i in range(start, end, step)
+        ]
+
+    def split_section(self, text):
+        units = self._units(text)
+        spans = []
+        i = 0
+        while i < len(units):
+            j, tokens = i, 0
+            while j < len(units) and (j == i or tokens + units[j][2] <= self.max_tokens):
+                tokens += units[j][2]
+                j += 1
+            spans.append((units[i][0], units[j - 1][1]))
+            if j >= len(units):
+                break
+            # El siguiente chunk repite las últimas oraciones que caben en overlap_tokens
+            k, overlap = j, 0
+            while k - 1 > i and overlap + units[k - 1][2] <= self.overlap_tokens:
+                k -= 1
+                overlap += units[k][2]
+            i = k
+        return spans
+
+
+class CharacterChunker(Chunker):
+    """The original RecursiveCharacterTextSplitter chunking, sized in characters."""
+
+    def __init__(self, chunk_size=10000, chunk_overlap=2000, split_on=()):
+        super().__init__(split_on)
+        from langchain.text_splitter import RecursiveCharacterTextSplitter
+        self.splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    def split_section(self, text):
+        spans = []
+        cursor = 0
+        for chunk in self.splitter.split_text(text):
+            start = text.find(chunk, cursor)
+            if start < 0:
+                continue
+            spans.append((start, start + len(chunk)))
+            cursor = start + 1
+        return spans
+
+
+CHUNKERS = {
+    'tokens': TokenChunker,
+    'characters': CharacterChunker,
+}
+
+# Estrategias con nombre; settings.CHUNKING_STRATEGIES agrega o reemplaza entradas
+BUILTIN_STRATEGIES = {
+    'default': {'class': 'tokens', 'max_tokens': 400, 'overlap_tokens': 40},
+    'fine': {'class': 'tokens', 'max_tokens': 200, 'overlap_tokens': 20},
+    'coarse': {'class': 'tokens', 'max_tokens': 800, 'overlap_tokens': 80},
+    'legacy': {'class': 'characters', 'chunk_size': 10000, 'chunk_overlap': 2000},
+}
+
+_chunkers = {}
+_chunkers_lock = threading.Lock()
+
+
+def get_strategies():
+    """Returns every strategy name with its options."""
+    return {**BUILTIN_STRATEGIES, **getattr(settings, 'CHUNKING_STRATEGIES', {})}
+
+
+def get_chunker(name=None):
+    """Returns the (cached) chunker of a named strategy."""
+    name = name or settings.CHUNKING_DEFAULT_STRATEGY
+    chunker = _chunkers.get(name)
+    if chunker is None:
+        with _chunkers_lock:
+            chunker = _chunkers.get(name)
+            if chunker is None:
+                options = dict(get_strategies().get(name) or {})
+                if not options:
+                    raise ImproperlyConfigured(f"Unknown chunking strategy: {name}")
+                kind = options.pop('class', 'tokens')
+                chunker_class = CHUNKERS.get(kind) or import_string(kind)
+                chunker = _chunkers[name] = chunker_class(**options)
+    return chunker
+
+
+def resolve_chunking_strategy(user_id=None, requested=None):
+    """Picks the strategy of a document: the requested one, else the tenant's, else the default."""
+    if requested:
+        if requested not in get_strategies():
+            raise ValueError(f"Unknown chunking strategy '{requested}'. Available: {', '.join(sorted(get_strategies()))}")
+        return requested
+    tenants = getattr(settings, 'CHUNKING_TENANT_STRATEGIES', {})
+    return tenants.get(str(user_id)) or settings.CHUNKING_DEFAULT_STRATEGY
@@ -0,0 +1,116 @@
+from collections import namedtuple
+from django.conf import settings
+from .tokens import count_tokens
+from .lexical_index import STOPWORDS
+from .tracing import log_sampled
+import re
+import logging
+
+PromptContext = namedtuple(
+    "PromptContext", ["prompt", "chunk_ids", "context_tokens", "prompt_tokens", "trimmed", "dropped"]
+)
+
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?;:])\s+|\n+")
+_WORD = re.compile(r"\w+")
+
+def split_sentences(text):
+    """Splits a chunk into stripped, non-empty sentences."""
+    return [sentence.strip() for sentence in _SENTENCE_BREAK.split(text) if sentence.strip()]
+
+
+def sentence_key(sentence):
+    """Normalized form used to spot the same sentence in overlapping chunks."""
+    return " ".join(sentence.split()).casefold()
+
+
+def query_terms(text):
+    return {word for word in _WORD.findall(text.casefold()) if word not in STOPWORDS}
+
+
+class ContextBuilder:
+    """Packs retrieved chunks into the LLM prompt under a token budget.
+
+    Chunks are taken best score first. Sentences already seen in a better
+    chunk (the overlap between consecutive chunks) are skipped, and a chunk that
+    does not fit in what is left of the budget is cut down to the sentences that
+    share most words with the query, kept in document order.
+    """
+
+    def __init__(self, max_tokens=None):
+        self.max_tokens = max_tokens or settings.CONTEXT_MAX_TOKENS
+
+    @staticmethod
+    def format_header(chunk):
+        page = f" (page {chunk['page']})" if chunk.get('page') else ""
+        return f"Document: {chunk['document']}\nChunk {chunk['chunk_id']}{page}:\n"
+
+    @staticmethod
+    def format_prompt(context_text, query):
+        return f"Context:\n{context_text or 'No context available.'}\n\nUser Query: {query}"
+
+    def build(self, query, chunks):
+        """Returns a PromptContext for the query and the retrieved chunks."""
+        terms = query_terms(query)
+        seen = set()
+        entries, chunk_ids = [], []
+        used = trimmed = dropped = 0
+
+        for chunk in sorted(chunks, key=lambda c: c.get('score', 0.0), reverse=True):
+            sentences, keys = [], set()
+            for sentence in split_sentences(chunk['content']):
+                key = sentence_key(sentence)
+                if key not in seen and key not in keys:
+                    keys.add(key)
+                    sentences.append(sentence)
+            header = self.format_header(chunk)
+            remaining = self.max_tokens - used - count_tokens(header)
+            if not sentences or remaining <= 0:
+                dropped += 1
+                continue
+
+            costs = [count_tokens(sentence) + 1 for sentence in sentences]
+            keep = range(len(sentences))
+            if sum(costs) > remaining:
+                # Oraciones con más palabras de la pregunta primero; a igualdad, las primeras
+                overlap = [len(terms & query_terms(sentence)) for sentence in sentences]
+                ranked = sorted(keep, key=lambda i: (-overlap[i], i))
+                keep, budget = [], remaining
+                for i in ranked:
+                    if overlap[i] == 0 and terms:
+                        break  # El resto no comparte ninguna palabra con la pregunta
+                    if costs[i] <= budget:
+                        keep.append(i)
+                        budget -= costs[i]
+                keep.sort()
+                if not keep:
+                    dropped += 1
+                    continue
+                trimmed += 1
+
+            text = " ".join(sentences[i] for i in keep)
+            seen.update(sentence_key(sentences[i]) for i in keep)
+            entries.append(header + text)
+            chunk_ids.append(chunk['chunk_id'])
+            used += count_tokens(header) + sum(costs[i] for i in keep)
+
+        context_text = "\n\n".join(entries)
+        prompt = self.format_prompt(context_text, query)
+        context = PromptContext(
+            prompt=prompt,
+            chunk_ids=chunk_ids,
+            context_tokens=count_tokens(context_text) if context_text else 0,
+            prompt_tokens=count_tokens(prompt),
+            trimmed=trimmed,
+            dropped=dropped,
+        )
+        log_sampled(
+            logging.INFO,
+            f"Contexto: {len(chunk_ids)}/{len(chunks)} chunks, {context.context_tokens}/{self.max_tokens} tokens "
+            f"(recortados {trimmed}, descartados {dropped}), prompt {context.prompt_tokens} tokens"
+        )
+        return context
+
+
+def build_context(query, chunks, max_tokens=None):
+    """Builds the prompt for a chat message with the configured token budget."""
+    return ContextBuilder(max_tokens).build(query, chunks)
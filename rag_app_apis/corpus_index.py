@@ -0,0 +1,228 @@
+"""Vector index over every processed document of a user.
+
+All chunks of the user's completed documents are kept in one normalized
+float32 matrix. Large corpora are partitioned with a k-means coarse quantizer
+(IVF): rows are sorted by cluster and a search only scores the clusters
+closest to the query, so latency grows with sqrt(rows) instead of rows.
+
+Document filters are applied inside the search: only rows of allowed
+documents are scored, and a filter that leaves few rows is searched exactly
+from a per-document row map instead of through the clusters.
+"""
+
+from collections import namedtuple
+from django.conf import settings
+from .models import APIChunk, APIDocument
+from .providers import get_embedding_model_name
+from .embedding_codec import decode_matrix
+from .vector_index import normalize_rows
+from .cache import LRUCache
+import numpy as np
+import hashlib
+import threading
+import logging
+
+CorpusEntry = namedtuple("CorpusEntry", ["ids", "doc_ids", "matrix", "centroids", "list_offsets", "doc_rows"])
+
+
+def kmeans(matrix, clusters, iterations=10, sample_per_cluster=64, seed=0):
+    """Spherical k-means on a sample of the rows; returns normalized centroids."""
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(matrix), clusters * sample_per_cluster)
+    sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]
+    centroids = sample[rng.choice(len(sample), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(sample @ centroids.T, axis=1)
+        order = np.argsort(assign, kind='stable')
+        present, starts = np.unique(assign[order], return_index=True)
+        centroids[present] = np.add.reduceat(sample[order], starts, axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids
+
+
+def assign_clusters(matrix, centroids, block_rows=65536):
+    """Nearest centroid of every row, computed in blocks to bound memory."""
+    return np.concatenate([
+        np.argmax(matrix[start:start + block_rows] @ centroids.T, axis=1)
+        for start in range(0, len(matrix), block_rows)
+    ]) if len(matrix) else np.empty(0, dtype=np.int64)
+
+
+def build_corpus_entry(ids, doc_ids, matrix, min_rows_for_ivf=None):
+    """Builds the searchable entry; corpora below min_rows_for_ivf are searched exactly."""
+    min_rows_for_ivf = min_rows_for_ivf or settings.CORPUS_IVF_MIN_ROWS
+    centroids = list_offsets = None
+    if len(ids) >= min_rows_for_ivf:
+        clusters = max(1, int(np.sqrt(len(ids))))
+        centroids = kmeans(matrix, clusters)
+        assign = assign_clusters(matrix, centroids)
+        order = np.argsort(assign, kind='stable')
+        ids, doc_ids, matrix = ids[order], doc_ids[order], np.ascontiguousarray(matrix[order])
+        list_offsets = np.searchsorted(assign[order], np.arange(clusters + 1))
+
+    # Filas de cada documento, para búsquedas exactas cuando el filtro deja pocos documentos
+    order = np.argsort(doc_ids, kind='stable')
+    unique, starts = np.unique(doc_ids[order], return_index=True)
+    doc_rows = dict(zip(unique.tolist(), np.split(order, starts[1:]))) if len(unique) else {}
+    return CorpusEntry(ids, doc_ids, matrix, centroids, list_offsets, doc_rows)
+
+
+def search_corpus_entry(entry, query, top_k=3, document_ids=None, nprobe=None, exact_max_rows=None):
+    """Returns up to top_k (chunk_id, document_id, score), only from document_ids when given."""
+    nprobe = nprobe or settings.CORPUS_IVF_NPROBE
+    exact_max_rows = exact_max_rows if exact_max_rows is not None else settings.CORPUS_EXACT_MAX_ROWS
+    if not len(entry.ids):
+        return []
+
+    rows = None
+    if document_ids is not None:
+        allowed = [entry.doc_rows[doc_id] for doc_id in set(document_ids) if doc_id in entry.doc_rows]
+        if not allowed:
+            return []
+        if entry.centroids is None or sum(len(r) for r in allowed) <= exact_max_rows:
+            rows = np.concatenate(allowed)
+
+    if rows is not None:
+        scores = entry.matrix[rows] @ query
+    elif entry.centroids is None:
+        rows = np.arange(len(entry.ids))
+        scores = entry.matrix @ query
+    else:
+        # IVF: solo se puntúan las listas de los centroides más cercanos
+        probe = np.argsort(-(entry.centroids @ query))[:nprobe]
+        rows = np.concatenate([np.arange(entry.list_offsets[c], entry.list_offsets[c + 1]) for c in probe])
+        if document_ids is not None:
+            rows = rows[np.isin(entry.doc_ids[rows], np.fromiter(document_ids, dtype=np.int64))]
+            if len(rows) < top_k:
+                rows = np.concatenate(allowed)  # Las listas visitadas casi no tienen filas permitidas
+        scores = entry.matrix[rows] @ query
+
+    if not len(rows):
+        return []
+    k = min(top_k, len(rows))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return [(int(entry.ids[rows[i]]), int(entry.doc_ids[rows[i]]), float(scores[i])) for i in top]
+
+
+def entry_nbytes(entry):
+    size = entry.ids.nbytes + entry.doc_ids.nbytes + entry.matrix.nbytes + 8 * len(entry.ids)
+    if entry.centroids is not None:
+        size += entry.centroids.nbytes + entry.list_offsets.nbytes
+    return size
+
+
+class CorpusIndex:
+    """Per-user corpus entries in a byte-bounded LRU.
+
+    An entry is tagged with a signature of the user's completed documents and
+    their index_version, so uploads, re-processing and deletions rebuild it.
+    The signature is cached for CORPUS_SIGNATURE_TTL seconds and dropped when
+    this process completes or deletes one of the user's documents, so most
+    queries do not scan the documents table.
+
+    An entry larger than the whole cache is kept as the only resident entry
+    (with a warning to raise CORPUS_CACHE_MAX_BYTES) instead of being rebuilt
+    on every query.
+    """
+
+    def __init__(self, max_bytes=None, signature_ttl=None):
+        self.cache = LRUCache(max_bytes or settings.CORPUS_CACHE_MAX_BYTES)
+        signature_ttl = signature_ttl if signature_ttl is not None else settings.CORPUS_SIGNATURE_TTL
+        self.signatures = LRUCache(1024 * 1024, ttl=signature_ttl) if signature_ttl else None
+        self._oversized = None  # (key, entry) de la entrada que no cabe en el LRU
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def compute_signature(user_id):
+        documents = APIDocument.objects.filter(user_id=user_id, status=APIDocument.STATUS_COMPLETED)
+        versions = documents.order_by('id').values_list('id', 'index_version')
+        return hashlib.sha1(repr((get_embedding_model_name(), list(versions))).encode()).hexdigest()
+
+    def signature(self, user_id):
+        if self.signatures is None:
+            return self.compute_signature(user_id)
+        signature = self.signatures.get(user_id)
+        if signature is None:
+            signature = self.compute_signature(user_id)
+            self.signatures.set(user_id, signature, len(signature) + 64)
+        return signature
+
+    def _cached(self, key):
+        oversized = self._oversized
+        if oversized is not None and oversized[0] == key:
+            return oversized[1]
+        return self.cache.get(key)
+
+    def _store(self, key, entry):
+        size = entry_nbytes(entry)
+        self.cache.discard(lambda cached: cached[0] == key[0])
+        if size > self.cache.max_bytes:
+            # Nunca cabría en el LRU: se queda como única entrada residente en lugar de reconstruirse en cada consulta
+            logging.warning(
+                f"Índice de corpus del usuario {key[0]} ocupa {size / 2**20:.0f} MB, más que CORPUS_CACHE_MAX_BYTES "
+                f"({self.cache.max_bytes / 2**20:.0f} MB): se mantiene como única entrada; conviene subir el límite"
+            )
+            self.cache.clear()
+            self._oversized = (key, entry)
+        else:
+            self._oversized = None
+            self.cache.set(key, entry, size)
+
+    def build(self, user_id, signature):
+        rows = list(
+            APIChunk.objects.filter(
+                document__user_id=user_id, document__status=APIDocument.STATUS_COMPLETED, embedding_model=get_embedding_model_name(),
+            )
+            .order_by('document_id', 'ordinal').values_list('id', 'document_id', 'embedding', 'embedding_format')
+        )
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        doc_ids = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+        matrix = normalize_rows(decode_matrix([row[2] for row in rows], [row[3] for row in rows])) if rows else np.empty((0, 0), dtype=np.float32)
+        entry = build_corpus_entry(ids, doc_ids, matrix)
+        self._store((user_id, signature), entry)
+        logging.info(f"Índice de corpus construido para usuario {user_id}: {len(ids)} chunks")
+        return entry
+
+    def get(self, user_id):
+        signature = self.signature(user_id)
+        entry = self._cached((user_id, signature))
+        if entry is None:
+            # Un solo build por usuario aunque lleguen varias consultas a la vez
+            with self._lock:
+                lock = self._locks.setdefault(user_id, threading.Lock())
+            with lock:
+                entry = self._cached((user_id, signature)) or self.build(user_id, signature)
+        return entry
+
+    def search(self, user_id, query_embedding, top_k=3, document_ids=None):
+        """Returns up to top_k (chunk_id, document_id, score) over the user's documents."""
+        query = normalize_rows(query_embedding)[0]
+        return search_corpus_entry(self.get(user_id), query, top_k, document_ids)
+
+    def remove(self, user_id):
+        """Drops the user's entry and signature (a document of the user was completed or deleted)."""
+        self.cache.discard(lambda key: key[0] == user_id)
+        if self.signatures is not None:
+            self.signatures.delete(user_id)
+        oversized = self._oversized
+        if oversized is not None and oversized[0][0] == user_id:
+            self._oversized = None
+
+    def stats(self):
+        return self.cache.stats()
+
+
+_corpus_index = None
+_corpus_lock = threading.Lock()
+
+
+def get_corpus_index():
+    """Returns the process-wide corpus index."""
+    global _corpus_index
+    if _corpus_index is None:
+        with _corpus_lock:
+            if _corpus_index is None:
+                _corpus_index = CorpusIndex()
+    return _corpus_index
@@ -0,0 +1,52 @@
+import numpy as np
+
+# Formatos binarios para APIChunk.embedding
+FORMAT_FLOAT32 = 'f32'
+FORMAT_FLOAT16 = 'f16'
+FORMAT_INT8 = 'i8'  # Cuantizado: 4 bytes de escala float32 seguidos de un int8 por dimensión
+
+FORMAT_CHOICES = [
+    (FORMAT_FLOAT32, 'float32'),
+    (FORMAT_FLOAT16, 'float16'),
+    (FORMAT_INT8, 'int8 quantized'),
+]
+
+_SCALE_BYTES = 4
+
+
+def encode_embedding(vector, fmt=FORMAT_FLOAT32):
+    """Packs an embedding into little-endian bytes in the given format."""
+    vector = np.asarray(vector, dtype=np.float32)
+    if fmt == FORMAT_FLOAT32:
+        return vector.astype('<f4').tobytes()
+    if fmt == FORMAT_FLOAT16:
+        return vector.astype('<f2').tobytes()
+    if fmt == FORMAT_INT8:
+        peak = float(np.abs(vector).max()) if vector.size else 0.0
+        scale = peak / 127.0 if peak else 1.0
+        quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+        return np.float32(scale).astype('<f4').tobytes() + quantized.tobytes()
+    raise ValueError(f"Unknown embedding format: {fmt}")
+
+
+def decode_embedding(data, fmt=FORMAT_FLOAT32):
+    """Unpacks bytes into a float32 vector; float32 data is a zero-copy view."""
+    if fmt == FORMAT_FLOAT32:
+        return np.frombuffer(data, dtype='<f4')
+    if fmt == FORMAT_FLOAT16:
+        return np.frombuffer(data, dtype='<f2').astype(np.float32)
+    if fmt == FORMAT_INT8:
+        scale = np.frombuffer(data, dtype='<f4', count=1)[0]
+        return np.frombuffer(data, dtype=np.int8, offset=_SCALE_BYTES).astype(np.float32) * scale
+    raise ValueError(f"Unknown embedding format: {fmt}")
+
+
+def decode_matrix(blobs, formats):
+    """Stacks stored embeddings into one (n, dim) float32 matrix."""
+    if not blobs:
+        return np.empty((0, 0), dtype=np.float32)
+    if all(fmt == FORMAT_FLOAT32 for fmt in formats):
+        # Camino rápido: una sola copia de todos los bytes y una vista reshape
+        data = b"".join(bytes(blob) for blob in blobs)
+        return np.frombuffer(data, dtype='<f4').reshape(len(blobs), -1)
+    return np.vstack([decode_embedding(blob, fmt) for blob, fmt in zip(blobs, formats)])
@@ -0,0 +1,223 @@
+"""BM25 inverted index over the chunks of a document.
+
+The index is built while the chunks are ingested and stored as one compressed
+blob per document (APILexicalIndex). Postings reference chunks by
+APIChunk.ordinal, their position in the document, so the blob does not depend
+on the ids assigned by the database and can be copied as-is to a deduplicated
+document.
+"""
+
+from collections import Counter
+from django.conf import settings
+from .models import APIChunk, APILexicalIndex
+from .cache import LRUCache
+import numpy as np
+import re
+import struct
+import threading
+import zlib
+import logging
+
+# Términos: palabras y códigos como "12.3", "ACC-0042" o "art/5"
+_TERM = re.compile(r"\w+(?:[-./]\w+)*")
+
+# Palabras que no ayudan a decidir qué chunk responde la pregunta
+STOPWORDS = frozenset("""
+a an and are as at be by do does for from how in is it of on or that the this to was what when where which who why with
+al con como cual cuando de del donde el en es la las lo los para por que qué se su un una y
+""".split())
+
+_MAGIC = b"BM25"
+_HEADER = struct.Struct('<4sIII')  # magic, chunks, terms, postings
+
+
+def tokenize(text):
+    """Lowercased terms of a text; compound codes also yield their parts."""
+    terms = []
+    for term in _TERM.findall(text.casefold()):
+        if term in STOPWORDS:
+            continue
+        terms.append(term)
+        if not term.isalnum():
+            terms.extend(part for part in re.split(r"[-./]", term) if part and part not in STOPWORDS)
+    return terms
+
+
+def is_identifier(term):
+    """True for code-like terms (IDs, clause numbers, versions): they contain digits or separators."""
+    return not term.isalpha()
+
+
+class LexicalIndexBuilder:
+    """Accumulates postings chunk by chunk during ingestion."""
+
+    def __init__(self):
+        self.lengths = []
+        self.postings = {}
+
+    def add(self, text):
+        ordinal = len(self.lengths)
+        terms = tokenize(text)
+        self.lengths.append(len(terms))
+        for term, tf in Counter(terms).items():
+            self.postings.setdefault(term, []).append((ordinal, tf))
+
+    def to_bytes(self):
+        """Serializes the index: header, chunk lengths, vocabulary, offsets, ordinals, tfs (zlib)."""
+        vocabulary = sorted(self.postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype='<u4')
+        ordinals, tfs = [], []
+        for i, term in enumerate(vocabulary):
+            entries = self.postings[term]
+            ordinals.extend(ordinal for ordinal, _ in entries)
+            tfs.extend(min(tf, 65535) for _, tf in entries)
+            offsets[i + 1] = offsets[i] + len(entries)
+        terms_blob = "\n".join(vocabulary).encode("utf-8")
+        payload = b"".join([
+            _HEADER.pack(_MAGIC, len(self.lengths), len(vocabulary), len(ordinals)),
+            np.asarray(self.lengths, dtype='<u4').tobytes(),
+            struct.pack('<I', len(terms_blob)), terms_blob,
+            offsets.tobytes(),
+            np.asarray(ordinals, dtype='<u4').tobytes(),
+            np.asarray(tfs, dtype='<u2').tobytes(),
+        ])
+        return zlib.compress(payload, 6)
+
+
+class LexicalIndex:
+    """Read-only BM25 index of one document, loaded from its stored blob."""
+
+    def __init__(self, chunk_ids, data, k1=1.2, b=0.75):
+        payload = zlib.decompress(data)
+        magic, chunks, terms, total = _HEADER.unpack_from(payload)
+        if magic != _MAGIC:
+            raise ValueError("Not a lexical index blob")
+        offset = _HEADER.size
+        self.lengths = np.frombuffer(payload, dtype='<u4', count=chunks, offset=offset).astype(np.float32)
+        offset += 4 * chunks
+        (terms_size,) = struct.unpack_from('<I', payload, offset)
+        offset += 4
+        vocabulary = payload[offset:offset + terms_size].decode("utf-8").split("\n") if terms else []
+        offset += terms_size
+        self.offsets = np.frombuffer(payload, dtype='<u4', count=terms + 1, offset=offset)
+        offset += 4 * (terms + 1)
+        self.ordinals = np.frombuffer(payload, dtype='<u4', count=total, offset=offset)
+        offset += 4 * total
+        self.tfs = np.frombuffer(payload, dtype='<u2', count=total, offset=offset).astype(np.float32)
+
+        self.vocabulary = {term: i for i, term in enumerate(vocabulary)}
+        self.chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        if len(self.chunk_ids) != chunks:
+            raise ValueError(f"Lexical index has {chunks} chunks, the document has {len(self.chunk_ids)}")
+        self.k1 = k1
+        self.b = b
+        self.avgdl = float(self.lengths.mean()) if chunks else 0.0
+        self.nbytes = len(payload) + self.chunk_ids.nbytes + self.lengths.nbytes + self.tfs.nbytes
+
+    def search(self, query, top_k=3):
+        """Returns up to top_k (chunk_id, score, coverage) by BM25; coverage is the share of query terms matched."""
+        terms = set(tokenize(query))
+        if not terms or not len(self.chunk_ids):
+            return []
+        n = len(self.chunk_ids)
+        scores = np.zeros(n, dtype=np.float32)
+        matched = np.zeros(n, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.lengths / max(self.avgdl, 1.0))
+        for term in terms:
+            i = self.vocabulary.get(term)
+            if i is None:
+                continue
+            start, end = self.offsets[i], self.offsets[i + 1]
+            ordinals, tfs = self.ordinals[start:end], self.tfs[start:end]
+            idf = np.log(1 + (n - len(ordinals) + 0.5) / (len(ordinals) + 0.5))
+            scores[ordinals] += idf * tfs * (self.k1 + 1) / (tfs + norm[ordinals])
+            matched[ordinals] += 1
+        hits = np.flatnonzero(scores)
+        if not len(hits):
+            return []
+        k = min(top_k, len(hits))
+        top = hits[np.argpartition(-scores[hits], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(int(self.chunk_ids[i]), float(scores[i]), float(matched[i]) / len(terms)) for i in top]
+
+
+def build_document_lexical_index(document_id):
+    """Builds the blob of a document from its stored chunks (documents ingested before the index existed)."""
+    builder = LexicalIndexBuilder()
+    for content in APIChunk.objects.filter(document_id=document_id).order_by('ordinal').values_list('content', flat=True).iterator(chunk_size=500):
+        builder.add(content)
+    return builder
+
+
+def save_lexical_index(document_id, builder):
+    """Stores the index of a document, replacing the previous one."""
+    APILexicalIndex.objects.update_or_create(
+        document_id=document_id,
+        defaults={
+            'data': builder.to_bytes(),
+            'chunk_count': len(builder.lengths),
+            'term_count': len(builder.postings),
+        },
+    )
+
+
+class LexicalIndexCache:
+    """Process-local LRU of loaded indexes keyed by (document id, index_version)."""
+
+    def __init__(self, max_bytes):
+        self.cache = LRUCache(max_bytes)
+        self._lock = threading.Lock()
+
+    def get(self, document_id, version=0):
+        """Returns the LexicalIndex of a document, loading (or back-filling) it on a miss."""
+        index = self.cache.get((document_id, version))
+        if index is not None:
+            return index
+        chunk_ids = list(APIChunk.objects.filter(document_id=document_id).order_by('ordinal').values_list('id', flat=True))
+        data = APILexicalIndex.objects.filter(document_id=document_id).values_list('data', flat=True).first()
+        index = None
+        if data is not None:
+            try:
+                index = LexicalIndex(chunk_ids, bytes(data))
+            except ValueError as e:
+                logging.warning(f"Índice léxico del documento {document_id} inválido, se reconstruye: {e}")
+        if index is None:
+            builder = build_document_lexical_index(document_id)
+            save_lexical_index(document_id, builder)
+            index = LexicalIndex(chunk_ids, builder.to_bytes())
+        with self._lock:
+            self.cache.discard(lambda key: key[0] == document_id and key[1] != version)
+            self.cache.set((document_id, version), index, index.nbytes)
+        return index
+
+    def search(self, document_id, query, top_k=3, version=0):
+        return self.get(document_id, version).search(query, top_k)
+
+    def remove(self, document_id):
+        self.cache.discard(lambda key: key[0] == document_id)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+_lexical_cache = None
+_lexical_lock = threading.Lock()
+
+
+def get_lexical_index():
+    """Returns the process-wide cache of lexical indexes."""
+    global _lexical_cache
+    if _lexical_cache is None:
+        with _lexical_lock:
+            if _lexical_cache is None:
+                _lexical_cache = LexicalIndexCache(settings.LEXICAL_CACHE_MAX_BYTES)
+    return _lexical_cache
+
+
+def reciprocal_rank_fusion(rankings, k=60, top_k=3):
+    """Fuses several [(chunk_id, score, ...)] rankings into [(chunk_id, rrf score)]."""
+    fused = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking):
+            fused[hit[0]] = fused.get(hit[0], 0.0) + 1.0 / (k + rank + 1)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)[:top_k]
@@ -0,0 +1,35 @@
+"""Local sentence-transformers encoding that runs in process-pool workers.
+
+This module must not import Django or the app models: with the ``spawn``
+start method every worker imports it from scratch. Each worker loads the
+model once (init_worker) and then encodes the batches it is sent.
+"""
+
+_model = None
+
+
+def load_model(model_name, threads=None):
+    """Loads the sentence-transformers model of this process."""
+    global _model
+    if threads:
+        import torch
+        # Varios procesos en la misma máquina: cada uno con su parte de los núcleos
+        torch.set_num_threads(threads)
+    from sentence_transformers import SentenceTransformer
+    _model = SentenceTransformer(model_name, device="cpu")
+    return _model
+
+
+def init_worker(model_name, threads):
+    load_model(model_name, threads)
+
+
+def encode_batch(texts, batch_size=32):
+    """Returns the unit-length float32 embeddings of texts as a list of lists."""
+    vectors = _model.encode(texts, batch_size=batch_size, normalize_embeddings=True, convert_to_numpy=True)
+    return vectors.astype("float32").tolist()
+
+
+def model_dimension():
+    """Returns the embedding dimension of the model loaded in this process."""
+    return _model.get_sentence_embedding_dimension()
@@ -0,0 +1,100 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from rag_app_apis.models import APIChunk, APIDocument
+from rag_app_apis.providers import get_embedding_model_name
+from rag_app_apis.tasks import enqueue_document, process_document_task
+import time
+
+
+class Command(BaseCommand):
+    help = (
+        "Resumes interrupted ingestions: failed documents and pending or processing ones without a "
+        "checkpoint for --stale-minutes. Committed chunk batches are kept unless --reindex is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--documents", nargs="+", type=int, help="only these document ids (any status)")
+        parser.add_argument("--user", type=int, help="only the documents of this user id")
+        parser.add_argument(
+            "--status", nargs="+", choices=[choice for choice, _ in APIDocument.STATUS_CHOICES],
+            help="select every document in these states instead of the stuck ones (e.g. completed --reindex)",
+        )
+        parser.add_argument(
+            "--outdated-embeddings", action="store_true",
+            help="select the documents with chunks embedded by a model other than the configured one",
+        )
+        parser.add_argument(
+            "--stale-minutes", type=float, default=settings.INGEST_STALE_MINUTES,
+            help="pending/processing documents count as stuck after this long without a checkpoint",
+        )
+        parser.add_argument("--reindex", action="store_true", help="discard the saved chunks and process from scratch")
+        parser.add_argument("--concurrency", type=int, default=settings.INGEST_RESUME_CONCURRENCY)
+        parser.add_argument("--enqueue", action="store_true", help="send the documents to the Celery queue instead")
+        parser.add_argument("--dry-run", action="store_true", help="only list the selected documents")
+
+    def handle(self, *args, **options):
+        if options["concurrency"] < 1:
+            raise CommandError("--concurrency must be at least 1")
+
+        documents = list(self.select(options).order_by("id").only("id", "title", "status", "checkpoint_at"))
+        self.stdout.write(f"{len(documents)} documents selected")
+        for document in documents:
+            chunks = APIChunk.objects.filter(document=document).count()
+            self.stdout.write(f"  {document.id} '{document.title}': {document.status}, {chunks} chunks saved")
+        if options["dry_run"] or not documents:
+            return
+
+        if options["enqueue"]:
+            for document in documents:
+                APIDocument.objects.filter(id=document.id).update(status=APIDocument.STATUS_PENDING)
+                enqueue_document(document, reindex=options["reindex"])
+            self.stdout.write(self.style.SUCCESS(f"{len(documents)} documents enqueued"))
+            return
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            futures = {executor.submit(self.run, document.id, options["reindex"]): document for document in documents}
+            for future in as_completed(futures):
+                document = futures[future]
+                status, seconds = future.result()
+                results[status] = results.get(status, 0) + 1
+                style = self.style.SUCCESS if status == APIDocument.STATUS_COMPLETED else self.style.ERROR
+                self.stdout.write(style(f"  {document.id} '{document.title}': {status} in {seconds:.1f}s"))
+
+        summary = ", ".join(f"{count} {status}" for status, count in sorted(results.items()))
+        self.stdout.write(f"Done: {summary}")
+
+    def select(self, options):
+        documents = APIDocument.objects.all()
+        if options["user"]:
+            documents = documents.filter(user_id=options["user"])
+        if options["documents"]:
+            return documents.filter(id__in=options["documents"])
+        if options["status"]:
+            return documents.filter(status__in=options["status"])
+        if options["outdated_embeddings"]:
+            other_model = APIChunk.objects.filter(document=OuterRef("pk")).exclude(embedding_model=get_embedding_model_name())
+            return documents.filter(Exists(other_model))
+
+        # Una ingesta activa confirma un batch cada pocos segundos; sin checkpoint reciente, se da por muerta
+        cutoff = timezone.now() - timedelta(minutes=options["stale_minutes"])
+        stale = Q(checkpoint_at__lt=cutoff) | Q(checkpoint_at__isnull=True, uploaded_at__lt=cutoff)
+        return documents.filter(
+            Q(status=APIDocument.STATUS_FAILED)
+            | Q(status__in=[APIDocument.STATUS_PENDING, APIDocument.STATUS_PROCESSING]) & stale
+        )
+
+    def run(self, document_id, reindex):
+        """Processes one document in this thread, like the worker task; returns (status, seconds)."""
+        start = time.perf_counter()
+        try:
+            status = process_document_task(document_id, reindex=reindex)
+        finally:
+            # Cada hilo abre su propia conexión a la base de datos
+            connections.close_all()
+        return status, time.perf_counter() - start
@@ -0,0 +1,253 @@
+"""Process-local metrics rendered in the Prometheus text format.
+
+Stage timers, token counters and request counters live in memory in the
+process that does the work and are served by the /metrics view. Ingestion
+runs in the Celery worker, so its stages are exported by the worker itself
+(see start_metrics_server and WORKER_METRICS_PORT).
+"""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from django.conf import settings
+import bisect
+import threading
+import time
+import logging
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Segundos: de una consulta a la base de datos a una ingesta completa
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics):
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                logging.warning(f"No se pudo recolectar la métrica {metric.name}: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels))
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(self._values.items())]
+
+
+class Gauge(Metric):
+    """A value that is set, or read from collect() (returning {label values tuple: value}) at scrape time."""
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), collect=None, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        values = self.collect() if self.collect else None
+        if values is None:
+            with self._lock:
+                values = dict(self._values)
+        return [(self.name, _format_labels(self.labels, key), value) for key, value in sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, help, labels, registry)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Un contador por bucket más +Inf, la suma y el total
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            items = sorted((key, list(counts)) for key, counts in self._values.items())
+        for key, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", _format_labels(self.labels, key, [("le", _format_value(bound))]), cumulative))
+            samples.append((f"{self.name}_sum", _format_labels(self.labels, key), counts[-2]))
+            samples.append((f"{self.name}_count", _format_labels(self.labels, key), counts[-1]))
+        return samples
+
+
+def _queue_depth():
+    """Documents per ingestion state, and the tasks waiting in the Redis broker if there is one."""
+    from .models import APIDocument
+    from django.db.models import Count
+
+    states = (APIDocument.STATUS_PENDING, APIDocument.STATUS_PROCESSING)
+    depth = {(state,): 0 for state in states}
+    rows = APIDocument.objects.filter(status__in=states).values('status').annotate(total=Count('id'))
+    depth.update({(row['status'],): row['total'] for row in rows})
+
+    broker = settings.CELERY_BROKER_URL or ''
+    if broker.startswith('redis') and not settings.CELERY_TASK_ALWAYS_EAGER:
+        try:
+            import redis
+            depth[('broker',)] = redis.Redis.from_url(broker, socket_timeout=0.5).llen('celery')
+        except Exception as e:
+            logging.debug(f"No se pudo leer la cola de Celery: {e}")
+    return depth
+
+
+STAGE_SECONDS = Histogram(
+    "rag_stage_duration_seconds", "Time spent in each stage of the ingestion and chat pipelines.", ["pipeline", "stage"]
+)
+TOKENS = Counter("rag_tokens_total", "Tokens sent to or generated by the models.", ["kind"])
+DOCUMENTS = Counter("rag_documents_processed_total", "Documents finished by the ingestion pipeline.", ["status"])
+CHUNKS = Counter("rag_chunks_stored_total", "Chunks written to the database.")
+RESUMED_CHUNKS = Counter("rag_chunks_resumed_total", "Chunks kept from an interrupted ingestion instead of being embedded again.")
+HTTP_REQUESTS = Counter("rag_http_requests_total", "HTTP requests served.", ["view", "method", "status"])
+HTTP_SECONDS = Histogram("rag_http_request_duration_seconds", "Time until the response is returned.", ["view", "method"])
+QUEUE_DEPTH = Gauge("rag_ingestion_queue_depth", "Documents pending or processing, and broker backlog.", ["state"], collect=_queue_depth)
+
+
+def _concurrency_limits():
+    from .rate_limit import concurrency_limits
+    return concurrency_limits()
+
+
+RATE_LIMIT_WAIT_SECONDS = Counter("rag_rate_limit_wait_seconds_total", "Time calls waited for the client-side rate limiter.", ["api"])
+RATE_LIMITED = Counter("rag_rate_limited_total", "Calls answered with 429 by the API.", ["api"])
+CONCURRENCY_LIMIT = Gauge("rag_adaptive_concurrency_limit", "Current AIMD limit on calls in flight.", ["api"], collect=_concurrency_limits)
+
+
+def observe_stage(pipeline, stage, seconds):
+    STAGE_SECONDS.observe(seconds, pipeline=pipeline, stage=stage)
+
+
+@contextmanager
+def timed(pipeline, stage):
+    """Times the block as one observation of the stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(pipeline, stage, time.perf_counter() - start)
+
+
+class Stopwatch:
+    """Accumulates the time spent inside an iterator, for stages run as chained generators."""
+
+    def __init__(self):
+        self.seconds = 0.0
+
+    def wrap(self, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.seconds += time.perf_counter() - start
+                return
+            self.seconds += time.perf_counter() - start
+            yield item
+
+
+def count_model_tokens(kind, tokens):
+    if tokens:
+        TOKENS.inc(tokens, kind=kind)
+
+
+def render_metrics():
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Cada scrape no debe terminar en el log
+
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serves render_metrics() on port from a daemon thread (processes without Django views, e.g. the worker)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Métricas disponibles en http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:19
+
+from django.db import migrations, models
+
+
+def mark_processed_documents(apps, schema_editor):
+    APIDocument = apps.get_model('rag_app_apis', 'APIDocument')
+    APIDocument.objects.filter(processed=True).update(status='completed', progress=100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0002_apidocument_local_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apidocument',
+            name='error',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='apidocument',
+            name='job_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='apidocument',
+            name='progress',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='apidocument',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+        migrations.RunPython(mark_processed_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0003_apidocument_ingestion_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apidocument',
+            name='index_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
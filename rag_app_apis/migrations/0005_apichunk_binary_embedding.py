@@ -0,0 +1,69 @@
+from django.db import migrations, models
+import numpy as np
+
+
+def json_to_binary(apps, schema_editor):
+    APIChunk = apps.get_model('rag_app_apis', 'APIChunk')
+    batch = []
+    for chunk in APIChunk.objects.only('id', 'embedding').iterator(chunk_size=500):
+        chunk.embedding_bin = np.asarray(chunk.embedding, dtype='<f4').tobytes()
+        chunk.embedding_format = 'f32'
+        batch.append(chunk)
+        if len(batch) >= 500:
+            APIChunk.objects.bulk_update(batch, ['embedding_bin', 'embedding_format'])
+            batch = []
+    if batch:
+        APIChunk.objects.bulk_update(batch, ['embedding_bin', 'embedding_format'])
+
+
+def binary_to_json(apps, schema_editor):
+    APIChunk = apps.get_model('rag_app_apis', 'APIChunk')
+    batch = []
+    for chunk in APIChunk.objects.only('id', 'embedding_bin').iterator(chunk_size=500):
+        chunk.embedding = np.frombuffer(chunk.embedding_bin, dtype='<f4').tolist()
+        batch.append(chunk)
+        if len(batch) >= 500:
+            APIChunk.objects.bulk_update(batch, ['embedding'])
+            batch = []
+    if batch:
+        APIChunk.objects.bulk_update(batch, ['embedding'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0004_apidocument_index_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apichunk',
+            name='embedding_bin',
+            field=models.BinaryField(null=True),
+        ),
+        migrations.AddField(
+            model_name='apichunk',
+            name='embedding_format',
+            field=models.CharField(choices=[('f32', 'float32'), ('f16', 'float16'), ('i8', 'int8 quantized')], default='f32', max_length=3),
+        ),
+        migrations.AlterField(
+            model_name='apichunk',
+            name='embedding',
+            field=models.JSONField(null=True),
+        ),
+        migrations.RunPython(json_to_binary, binary_to_json),
+        migrations.RemoveField(
+            model_name='apichunk',
+            name='embedding',
+        ),
+        migrations.RenameField(
+            model_name='apichunk',
+            old_name='embedding_bin',
+            new_name='embedding',
+        ),
+        migrations.AlterField(
+            model_name='apichunk',
+            name='embedding',
+            field=models.BinaryField(),
+        ),
+    ]
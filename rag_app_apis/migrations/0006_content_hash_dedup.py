@@ -0,0 +1,51 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:31
+
+from django.db import migrations, models
+import hashlib
+
+
+def hash_existing_chunks(apps, schema_editor):
+    APIChunk = apps.get_model('rag_app_apis', 'APIChunk')
+    batch = []
+    for chunk in APIChunk.objects.only('id', 'content').iterator(chunk_size=500):
+        chunk.content_hash = hashlib.sha256(chunk.content.encode('utf-8')).hexdigest()
+        batch.append(chunk)
+        if len(batch) >= 500:
+            APIChunk.objects.bulk_update(batch, ['content_hash'])
+            batch = []
+    if batch:
+        APIChunk.objects.bulk_update(batch, ['content_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0005_apichunk_binary_embedding'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apichunk',
+            name='content_hash',
+            field=models.CharField(db_index=True, default='', max_length=64),
+        ),
+        migrations.AddField(
+            model_name='apidocument',
+            name='content_hash',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+        migrations.CreateModel(
+            name='APIEmbedding',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('embedding', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'unique_together': {('model', 'content_hash')},
+            },
+        ),
+        migrations.RunPython(hash_existing_chunks, migrations.RunPython.noop),
+    ]
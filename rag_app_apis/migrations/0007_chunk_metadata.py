@@ -0,0 +1,41 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:37
+
+from django.db import migrations, models
+
+
+def mark_legacy_chunking(apps, schema_editor):
+    # Los documentos ya procesados se dividieron con el splitter de 10000/2000 caracteres
+    APIDocument = apps.get_model('rag_app_apis', 'APIDocument')
+    APIChunk = apps.get_model('rag_app_apis', 'APIChunk')
+    APIDocument.objects.filter(id__in=APIChunk.objects.values('document_id')).update(chunking_strategy='legacy')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0006_content_hash_dedup'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apichunk',
+            name='char_offset',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='apichunk',
+            name='page',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='apichunk',
+            name='token_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='apidocument',
+            name='chunking_strategy',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.RunPython(mark_legacy_chunking, migrations.RunPython.noop),
+    ]
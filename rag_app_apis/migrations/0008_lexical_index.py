@@ -0,0 +1,25 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:44
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0007_chunk_metadata'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='APILexicalIndex',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.BinaryField()),
+                ('chunk_count', models.PositiveIntegerField(default=0)),
+                ('term_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('document', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='lexical_index', to='rag_app_apis.apidocument')),
+            ],
+        ),
+    ]
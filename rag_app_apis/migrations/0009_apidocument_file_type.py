@@ -0,0 +1,33 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:45
+
+from django.db import migrations, models
+import os
+
+
+def fill_file_type(apps, schema_editor):
+    APIDocument = apps.get_model('rag_app_apis', 'APIDocument')
+    batch = []
+    for document in APIDocument.objects.only('id', 'file').iterator(chunk_size=500):
+        document.file_type = os.path.splitext(document.file.name or '')[1].lower().lstrip('.')[:10]
+        batch.append(document)
+        if len(batch) >= 500:
+            APIDocument.objects.bulk_update(batch, ['file_type'])
+            batch = []
+    if batch:
+        APIDocument.objects.bulk_update(batch, ['file_type'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0008_lexical_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apidocument',
+            name='file_type',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=10),
+        ),
+        migrations.RunPython(fill_file_type, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 4.2.10 on 2026-10-17 03:52
+
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Min
+
+
+def fill_ordinals(apps, schema_editor):
+    """Numbers the chunks of each document in id order, the order the lexical index postings use."""
+    APIChunk = apps.get_model('rag_app_apis', 'APIChunk')
+    ranges = APIChunk.objects.values('document_id').annotate(first=Min('id'), last=Max('id'), total=Count('id'))
+    scattered = []
+    for row in ranges.iterator():
+        if row['last'] - row['first'] + 1 == row['total']:
+            # Chunks guardados con ids consecutivos (lo normal con bulk_create): una sola sentencia
+            APIChunk.objects.filter(document_id=row['document_id']).update(ordinal=F('id') - row['first'])
+        else:
+            scattered.append(row['document_id'])
+
+    batch = []
+    for document_id in scattered:
+        for ordinal, chunk in enumerate(APIChunk.objects.filter(document_id=document_id).only('id').order_by('id')):
+            chunk.ordinal = ordinal
+            batch.append(chunk)
+        if len(batch) >= 1000:
+            APIChunk.objects.bulk_update(batch, ['ordinal'])
+            batch = []
+    if batch:
+        APIChunk.objects.bulk_update(batch, ['ordinal'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0009_apidocument_file_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apichunk',
+            name='ordinal',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_ordinals, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='apiconversation',
+            index=models.Index(fields=['user', 'created_at', 'id'], name='apiconv_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='apidocument',
+            index=models.Index(fields=['user', 'status', 'uploaded_at'], name='apidoc_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='apimessage',
+            index=models.Index(fields=['conversation', 'timestamp', 'id'], name='apimsg_conv_timestamp_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='apichunk',
+            constraint=models.UniqueConstraint(fields=('document', 'ordinal'), name='apichunk_document_ordinal_uniq'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.10 on 2026-10-17 04:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0010_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apidocument',
+            name='checkpoint_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.10 on 2026-10-17 04:40
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.functions import Length
+
+
+def fill_embedding_model(apps, schema_editor):
+    """Existing chunks were embedded by the OpenAI model of EMBEDDING_MODEL_NAME; the dimension follows from the bytes."""
+    APIChunk = apps.get_model('rag_app_apis', 'APIChunk')
+    APIChunk.objects.update(embedding_model=settings.EMBEDDING_MODEL_NAME)
+    APIChunk.objects.filter(embedding_format='f32').update(embedding_dim=Length('embedding') / 4)
+    APIChunk.objects.filter(embedding_format='f16').update(embedding_dim=Length('embedding') / 2)
+    # int8: 4 bytes de escala y un byte por dimensión
+    APIChunk.objects.filter(embedding_format='i8').update(embedding_dim=Length('embedding') - 4)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('rag_app_apis', '0011_apidocument_checkpoint_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='apichunk',
+            name='embedding_model',
+            field=models.CharField(default='', max_length=100),
+        ),
+        migrations.AddField(
+            model_name='apichunk',
+            name='embedding_dim',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(fill_embedding_model, migrations.RunPython.noop),
+    ]
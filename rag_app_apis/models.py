@@ -1,23 +1,37 @@
 from django.db import models
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from .embedding_codec import FORMAT_CHOICES, FORMAT_FLOAT32, decode_embedding
 import os
 
 # File Validation
+VALID_FILE_EXTENSIONS = ['.pdf', '.txt', '.docx', '.md']
+
 def validate_file_extension(value):
     """Allows only PDF, TXT, DOCX, and MD files"""
     ext = os.path.splitext(value.name)[1].lower()
-    valid_extensions = ['.pdf', '.txt', '.docx', '.md']
-    if ext not in valid_extensions:
-        raise ValidationError(f"Invalid format. Allowed: {', '.join(valid_extensions)}")
+    if ext not in VALID_FILE_EXTENSIONS:
+        raise ValidationError(f"Invalid format. Allowed: {', '.join(VALID_FILE_EXTENSIONS)}")
 
 def validate_file_size(value):
-    """Restricts file size to 10MB"""
-    limit = 10 * 1024 * 1024  # 10MB
-    if value.size > limit:
-        raise ValidationError("File too large. Maximum allowed size is 10MB.")
+    """Restricts file size to settings.MAX_UPLOAD_SIZE_MB"""
+    limit_mb = getattr(settings, 'MAX_UPLOAD_SIZE_MB', 10)
+    if value.size > limit_mb * 1024 * 1024:
+        raise ValidationError(f"File too large. Maximum allowed size is {limit_mb}MB.")
 
 class APIDocument(models.Model):  # 👈 Cambié el nombre del modelo
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_COMPLETED = 'completed'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_COMPLETED, 'Completed'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     conversation = models.ForeignKey("APIConversation", on_delete=models.SET_NULL, null=True, blank=True)  # 👈 Cambié la referencia
     file = models.FileField(upload_to='documents/', validators=[validate_file_extension, validate_file_size])
@@ -27,6 +41,36 @@ class APIDocument(models.Model):  # 👈 Cambié el nombre del modelo
     summary = models.TextField(blank=True, null=True)
     explanation = models.TextField(blank=True, null=True)
     processed = models.BooleanField(default=False)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_PENDING)
+    progress = models.PositiveSmallIntegerField(default=0)  # Porcentaje 0-100 del pipeline de ingesta
+    job_id = models.CharField(max_length=255, null=True, blank=True)  # Id de la tarea en la cola
+    error = models.TextField(blank=True, null=True)
+    index_version = models.PositiveIntegerField(default=0)  # Se incrementa cada vez que cambian los chunks
+    content_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True)  # SHA-256 del archivo subido
+    chunking_strategy = models.CharField(max_length=32, blank=True, default='')  # Ver chunking.get_strategies()
+    file_type = models.CharField(max_length=10, blank=True, default='', db_index=True)  # Extensión sin punto: pdf, docx, txt, md
+    checkpoint_at = models.DateTimeField(null=True, blank=True)  # Último batch de chunks confirmado; sirve para detectar ingestas colgadas
+
+    class Meta:
+        indexes = [
+            # Documentos procesados de un usuario, filtrados por fecha (búsqueda en el corpus)
+            models.Index(fields=['user', 'status', 'uploaded_at'], name='apidoc_user_status_idx'),
+        ]
+
+    def set_progress(self, status=None, progress=None, error=None):
+        """Updates the ingestion state without touching the other columns."""
+        fields = []
+        if status is not None:
+            self.status = status
+            fields.append('status')
+        if progress is not None:
+            self.progress = progress
+            fields.append('progress')
+        if error is not None:
+            self.error = error
+            fields.append('error')
+        if fields:
+            self.save(update_fields=fields)
 
     def __str__(self):
         return self.title
@@ -36,9 +80,16 @@ class APIConversation(models.Model):  # 👈 Cambié el nombre del modelo
     title = models.CharField(max_length=255, blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True, db_index=True)
 
+    class Meta:
+        indexes = [
+            # Historial paginado: conversaciones de un usuario por (created_at, id)
+            models.Index(fields=['user', 'created_at', 'id'], name='apiconv_user_created_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.title:
-            first_message = self.messages.first()
+            # Una conversación nueva todavía no tiene mensajes
+            first_message = self.messages_api.only('text').first() if self.pk else None
             if first_message:
                 self.title = first_message.text[:30]
             else:
@@ -62,6 +113,10 @@ class APIMessage(models.Model):  # 👈 Cambié el nombre del modelo
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Mensajes de una conversación en orden
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='apimsg_conv_timestamp_idx'),
+        ]
 
     def __str__(self):
         return f"{self.sender.username} ({self.role}): {self.text[:30]}"
@@ -69,7 +124,50 @@ class APIMessage(models.Model):  # 👈 Cambié el nombre del modelo
 class APIChunk(models.Model):  # 👈 Cambié el nombre del modelo
     document = models.ForeignKey(APIDocument, on_delete=models.CASCADE, related_name="chunks_api")  # 👈 Cambié la referencia
     content = models.TextField()
-    embedding = models.JSONField()
+    embedding = models.BinaryField()  # Vector empaquetado, ver embedding_codec
+    embedding_format = models.CharField(max_length=3, choices=FORMAT_CHOICES, default=FORMAT_FLOAT32)
+    embedding_model = models.CharField(max_length=100, default='')  # Espacio vectorial: nunca se mezclan modelos en un índice
+    embedding_dim = models.PositiveIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, db_index=True, default='')  # SHA-256 del contenido
+    page = models.PositiveIntegerField(null=True, blank=True)  # Página de inicio (PDF)
+    char_offset = models.PositiveIntegerField(null=True, blank=True)  # Posición en el texto extraído
+    token_count = models.PositiveIntegerField(null=True, blank=True)
+    ordinal = models.PositiveIntegerField(default=0)  # Posición del chunk en el documento
+
+    class Meta:
+        constraints = [
+            # También es el índice para recorrer los chunks de un documento en orden
+            models.UniqueConstraint(fields=['document', 'ordinal'], name='apichunk_document_ordinal_uniq'),
+        ]
+
+    @property
+    def vector(self):
+        """Returns the embedding as a float32 NumPy array."""
+        return decode_embedding(self.embedding, self.embedding_format)
 
     def __str__(self):
         return f"Chunk from {self.document.title}"
+
+class APIEmbedding(models.Model):
+    """Embedding store shared by all documents, keyed by (model, SHA-256 of the chunk text)."""
+    model = models.CharField(max_length=100)
+    content_hash = models.CharField(max_length=64)
+    embedding = models.BinaryField()  # float32, ver embedding_codec
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        unique_together = [('model', 'content_hash')]
+
+    def __str__(self):
+        return f"{self.model}:{self.content_hash[:12]}"
+
+class APILexicalIndex(models.Model):
+    """Compressed BM25 postings of the chunks of a document, see lexical_index."""
+    document = models.OneToOneField(APIDocument, on_delete=models.CASCADE, related_name="lexical_index")
+    data = models.BinaryField()
+    chunk_count = models.PositiveIntegerField(default=0)
+    term_count = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Lexical index of {self.document_id} ({self.term_count} terms)"
@@ -0,0 +1,10 @@
+from rest_framework.pagination import CursorPagination
+from django.conf import settings
+
+
+class ConversationCursorPagination(CursorPagination):
+    """Newest conversations first; the cursor is the created_at of the last row (id breaks ties)."""
+    ordering = ('-created_at', '-id')
+    page_size = settings.HISTORY_PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = settings.HISTORY_MAX_PAGE_SIZE
@@ -0,0 +1,56 @@
+"""PDF text extraction helpers that run in process-pool workers.
+
+This module must not import Django or the app models: with the ``spawn``
+start method every worker imports it from scratch.
+"""
+
+from collections import deque
+from itertools import islice
+import mmap
+
+from .process_pool import process_pool
+
+
+def count_pdf_pages(file_path):
+    """Returns the number of pages of a PDF."""
+    import PyPDF2  # Se importa al usarlo: el arranque de la app no necesita el lector PDF
+    with open(file_path, 'rb') as file:
+        return len(PyPDF2.PdfReader(file).pages)
+
+def extract_pdf_page_range(file_path, start, end):
+    """Extracts the text of pages [start, end); runs inside process-pool workers.
+
+    The file is mapped with mmap, so workers reading the same PDF share the
+    OS page cache instead of each loading a private copy.
+    """
+    import PyPDF2
+    with open(file_path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        pdf_reader = PyPDF2.PdfReader(data)
+        return [pdf_reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+def iter_pdf_pages_parallel(file_path, workers, pages_per_task, total_pages=None):
+    """Yields (page_number, text) in page order, extracting page ranges in a process pool.
+
+    At most 2 * workers ranges are in flight, so finished pages do not pile up
+    in memory while the consumer is embedding.
+    """
+    total_pages = total_pages or count_pdf_pages(file_path)
+    ranges = iter([(start, min(start + pages_per_task, total_pages)) for start in range(0, total_pages, pages_per_task)])
+    in_flight = deque()
+
+    pool = process_pool(workers)
+    try:
+        for start, end in islice(ranges, 2 * workers):
+            in_flight.append((start, pool.apply_async(extract_pdf_page_range, (file_path, start, end))))
+        while in_flight:
+            start, result = in_flight.popleft()
+            texts = result.get()
+            for next_start, next_end in islice(ranges, 1):
+                in_flight.append((next_start, pool.apply_async(extract_pdf_page_range, (file_path, next_start, next_end))))
+            for offset, text in enumerate(texts):
+                yield start + offset + 1, text
+    finally:
+        # terminate() de billiard se queda esperando los resultados de las tareas en curso:
+        # se dejan acabar (como mucho 2 * workers rangos) y se cierra el pool
+        pool.close()
+        pool.join()
@@ -0,0 +1,17 @@
+"""Process pools for CPU-bound work that also run inside Celery workers.
+
+The default prefork pool of Celery runs tasks in daemon processes, and the
+standard library refuses to start children from a daemon process. billiard,
+the multiprocessing fork Celery is built on, allows it, so the pools are
+billiard pools.
+
+This module must not import Django: spawned workers import it too.
+"""
+
+import billiard
+
+
+def process_pool(workers, initializer=None, initargs=()):
+    """Returns a billiard Pool of `workers` processes started with spawn."""
+    # spawn: un fork copiaría los hilos, conexiones y locks del proceso web o del worker
+    return billiard.get_context('spawn').Pool(processes=workers, initializer=initializer, initargs=initargs)
@@ -0,0 +1,264 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from . import local_embeddings
+from .process_pool import process_pool
+import numpy as np
+import asyncio
+import hashlib
+import importlib.util
+import os
+import threading
+import time
+import re
+
+# Los clientes se construyen la primera vez que se piden, no al importar el módulo:
+# manage.py, las migraciones y el arranque del worker no pagan los imports de langchain.
+_factories = {}
+_instances = {}
+_lock = threading.Lock()
+
+
+def register_provider(name, factory):
+    """Registers the factory that builds a client; the cached instance, if any, is dropped."""
+    with _lock:
+        _factories[name] = factory
+        _instances.pop(name, None)
+
+
+def override_provider(name, instance):
+    """Replaces the cached client, e.g. with a fake in tests and benchmarks."""
+    with _lock:
+        _instances[name] = instance
+
+
+def reset_providers():
+    """Drops every cached client so the next access builds it again."""
+    with _lock:
+        _instances.clear()
+
+
+def get_provider(name):
+    """Returns the cached client for name, building it on first use."""
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                if name not in _factories:
+                    raise KeyError(f"Unknown provider: {name}")
+                instance = _instances[name] = _factories[name]()
+    return instance
+
+
+class FakeStreamingLLM:
+    """Offline stand-in for ChatOpenAI that streams a canned answer word by word."""
+
+    def __init__(self, response=None, delay=0.0):
+        self.response = response
+        self.delay = delay
+
+    def _tokens(self, messages):
+        text = self.response or f"Respuesta simulada para: {messages[-1].content[-200:]}"
+        return re.findall(r"\S+\s*", text)
+
+    def stream(self, messages):
+        from langchain_core.messages import AIMessageChunk
+        for token in self._tokens(messages):
+            if self.delay:
+                time.sleep(self.delay)
+            yield AIMessageChunk(content=token)
+
+    def invoke(self, messages):
+        from langchain_core.messages import AIMessage
+        return AIMessage(content="".join(chunk.content for chunk in self.stream(messages)))
+
+    __call__ = invoke
+
+    async def astream(self, messages):
+        from langchain_core.messages import AIMessageChunk
+        for token in self._tokens(messages):
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            yield AIMessageChunk(content=token)
+
+    async def ainvoke(self, messages):
+        from langchain_core.messages import AIMessage
+        return AIMessage(content="".join([chunk.content async for chunk in self.astream(messages)]))
+
+
+class EmbeddingProvider:
+    """Interface of the embedding clients: the LangChain Embeddings methods plus model and dimension.
+
+    model names the vector space: chunks, the embedding store and the caches
+    are keyed by it, so vectors of different models are never compared.
+    dimension is None until known.
+    """
+    model = 'default'
+    dimension = None
+
+    def embed_documents(self, texts):
+        raise NotImplementedError
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts):
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    async def aembed_query(self, text):
+        return (await self.aembed_documents([text]))[0]
+
+
+# Dimensión de los modelos de OpenAI conocidos (los demás se conocen con el primer vector)
+OPENAI_EMBEDDING_DIMENSIONS = {
+    'text-embedding-3-small': 1536,
+    'text-embedding-3-large': 3072,
+    'text-embedding-ada-002': 1536,
+}
+
+
+class OpenAIEmbeddingProvider(EmbeddingProvider):
+    """OpenAI embeddings through LangChain, with native async calls.
+
+    Batches are sent without the client's own retries: embed_batch retries
+    them, and the adaptive concurrency has to see the 429s. Single queries
+    keep the client retries.
+    """
+
+    def __init__(self, model_name):
+        from langchain.embeddings.openai import OpenAIEmbeddings
+        self.model = model_name
+        self.dimension = OPENAI_EMBEDDING_DIMENSIONS.get(model_name)
+        self.client = OpenAIEmbeddings(model=model_name, max_retries=0)
+        self.query_client = OpenAIEmbeddings(model=model_name)
+
+    def embed_documents(self, texts):
+        return self.client.embed_documents(texts)
+
+    def embed_query(self, text):
+        return self.query_client.embed_query(text)
+
+    async def aembed_documents(self, texts):
+        return await self.client.aembed_documents(texts)
+
+    async def aembed_query(self, text):
+        return await self.query_client.aembed_query(text)
+
+
+class LocalEmbeddings(EmbeddingProvider):
+    """A sentence-transformers model on CPU, encoding batches in a pool of worker processes.
+
+    The pool is a billiard pool, so it also starts inside Celery prefork
+    workers. With workers=0 the model is loaded and run in the current process.
+    """
+
+    def __init__(self, model_name, workers=0, batch_size=32):
+        if importlib.util.find_spec('sentence_transformers') is None:
+            raise ImproperlyConfigured("EMBEDDING_BACKEND='local' requires sentence-transformers (pip install sentence-transformers).")
+        self.model = model_name
+        self.batch_size = batch_size
+        self.workers = workers
+        self._pool = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loaded:
+                return
+            if self.workers:
+                threads = max(1, (os.cpu_count() or 1) // self.workers)
+                self._pool = process_pool(self.workers, initializer=local_embeddings.init_worker, initargs=(self.model, threads))
+                # Cada worker ya cargó el modelo en el initializer: uno de ellos da la dimensión
+                self.dimension = self._pool.apply(local_embeddings.model_dimension)
+            else:
+                local_embeddings.load_model(self.model)
+                self.dimension = local_embeddings.model_dimension()
+            self._loaded = True
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        self._start()
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if self._pool:
+            results = self._pool.starmap(local_embeddings.encode_batch, [(batch, self.batch_size) for batch in batches])
+        else:
+            results = (local_embeddings.encode_batch(batch, self.batch_size) for batch in batches)
+        return [vector for batch in results for vector in batch]
+
+
+class HashEmbeddings(EmbeddingProvider):
+    """Deterministic offline embeddings for tests and benchmarks.
+
+    Every word is hashed to one dimension and a sign (feature hashing), so texts
+    that share words get similar vectors and retrieval behaves plausibly
+    without a model or the network.
+    """
+
+    def __init__(self, dimension=256):
+        self.dimension = dimension
+        self.model = f'hash-{dimension}'
+
+    def embed_text(self, text):
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            value = int.from_bytes(hashlib.blake2b(word.encode('utf-8'), digest_size=8).digest(), 'little')
+            vector[value % self.dimension] += 1.0 if value >> 63 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed_text(text) for text in texts]
+
+
+def build_embeddings():
+    backend = settings.EMBEDDING_BACKEND
+    if backend == 'openai':
+        return OpenAIEmbeddingProvider(settings.EMBEDDING_MODEL_NAME)
+    if backend == 'local':
+        return LocalEmbeddings(
+            settings.LOCAL_EMBEDDING_MODEL, workers=settings.LOCAL_EMBEDDING_WORKERS, batch_size=settings.LOCAL_EMBEDDING_BATCH_SIZE,
+        )
+    if backend == 'fake':
+        return HashEmbeddings(settings.FAKE_EMBEDDING_DIM)
+    raise ImproperlyConfigured(f"Unknown EMBEDDING_BACKEND: {backend!r} (expected 'openai', 'local' or 'fake').")
+
+
+def build_chat_llm():
+    if settings.LLM_BACKEND == 'fake':
+        return FakeStreamingLLM()
+    from langchain.chat_models import ChatOpenAI
+    return ChatOpenAI(model=settings.LLM_MODEL_NAME, temperature=0.7)
+
+
+register_provider('embeddings', build_embeddings)
+register_provider('llm', build_chat_llm)
+
+
+def get_embedding_model():
+    """Returns the shared embeddings client."""
+    return get_provider('embeddings')
+
+
+def get_embedding_model_name():
+    """Name of the vector space of the current embeddings client, without building the client.
+
+    A client already built or overridden (fakes in tests) gives its own name;
+    otherwise the name comes from settings, so the upload and query paths do
+    not construct an OpenAI client just to read it.
+    """
+    instance = _instances.get('embeddings')
+    if instance is not None:
+        return getattr(instance, 'model', 'default')
+    backend = settings.EMBEDDING_BACKEND
+    if backend == 'openai':
+        return settings.EMBEDDING_MODEL_NAME
+    if backend == 'local':
+        return settings.LOCAL_EMBEDDING_MODEL
+    return get_embedding_model().model
+
+
+def get_llm():
+    """Returns the shared chat model."""
+    return get_provider('llm')
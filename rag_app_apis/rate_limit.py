@@ -0,0 +1,290 @@
+"""Client-side rate limiting and adaptive concurrency for the OpenAI calls.
+
+Each API ('embeddings', 'llm') has a pair of token buckets, one for requests
+and one for tokens, refilled at the per-minute quota of settings (*_RPM,
+*_TPM) and holding at most RATE_LIMIT_BURST_SECONDS of it. A call waits until
+both buckets can pay for it; a call larger than a bucket is let through when
+the bucket is full and leaves it in debt, so later calls wait until the quota
+has been repaid. With RATE_LIMIT_BACKEND='redis' the buckets live
+in Redis and are shared by every thread and process (web and workers); the
+local backend only coordinates the threads of one process.
+
+Token counts of a call are estimated before it is sent (the input tokens, plus
+LLM_COMPLETION_TOKENS_ESTIMATE for chat completions), which is also how the
+API counts them against the quota.
+
+AdaptiveConcurrency bounds the calls in flight with AIMD: the limit is halved
+when the API answers 429 and grows by one after as many healthy calls as the
+current limit, so bulk ingestion settles just below the quota.
+"""
+
+from django.conf import settings
+import asyncio
+import logging
+import threading
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+def is_rate_limit_error(error):
+    """True for a 429 from the API, whatever the client library (openai 0.x/1.x, httpx)."""
+    if type(error).__name__ == 'RateLimitError':
+        return True
+    status = getattr(error, 'status_code', None) or getattr(getattr(error, 'response', None), 'status_code', None)
+    return status == 429
+
+
+class LocalRateLimiter:
+    """Request and token buckets shared by the threads of this process."""
+
+    def __init__(self, rpm, tpm, burst_seconds):
+        self.quotas = (rpm, tpm)
+        self.burst_seconds = burst_seconds
+        self._levels = [self._capacity(quota) for quota in self.quotas]
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _capacity(self, quota):
+        return quota * self.burst_seconds / 60.0
+
+    @property
+    def enabled(self):
+        return any(self.quotas)
+
+    def try_acquire(self, requests=1, tokens=0):
+        """Takes requests and tokens from the buckets if both have them; returns 0, or the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            elapsed, self._updated = now - self._updated, now
+            wait = 0.0
+            amounts = (requests, tokens)
+            for i, (quota, amount) in enumerate(zip(self.quotas, amounts)):
+                if not quota:
+                    continue
+                capacity = self._capacity(quota)
+                self._levels[i] = min(capacity, self._levels[i] + elapsed * quota / 60.0)
+                # Una llamada más grande que el bucket pasa con el bucket lleno, en lugar de esperar para siempre
+                need = min(amount, capacity)
+                if self._levels[i] < need:
+                    wait = max(wait, (need - self._levels[i]) * 60.0 / quota)
+            if wait:
+                return wait
+            for i, (quota, amount) in enumerate(zip(self.quotas, amounts)):
+                if quota:
+                    self._levels[i] -= amount
+            return 0.0
+
+
+# Los dos buckets se evalúan y se descuentan en un solo paso atómico; el reloj es el de Redis
+# KEYS[1]: hash del límite; ARGV: rpm, tpm, segundos de ráfaga, requests, tokens. Devuelve la espera en ms (0 = concedido)
+_REDIS_ACQUIRE = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local burst = tonumber(ARGV[3])
+local wait = 0
+local levels = {}
+for i = 1, 2 do
+    local quota = tonumber(ARGV[i])
+    if quota > 0 then
+        local capacity = quota * burst / 60
+        local amount = tonumber(ARGV[i + 3])
+        local need = math.min(amount, capacity)
+        local level = tonumber(redis.call('HGET', KEYS[1], 'level' .. i) or capacity)
+        local last = tonumber(redis.call('HGET', KEYS[1], 'time' .. i) or now)
+        level = math.min(capacity, level + (now - last) * quota / 60000)
+        levels[i] = level - amount
+        if level < need then
+            wait = math.max(wait, (need - level) * 60000 / quota)
+        end
+    end
+end
+if wait > 0 then
+    return math.ceil(wait)
+end
+for i = 1, 2 do
+    if levels[i] then
+        redis.call('HSET', KEYS[1], 'level' .. i, tostring(levels[i]), 'time' .. i, now)
+    end
+end
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 2000) + 60000)
+return 0
+"""
+
+
+class RedisRateLimiter:
+    """The same buckets kept in Redis, shared by every process; falls back to the local ones if Redis fails."""
+
+    def __init__(self, url, key, rpm, tpm, burst_seconds):
+        if redis is None:
+            raise RuntimeError("The redis package is required for RATE_LIMIT_BACKEND='redis'.")
+        self.client = redis.Redis.from_url(url, socket_timeout=1.0)
+        self.script = self.client.register_script(_REDIS_ACQUIRE)
+        self.key = key
+        self.quotas = (rpm, tpm)
+        self.burst_seconds = burst_seconds
+        self.fallback = LocalRateLimiter(rpm, tpm, burst_seconds)
+        self._warned = False
+
+    @property
+    def enabled(self):
+        return any(self.quotas)
+
+    def try_acquire(self, requests=1, tokens=0):
+        try:
+            wait_ms = self.script(keys=[self.key], args=[*self.quotas, self.burst_seconds, requests, tokens])
+        except Exception as e:
+            if not self._warned:
+                logging.warning(f"Redis no disponible para el límite {self.key}, se usa el límite local: {e}")
+                self._warned = True
+            return self.fallback.try_acquire(requests, tokens)
+        return int(wait_ms) / 1000.0
+
+
+class RateLimiter:
+    """Blocking and async waits on top of a local or Redis bucket pair."""
+
+    def __init__(self, api, buckets, max_wait=0.5):
+        self.api = api
+        self.buckets = buckets
+        self.max_wait = max_wait  # Se vuelve a consultar al menos cada max_wait: otros procesos también consumen
+
+    def acquire(self, requests=1, tokens=0):
+        """Blocks until the call fits in the quota; returns the seconds waited."""
+        if not self.buckets.enabled:
+            return 0.0
+        waited = 0.0
+        while True:
+            wait = self.buckets.try_acquire(requests, tokens)
+            if not wait:
+                break
+            wait = min(wait, self.max_wait)
+            time.sleep(wait)
+            waited += wait
+        self._record(waited)
+        return waited
+
+    async def aacquire(self, requests=1, tokens=0):
+        """Async version of acquire; the event loop keeps running while waiting."""
+        if not self.buckets.enabled:
+            return 0.0
+        local = isinstance(self.buckets, LocalRateLimiter)
+        waited = 0.0
+        while True:
+            if local:
+                wait = self.buckets.try_acquire(requests, tokens)
+            else:
+                wait = await asyncio.to_thread(self.buckets.try_acquire, requests, tokens)
+            if not wait:
+                break
+            wait = min(wait, self.max_wait)
+            await asyncio.sleep(wait)
+            waited += wait
+        self._record(waited)
+        return waited
+
+    def _record(self, waited):
+        if waited:
+            from .metrics import RATE_LIMIT_WAIT_SECONDS
+            RATE_LIMIT_WAIT_SECONDS.inc(waited, api=self.api)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on the calls in flight, shared by the threads of this process."""
+
+    def __init__(self, api, initial, minimum=1, maximum=None, decrease=0.5, cooldown=5.0):
+        self.api = api
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = max(minimum, min(initial, self.maximum))
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._successes = 0
+        self._decreased_at = float('-inf')
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= self.limit:
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self._successes = 0
+                now = time.monotonic()
+                # Los 429 de las llamadas que ya estaban en vuelo cuentan como uno solo
+                if now - self._decreased_at >= self.cooldown:
+                    self._decreased_at = now
+                    previous, self.limit = self.limit, max(self.minimum, int(self.limit * self.decrease))
+                    logging.warning(f"Rate limit de {self.api}: concurrencia {previous} -> {self.limit}")
+            else:
+                self._successes += 1
+                if self._successes >= self.limit and self.limit < self.maximum:
+                    self._successes = 0
+                    self.limit += 1
+            self._condition.notify_all()
+
+    def stats(self):
+        return {'limit': self.limit, 'in_flight': self.in_flight, 'minimum': self.minimum, 'maximum': self.maximum}
+
+
+_limiters = {}
+_gates = {}
+_lock = threading.Lock()
+
+
+def _quotas(api):
+    if api == 'embeddings':
+        return settings.EMBEDDING_RPM, settings.EMBEDDING_TPM
+    if api == 'llm':
+        return settings.LLM_RPM, settings.LLM_TPM
+    raise KeyError(f"Unknown API: {api}")
+
+
+def get_rate_limiter(api):
+    """Returns the process-wide rate limiter of an API ('embeddings' or 'llm')."""
+    limiter = _limiters.get(api)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.get(api)
+            if limiter is None:
+                rpm, tpm = _quotas(api)
+                if settings.RATE_LIMIT_BACKEND == 'redis' and (rpm or tpm):
+                    buckets = RedisRateLimiter(settings.RATE_LIMIT_REDIS_URL, f"rag:ratelimit:{api}", rpm, tpm, settings.RATE_LIMIT_BURST_SECONDS)
+                else:
+                    buckets = LocalRateLimiter(rpm, tpm, settings.RATE_LIMIT_BURST_SECONDS)
+                limiter = _limiters[api] = RateLimiter(api, buckets)
+    return limiter
+
+
+def get_embedding_concurrency():
+    """Returns the process-wide AIMD gate of the embedding batches."""
+    gate = _gates.get('embeddings')
+    if gate is None:
+        with _lock:
+            gate = _gates.get('embeddings')
+            if gate is None:
+                gate = _gates['embeddings'] = AdaptiveConcurrency(
+                    'embeddings', settings.EMBEDDING_INITIAL_CONCURRENCY,
+                    minimum=settings.EMBEDDING_MIN_CONCURRENCY, maximum=settings.EMBEDDING_MAX_CONCURRENCY,
+                )
+    return gate
+
+
+def concurrency_limits():
+    """{(api,): current limit} for the metrics gauge."""
+    return {(api,): gate.limit for api, gate in list(_gates.items())}
+
+
+def reset_rate_limits():
+    """Drops the limiters and gates so the next call builds them from the current settings (tests)."""
+    with _lock:
+        _limiters.clear()
+        _gates.clear()
@@ -1,56 +1,177 @@
-from langchain.vectorstores import Chroma
+from asgiref.sync import sync_to_async
 from .models import APIChunk, APIDocument
-import numpy as np
-from .utils import embedding_model
+from .utils import embed_query, aembed_query
+from .vector_index import get_vector_index
+from .lexical_index import get_lexical_index, is_identifier, reciprocal_rank_fusion, tokenize
+from .corpus_index import get_corpus_index
+from .tracing import log_sampled
+from collections import namedtuple
+from django.conf import settings
 import logging
 
+# Chunks elegidos y el embedding de la pregunta (None si la búsqueda léxica bastó), que reutiliza el caché de respuestas
+Retrieval = namedtuple("Retrieval", ["chunks", "query_embedding"])
+
+def _format_results(document, scored_ids, chunks):
+    """Pairs the index hits with their chunk rows and logs the selection."""
+    top_chunks = [(chunks[chunk_id], score) for chunk_id, score in scored_ids if chunk_id in chunks]
+
+    # Una sola línea por consulta, y solo para las trazas muestreadas
+    selected = ", ".join(f"{chunk.id} ({score:.4f})" for chunk, score in top_chunks)
+    log_sampled(logging.INFO, f"Chunks seleccionados de '{document.title}': {selected}")
+
+    return [
+        {"content": chunk.content, "document": document.title, "document_id": document.id, "index_version": document.index_version,
+         "chunk_id": chunk.id, "page": chunk.page, "score": score}
+        for chunk, score in top_chunks
+    ]
+
+def _lexical_fast_path(query, lexical_hits):
+    """True when BM25 alone is conclusive: the best chunk has every query term and clearly beats the next one.
+
+    Only for queries with an identifier-like term (IDs, clause numbers) or at
+    least LEXICAL_FAST_PATH_MIN_TERMS content terms: a question with a single
+    common word ("what is the deadline?") still needs the embedding.
+    """
+    if not settings.LEXICAL_FAST_PATH or not lexical_hits:
+        return False
+    terms = set(tokenize(query))
+    if len(terms) < settings.LEXICAL_FAST_PATH_MIN_TERMS and not any(is_identifier(term) for term in terms):
+        return False
+    best = lexical_hits[0]
+    if best[2] < settings.LEXICAL_FAST_PATH_MIN_COVERAGE:
+        return False
+    return len(lexical_hits) == 1 or best[1] >= settings.LEXICAL_FAST_PATH_MARGIN * lexical_hits[1][1]
+
+def _fuse(vector_hits, lexical_hits, top_k):
+    """Reciprocal rank fusion of the vector and BM25 rankings."""
+    if not lexical_hits:
+        return vector_hits[:top_k]
+    return reciprocal_rank_fusion([vector_hits, lexical_hits], k=settings.RRF_K, top_k=top_k)
+
 def retrieve_relevant_chunks(query, conversation,top_k=3):
-    """Retrieves the most relevant document chunks using embeddings."""
+    """Retrieves the most relevant document chunks, fusing BM25 and embedding similarity; returns a Retrieval."""
 
     # Obtener el documento asociado a la conversación
     document = APIDocument.objects.filter(conversation=conversation).first()
-    
+
     if not document:
         logging.warning(f"⚠️ No se encontró un documento asociado a la conversación {conversation.id}.")
-        return []
-    
-    logging.info(f"Recuperando chunks de: {document.title}")
+        return Retrieval([], None)
+
+    logging.debug(f"Recuperando chunks de: {document.title}")
 
-    print(f"Recuperando chunks de: {document.title}")
+    candidates = max(top_k, settings.HYBRID_CANDIDATES)
+    lexical_hits = []
+    if settings.LEXICAL_SEARCH:
+        lexical_hits = get_lexical_index().search(document.id, query, top_k=candidates, version=document.index_version)
 
-    # Obtener solo los chunks del documento correcto
-    document_chunks = APIChunk.objects.filter(document=document)
+    query_embedding = None
+    if _lexical_fast_path(query, lexical_hits):
+        # Coincidencia exacta y clara (IDs, números de cláusula): no hace falta el embedding
+        log_sampled(logging.INFO, f"Búsqueda léxica concluyente para '{query}', se omite el embedding")
+        scored_ids = [(chunk_id, score) for chunk_id, score, _ in lexical_hits[:top_k]]
+    else:
+        # Generar embedding de la consulta (las preguntas repetidas salen del caché)
+        query_embedding = embed_query(query)
 
-    print(document_chunks)
+        # Buscar en el índice vectorial del documento (se carga desde la base de datos si hace falta)
+        vector_hits = get_vector_index().search(
+            document.id, query_embedding, top_k=candidates if lexical_hits else top_k, version=document.index_version
+        )
+        scored_ids = _fuse(vector_hits, lexical_hits, top_k)
 
     # Si no hay chunks en la base de datos para este documento
-    if not document_chunks.exists():
+    if not scored_ids:
         logging.warning(f"No se encontraron chunks para el documento {document.title}.")
-        return []
+        return Retrieval([], query_embedding)
 
-    # Generar embedding de la consulta
-    query_embedding = embedding_model.embed_documents([query])[0]
+    # Cargar solo el contenido de los chunks seleccionados
+    chunks = APIChunk.objects.only('id', 'content', 'page').in_bulk([chunk_id for chunk_id, _ in scored_ids])
+    return Retrieval(_format_results(document, scored_ids, chunks), query_embedding)
 
-    # Compute similarity scores
-    def cosine_similarity(a, b):
-        return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+async def aretrieve_relevant_chunks(query, conversation, top_k=3):
+    """Async version of retrieve_relevant_chunks for the ASGI chat path."""
+    document = await APIDocument.objects.filter(conversation=conversation).afirst()
 
-    scored_chunks = [
-        (chunk, cosine_similarity(query_embedding, chunk.embedding))
-        for chunk in document_chunks
-    ]
+    if not document:
+        logging.warning(f"⚠️ No se encontró un documento asociado a la conversación {conversation.id}.")
+        return Retrieval([], None)
 
+    logging.debug(f"Recuperando chunks de: {document.title}")
 
-    # Sort by similarity and return top_k chunks
-    scored_chunks.sort(key=lambda x: x[1], reverse=True)
-    top_chunks = scored_chunks[:top_k]
+    candidates = max(top_k, settings.HYBRID_CANDIDATES)
+    lexical_hits = []
+    if settings.LEXICAL_SEARCH:
+        # Las búsquedas pueden cargar el índice desde la base de datos, así que salen del event loop
+        lexical_hits = await sync_to_async(get_lexical_index().search)(
+            document.id, query, top_k=candidates, version=document.index_version
+        )
 
-    # Log and return the selected chunks with metadata
-    for chunk, score in top_chunks:
-        logging.info(f"Selected Chunk ID: {chunk.id} from Document: {chunk.document.title} (Score: {score:.4f})")
-        print(f"Selected Chunk ID: {chunk.id} from Document: {chunk.document.title} (Score: {score:.4f})")
+    query_embedding = None
+    if _lexical_fast_path(query, lexical_hits):
+        log_sampled(logging.INFO, f"Búsqueda léxica concluyente para '{query}', se omite el embedding")
+        scored_ids = [(chunk_id, score) for chunk_id, score, _ in lexical_hits[:top_k]]
+    else:
+        query_embedding = await aembed_query(query)
+        vector_hits = await sync_to_async(get_vector_index().search)(
+            document.id, query_embedding, top_k=candidates if lexical_hits else top_k, version=document.index_version
+        )
+        scored_ids = _fuse(vector_hits, lexical_hits, top_k)
 
-    return [
-        {"content": chunk.content, "document": chunk.document.title, "chunk_id": chunk.id, "score": score}
-        for chunk, score in top_chunks
-    ]
+    if not scored_ids:
+        logging.warning(f"No se encontraron chunks para el documento {document.title}.")
+        return Retrieval([], query_embedding)
+
+    chunks = await APIChunk.objects.only('id', 'content', 'page').ain_bulk([chunk_id for chunk_id, _ in scored_ids])
+    return Retrieval(_format_results(document, scored_ids, chunks), query_embedding)
+
+def filter_user_documents(user_id, document_ids=None, uploaded_after=None, uploaded_before=None, file_types=None):
+    """Returns {document_id: (title, index_version)} of the user's processed documents matching the metadata filters."""
+    documents = APIDocument.objects.filter(user_id=user_id, status=APIDocument.STATUS_COMPLETED)
+    if document_ids:
+        documents = documents.filter(id__in=document_ids)
+    if uploaded_after:
+        documents = documents.filter(uploaded_at__gte=uploaded_after)
+    if uploaded_before:
+        documents = documents.filter(uploaded_at__lt=uploaded_before)
+    if file_types:
+        documents = documents.filter(file_type__in=[file_type.lower().lstrip('.') for file_type in file_types])
+    return {document_id: (title, version) for document_id, title, version in documents.values_list('id', 'title', 'index_version')}
+
+def retrieve_corpus_chunks(query, user_id, top_k=3, **filters):
+    """Retrieves the most relevant chunks across a user's documents.
+
+    filters (document_ids, uploaded_after, uploaded_before, file_types) select
+    the documents in SQL; the corpus index then only scores their rows.
+    Returns a Retrieval.
+    """
+    documents = filter_user_documents(user_id, **filters)
+    if not documents:
+        logging.warning(f"⚠️ Ningún documento del usuario {user_id} cumple los filtros {filters}.")
+        return Retrieval([], None)
+
+    logging.debug(f"Recuperando chunks de {len(documents)} documentos del usuario {user_id}")
+    query_embedding = embed_query(query)
+    # Sin filtros se busca en todo el corpus; con filtros, solo en las filas de los documentos elegidos
+    document_ids = list(documents) if any(filters.values()) else None
+    hits = get_corpus_index().search(user_id, query_embedding, top_k=top_k, document_ids=document_ids)
+
+    chunks = APIChunk.objects.only('id', 'content', 'page').in_bulk([chunk_id for chunk_id, _, _ in hits])
+    results = []
+    for chunk_id, document_id, score in hits:
+        chunk = chunks.get(chunk_id)
+        if chunk is None or document_id not in documents:
+            continue
+        title, version = documents[document_id]
+        results.append({
+            "content": chunk.content, "document": title, "document_id": document_id, "index_version": version,
+            "chunk_id": chunk_id, "page": chunk.page, "score": score,
+        })
+    selected = ", ".join(f"{result['chunk_id']} ({result['score']:.4f})" for result in results)
+    log_sampled(logging.INFO, f"Chunks seleccionados de {len(documents)} documentos: {selected}")
+    return Retrieval(results, query_embedding)
+
+async def aretrieve_corpus_chunks(query, user_id, top_k=3, **filters):
+    """Async version of retrieve_corpus_chunks; the index search runs in a worker thread."""
+    return await sync_to_async(retrieve_corpus_chunks)(query, user_id, top_k=top_k, **filters)
@@ -8,6 +8,12 @@ class DocumentSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
+class DocumentStatusSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = APIDocument
+        fields = ['id', 'title', 'status', 'progress', 'processed', 'job_id', 'error', 'chunking_strategy', 'uploaded_at', 'checkpoint_at']
+
+
 class MessageSerializer(serializers.ModelSerializer):
     class Meta:
         model = APIMessage
@@ -17,4 +23,16 @@ class MessageSerializer(serializers.ModelSerializer):
 class ConversationSerializer(serializers.ModelSerializer):
     class Meta:
         model = APIConversation
-        fields = '__all__'
+        fields = ['id', 'user', 'title', 'created_at']
+
+
+class ConversationHistorySerializer(ConversationSerializer):
+    """Conversation with its latest messages, prefetched by the view into latest_messages."""
+    latest_messages = serializers.SerializerMethodField()
+
+    class Meta(ConversationSerializer.Meta):
+        fields = ConversationSerializer.Meta.fields + ['latest_messages']
+
+    def get_latest_messages(self, obj):
+        # Se prefetchean de la más nueva a la más vieja; se devuelven en orden cronológico
+        return MessageSerializer(reversed(obj.latest_messages), many=True).data
@@ -0,0 +1,16 @@
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from .models import APIDocument
+from .vector_index import get_vector_index
+from .lexical_index import get_lexical_index
+from .corpus_index import get_corpus_index
+from .answer_cache import get_answer_cache
+
+
+@receiver(post_delete, sender=APIDocument)
+def drop_document_index(sender, instance, **kwargs):
+    """Removes a deleted document from the indexes and its cached answers."""
+    get_vector_index().remove(instance.id)
+    get_lexical_index().remove(instance.id)
+    get_corpus_index().remove(instance.user_id)
+    get_answer_cache().remove_document(instance.id)
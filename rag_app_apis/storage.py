@@ -1,32 +1,339 @@
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
-from django.core.files.storage import Storage
+from django.core.files.storage import FileSystemStorage, Storage
 from django.utils.deconstruct import deconstructible
 from django.conf import settings
+from collections import namedtuple
+from types import SimpleNamespace
+from .cache import LRUCache
+import hashlib
+import io
+import logging
+import threading
 import uuid
 import mimetypes
 import os
 import json
 from google.oauth2 import service_account
 
+# Metadatos de un objeto que se guardan en caché (sin round trip a GCS)
+BlobMetadata = namedtuple('BlobMetadata', ['size', 'content_type', 'etag'])
+# Objeto borrado por este proceso: exists() lo sabe sin preguntar a GCS
+_MISSING = BlobMetadata(None, None, None)
+GCS_BATCH_SIZE = 100  # Máximo de llamadas por request batch de GCS
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_gcs_client():
+    """Returns the process-wide GCS client, built on first use.
+
+    Its HTTP session keeps a pool of GCS_HTTP_POOL_SIZE connections, so the
+    ingestion and upload threads reuse connections instead of opening new
+    ones. With GCS_LOCAL_BUCKET_DIR set, a LocalGCSClient is used instead.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                if settings.GCS_LOCAL_BUCKET_DIR:
+                    _client = LocalGCSClient(settings.GCS_LOCAL_BUCKET_DIR)
+                    return _client
+                from google.auth.transport.requests import AuthorizedSession
+                from requests.adapters import HTTPAdapter
+                try:
+                    credentials = service_account.Credentials.from_service_account_info(settings.GCP_CREDENTIALS)
+                    session = AuthorizedSession(credentials)
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=settings.GCS_HTTP_POOL_SIZE)
+                    session.mount('https://', adapter)
+                    _client = storage.Client(credentials=credentials, project=settings.GCP_PROJECT_ID, _http=session)
+                except Exception as e:
+                    logging.error(f"Error initializing GCS client: {str(e)}")
+                    raise
+    return _client
+
+
+def reset_gcs_client():
+    """Drops the shared client so the next use builds it from the current settings (tests)."""
+    global _client
+    with _client_lock:
+        _client = None
+
+
+def unique_filename(name):
+    """A UUID name that keeps the extension of name."""
+    file_extension = os.path.splitext(name)[1] if name else ''
+    return f"{uuid.uuid4()}{file_extension}"
+
+
+class GCSUploadWriter:
+    """Streams one object to GCS as it is written.
+
+    Files smaller than chunk_size are sent in a single request when closed;
+    larger ones switch to a resumable upload that sends chunk_size pieces.
+    """
+
+    def __init__(self, blob, content_type, chunk_size):
+        self.blob = blob
+        self.name = blob.name
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+        self._buffer = io.BytesIO()
+        self._stream = None
+
+    def write(self, data):
+        if self._stream is not None:
+            self._stream.write(data)
+            return
+        self._buffer.write(data)
+        if self._buffer.tell() >= self.chunk_size:
+            # Large file: open a resumable upload and hand it what was buffered
+            self._stream = self.blob.open('wb', chunk_size=self.chunk_size, content_type=self.content_type)
+            self._stream.write(self._buffer.getvalue())
+            self._buffer = None
+
+    def close(self):
+        """Finishes the upload and returns the object name."""
+        if self._stream is not None:
+            self._stream.close()
+        else:
+            size = self._buffer.tell()
+            self._buffer.seek(0)
+            self.blob.upload_from_file(self._buffer, size=size, content_type=self.content_type)
+        return self.name
+
+    def abort(self):
+        if self._stream is not None:
+            # BlobWriter finalizes the object when it is closed or collected, so finish it and delete it
+            try:
+                self._stream.close()
+                self.blob.delete()
+            except Exception as e:
+                logging.warning(f"Error discarding partial upload {self.name}: {e}")
+        self._stream = None
+        self._buffer = None
+
+
+class LocalUploadWriter:
+    """Streams one file to disk; it only appears under its final name once closed."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(f"{path}.part", 'wb')
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+        os.replace(f"{self.path}.part", self.path)
+        return self.name
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(f"{self.path}.part"):
+            os.remove(f"{self.path}.part")
+
+
+class LocalGCSClient:
+    """Local fake of the parts of the GCS client the storage uses, backed by a directory.
+
+    Each bucket is a subdirectory and each object a file in it; content
+    types and etags live in a .meta subdirectory. Calls made inside batch()
+    run immediately but, as in GCS, count as a single request and report
+    their errors in the batch responses instead of raising them.
+    """
+
+    def __init__(self, location):
+        self.location = location
+        self.requests = 0
+        self.current_batch = None
+        self._lock = threading.Lock()
+
+    def bucket(self, name):
+        return LocalBucket(self, name)
+
+    def batch(self, raise_exception=True):
+        return LocalBatch(self, raise_exception)
+
+    def _call(self, function, *args):
+        if self.current_batch is not None:
+            return self.current_batch._call(function, *args)
+        with self._lock:
+            self.requests += 1
+        return function(*args)
+
+
+class LocalBatch:
+    def __init__(self, client, raise_exception=True):
+        self.client = client
+        self.raise_exception = raise_exception
+        self._responses = []
+        self._error = None
+
+    def _call(self, function, *args):
+        try:
+            result = function(*args)
+            self._responses.append(SimpleNamespace(status_code=200))
+            return result
+        except NotFound as e:
+            self._responses.append(SimpleNamespace(status_code=404))
+            self._error = e
+
+    def __enter__(self):
+        self.client.current_batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.client.current_batch = None
+        with self.client._lock:
+            self.client.requests += 1
+        if exc_type is None and self.raise_exception and self._error is not None:
+            raise self._error
+
+
+class LocalBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.path = os.path.join(client.location, name)
+
+    def blob(self, name):
+        return LocalBlob(self, name)
+
+    def get_blob(self, name):
+        blob = self.blob(name)
+        try:
+            blob.reload()
+        except NotFound:
+            return None
+        return blob
+
+
+class LocalBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.path = os.path.join(bucket.path, name)
+        self._meta_path = os.path.join(bucket.path, '.meta', f"{name}.json")
+        self._properties = {}
+
+    size = property(lambda self: self._properties.get('size'))
+    content_type = property(lambda self: self._properties.get('contentType'))
+    etag = property(lambda self: self._properties.get('etag'))
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        with open(self._meta_path) as f:
+            self._properties = json.load(f)
+
+    def _store(self, data, content_type):
+        os.makedirs(os.path.dirname(self._meta_path), exist_ok=True)
+        with open(self.path, 'wb') as f:
+            f.write(data)
+        self._properties = {
+            'size': len(data),
+            'contentType': content_type or 'application/octet-stream',
+            'etag': hashlib.md5(data).hexdigest(),
+        }
+        with open(self._meta_path, 'w') as f:
+            json.dump(self._properties, f)
+
+    def _remove(self):
+        if not os.path.exists(self.path):
+            raise NotFound(f"No such object: {self.bucket.name}/{self.name}")
+        os.remove(self.path)
+        os.remove(self._meta_path)
+
+    def reload(self):
+        self.bucket.client._call(self._load)
+
+    def exists(self):
+        try:
+            self.reload()
+        except NotFound:
+            return False
+        return True
+
+    def delete(self):
+        self.bucket.client._call(self._remove)
+
+    def upload_from_string(self, data, content_type=None):
+        data = data.encode('utf-8') if isinstance(data, str) else data
+        self.bucket.client._call(self._store, data, content_type)
+
+    def upload_from_file(self, file, size=None, content_type=None):
+        self.upload_from_string(file.read() if size is None else file.read(size), content_type)
+
+    def open(self, mode='wb', chunk_size=None, content_type=None):
+        # Como BlobWriter: el objeto se crea completo al cerrar
+        blob = self
+
+        class Writer(io.BytesIO):
+            def close(self):
+                if not self.closed:
+                    blob.upload_from_string(self.getvalue(), content_type)
+                super().close()
+
+        return Writer()
+
+
 @deconstructible
 class UniqueFilenameGoogleCloudStorage(Storage):
-    def __init__(self, bucket_name=None):
-        try:
-            # Get credentials from Django settings
-            credentials = service_account.Credentials.from_service_account_info(settings.GCP_CREDENTIALS)
-            self.client = storage.Client(credentials=credentials, project=settings.GCP_PROJECT_ID)
-            self.bucket_name = bucket_name or settings.GCP_BUCKET_NAME
-            self.bucket = self.client.bucket(self.bucket_name)
-        except Exception as e:
-            import logging
-            logging.error(f"Error initializing GCS storage: {str(e)}")
-            raise
+    """Stores files in GCS under UUID names.
+
+    The client is shared by every instance and created on first use
+    (get_gcs_client). Size, content type and etag of the objects this process
+    has seen are cached for GCS_METADATA_CACHE_TTL seconds, so exists() and
+    size() usually skip the round trip; objects changed by another process
+    may be seen stale until then.
+    """
+
+    def __init__(self, bucket_name=None, client=None):
+        self.bucket_name = bucket_name or settings.GCP_BUCKET_NAME
+        self._client = client
+        self._bucket = None
+        self.metadata_cache = LRUCache(settings.GCS_METADATA_CACHE_MAX_BYTES, ttl=settings.GCS_METADATA_CACHE_TTL)
+
+    @property
+    def client(self):
+        return self._client or get_gcs_client()
+
+    @property
+    def bucket(self):
+        if self._bucket is None:
+            self._bucket = self.client.bucket(self.bucket_name)
+        return self._bucket
+
+    def _remember(self, name, metadata):
+        # Tamaño aproximado de la entrada: nombre, content type, etag y la tupla
+        self.metadata_cache.set(name, metadata, len(name) + 200)
+        return metadata
+
+    def _remember_blob(self, blob):
+        if blob.size is None:
+            return None  # Upload resumable: la respuesta final no llega al blob
+        return self._remember(blob.name, BlobMetadata(int(blob.size), blob.content_type, blob.etag))
+
+    def metadata(self, name):
+        """BlobMetadata (size, content_type, etag) of an object, or None if it does not exist."""
+        metadata = self.metadata_cache.get(name)
+        if metadata is None:
+            # get_blob trae los metadatos en el mismo request que comprueba si existe
+            blob = self.bucket.get_blob(name)
+            if blob is None:
+                return None
+            metadata = self._remember_blob(blob)
+        return None if metadata is _MISSING else metadata
 
     def _save(self, name, content):
         """Save a file to Google Cloud Storage with a unique name."""
         # Generate a unique filename using UUID
-        file_extension = os.path.splitext(name)[1] if name else ''
-        unique_name = f"{uuid.uuid4()}{file_extension}"
+        unique_name = unique_filename(name)
         blob = self.bucket.blob(unique_name)
 
         # Try to get content_type from the content object, or guess it from the filename
@@ -44,16 +351,42 @@ class UniqueFilenameGoogleCloudStorage(Storage):
                 # If content is bytes or string, use upload_from_string
                 blob.upload_from_string(content.read(), content_type=content_type)
         except Exception as e:
-            import logging
             logging.error(f"Error uploading file to GCS: {str(e)}")
             raise
 
+        self._remember_blob(blob)
         return unique_name
 
+    def open_upload(self, name, content_type=None):
+        """Returns a writer that streams a new object with a unique name (see GCSUploadWriter)."""
+        content_type = content_type or mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        blob = self.bucket.blob(unique_filename(name))
+        return GCSUploadWriter(blob, content_type, settings.GCS_UPLOAD_CHUNK_SIZE)
+
     def exists(self, name):
         """Check if a file exists in Google Cloud Storage."""
-        blob = self.bucket.blob(name)
-        return blob.exists()
+        return self.metadata(name) is not None
+
+    def bulk_exists(self, names):
+        """{name: exists} for many files; the uncached ones are checked in batched requests."""
+        result = {}
+        pending = []
+        for name in dict.fromkeys(names):
+            metadata = self.metadata_cache.get(name)
+            if metadata is None:
+                pending.append(name)
+            else:
+                result[name] = metadata is not _MISSING
+        for blob, status_code in self._batch(pending, lambda blob: blob.reload()):
+            if 200 <= status_code < 300:
+                self._remember_blob(blob)
+                result[blob.name] = True
+            elif status_code == 404:
+                result[blob.name] = False
+            else:
+                # Error de esa llamada del batch: se repite sola, y su excepción se propaga
+                result[blob.name] = self.exists(blob.name)
+        return result
 
     def url(self, name):
         """Generate a public URL for the file."""
@@ -72,14 +405,62 @@ class UniqueFilenameGoogleCloudStorage(Storage):
         """Delete the specified file from storage."""
         try:
             self.bucket.blob(name).delete()
+            self._remember(name, _MISSING)
+        except NotFound:
+            self._remember(name, _MISSING)  # If the file doesn't exist, just ignore the error
         except Exception:
-            pass  # If the file doesn't exist, just ignore the error
+            self.metadata_cache.delete(name)
+
+    def bulk_delete(self, names):
+        """Deletes many files in batched requests; returns the names that existed and were deleted."""
+        deleted = []
+        for blob, status_code in self._batch(list(dict.fromkeys(names)), lambda blob: blob.delete()):
+            if 200 <= status_code < 300 or status_code == 404:
+                self._remember(blob.name, _MISSING)
+                if status_code != 404:
+                    deleted.append(blob.name)
+            else:
+                self.metadata_cache.delete(blob.name)
+                logging.warning(f"Error deleting {blob.name} from GCS: status {status_code}")
+        return deleted
+
+    def _batch(self, names, call):
+        """Runs call(blob) for each name in GCS batch requests; yields (blob, status code) pairs."""
+        for start in range(0, len(names), GCS_BATCH_SIZE):
+            blobs = [self.bucket.blob(name) for name in names[start:start + GCS_BATCH_SIZE]]
+            batch = self.client.batch(raise_exception=False)
+            with batch:
+                for blob in blobs:
+                    call(blob)
+            # Las respuestas del batch vienen en el orden de las llamadas
+            yield from zip(blobs, [response.status_code for response in batch._responses])
 
     def size(self, name):
         """Return the total size, in bytes, of the file."""
-        blob = self.bucket.blob(name)
-        return blob.size if blob.exists() else 0
+        metadata = self.metadata(name)
+        return metadata.size if metadata else 0
 
     def generate_filename(self, filename):
         """Generate filename for storage."""
-        return os.path.join(settings.MEDIA_ROOT, filename)
\ No newline at end of file
+        return os.path.join(settings.MEDIA_ROOT, filename)
+
+
+@deconstructible
+class LocalUniqueFilenameStorage(FileSystemStorage):
+    """Filesystem stand-in for UniqueFilenameGoogleCloudStorage, for tests and offline runs.
+
+    Files get the same UUID names at the root of the location (by default a
+    directory named after GCP_BUCKET_NAME in MEDIA_ROOT), and open_upload
+    streams them like the GCS storage does.
+    """
+
+    def __init__(self, location=None, **kwargs):
+        location = location or os.path.join(settings.MEDIA_ROOT, settings.GCP_BUCKET_NAME)
+        super().__init__(location=location, **kwargs)
+
+    def get_available_name(self, name, max_length=None):
+        return unique_filename(name)
+
+    def open_upload(self, name, content_type=None):
+        unique_name = unique_filename(name)
+        return LocalUploadWriter(unique_name, self.path(unique_name))
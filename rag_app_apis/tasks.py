@@ -0,0 +1,59 @@
+from celery import shared_task
+from django.conf import settings
+from .models import APIDocument, APIMessage
+from .utils import is_transient_error, process_document
+from .tracing import get_trace_id, start_trace
+import logging
+
+
+@shared_task(bind=True)
+def process_document_task(self, document_id, trace_id=None, reindex=False):
+    """Runs the ingestion pipeline for a document in a Celery worker.
+
+    trace_id is the id of the upload request, so its log lines can be followed
+    into the worker; without it the task id is used. A redelivered task resumes
+    from the last committed batch; reindex=True starts over.
+
+    Transient errors (rate limits, timeouts, lost connections) are retried up
+    to INGEST_TASK_MAX_RETRIES times with exponential backoff, each retry
+    resuming from the last committed batch; the document is marked as failed
+    only when the retries run out. Other errors fail it at once.
+    """
+    start_trace(trace_id or self.request.id)
+    document = APIDocument.objects.filter(id=document_id).select_related('user', 'conversation').first()
+
+    if not document:
+        logging.warning(f"Documento {document_id} no existe, se descarta la tarea {self.request.id}.")
+        return None
+
+    # Llamada directa (resume_ingestion): sin reintentos de Celery, el error marca el documento como fallido
+    retries_left = not self.request.called_directly and self.request.retries < settings.INGEST_TASK_MAX_RETRIES
+    try:
+        process_document(document, resume=not reindex, raise_transient=retries_left)
+    except Exception as e:
+        if not (retries_left and is_transient_error(e)):
+            raise
+        countdown = min(settings.INGEST_RETRY_MAX_DELAY, settings.INGEST_RETRY_BASE_DELAY * 2 ** self.request.retries)
+        # El reintento conserva los chunks ya confirmados, aunque se haya pedido reindexar
+        raise self.retry(
+            exc=e, countdown=countdown, max_retries=settings.INGEST_TASK_MAX_RETRIES,
+            kwargs={'trace_id': trace_id, 'reindex': False},
+        )
+
+    if document.processed and document.conversation:
+        # Guardar mensaje del sistema cuando el documento queda listo
+        APIMessage.objects.create(
+            conversation=document.conversation,
+            sender=document.user,
+            text=f"Documento '{document.title}' procesado y listo para consultas."
+        )
+
+    return document.status
+
+
+def enqueue_document(document, reindex=False):
+    """Sends a document to the ingestion queue and stores the job id on it."""
+    result = process_document_task.delay(document.id, trace_id=get_trace_id(), reindex=reindex)
+    APIDocument.objects.filter(id=document.id).update(job_id=result.id)
+    document.job_id = result.id
+    return result.id
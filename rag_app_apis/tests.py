@@ -1,3 +1,1190 @@
-from django.test import TestCase
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncClient, TestCase, override_settings
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+from .models import APIChunk, APIConversation, APIDocument, APIEmbedding, APIMessage
+from .embedding_codec import decode_embedding, decode_matrix, encode_embedding
+from .providers import FakeStreamingLLM, HashEmbeddings, get_embedding_model_name, override_provider, reset_providers
+from .providers import _instances as provider_instances
+from .retriever import _lexical_fast_path, retrieve_relevant_chunks
+from .context_builder import ContextBuilder, build_context
+from .answer_cache import AnswerCache, get_answer_cache
+from .views import astream_assistant_response, corpus_filters
+from .corpus_index import CorpusIndex
+from .vector_index import NumpyVectorIndex, get_vector_index
+from .cache import DocumentMatrixCache, LRUCache, QueryEmbeddingCache
+from .lexical_index import get_lexical_index, reciprocal_rank_fusion
+from .chunking import TokenChunker, get_chunker
+from .tokens import count_tokens
+from .utils import embed_chunks, embed_queries, embed_query, find_duplicate_document, get_chunk_embeddings, get_query_cache
+from .utils import LLM_ERROR_MESSAGE, hash_file_chunks
+from .utils import TextSegment, hash_text, iter_text_segments, process_document
+from .tasks import process_document_task
+from RAG_SaaS.celery import app as celery_app
+from .rate_limit import AdaptiveConcurrency, LocalRateLimiter, get_embedding_concurrency, reset_rate_limits
+from .storage import LocalGCSClient, UniqueFilenameGoogleCloudStorage
+from unittest import mock
+import hashlib
+import json
+import numpy as np
+import os
+import tempfile
+import time
 
-# Create your tests here.
+
+class ConversationHistoryViewTests(TestCase):
+    url = '/api/api_conversation/history/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('history')
+        other = User.objects.create_user('other')
+        for owner in (cls.user, other):
+            for i in range(5):
+                create_conversation(owner, f"Conversation {i}", messages=3)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get(self, **params):
+        return self.client.get(self.url, {'user': self.user.id, **params})
+
+    def test_query_count_does_not_grow_with_conversations(self):
+        # Usuario + página de conversaciones
+        with self.assertNumQueries(2):
+            response = self.get()
+        self.assertEqual(len(response.data['results']), 5)
+
+        for i in range(10):
+            create_conversation(self.user, f"More {i}", messages=2)
+        with self.assertNumQueries(2):
+            response = self.get()
+        self.assertEqual(len(response.data['results']), 15)
+
+    def test_latest_messages_are_prefetched(self):
+        # Usuario + página + una sola consulta para los mensajes de todas las conversaciones
+        with self.assertNumQueries(3):
+            response = self.get(messages=2)
+        for conversation in response.data['results']:
+            texts = [message['text'] for message in conversation['latest_messages']]
+            self.assertEqual(texts, [f"{conversation['title']} message 1", f"{conversation['title']} message 2"])
+
+    def test_messages_are_not_included_by_default(self):
+        response = self.get()
+        self.assertNotIn('latest_messages', response.data['results'][0])
+
+    def test_cursor_walks_every_conversation_once(self):
+        expected = list(
+            APIConversation.objects.filter(user=self.user).order_by('-created_at', '-id').values_list('id', flat=True)
+        )
+        seen = []
+        response = self.get(page_size=2)
+        while True:
+            self.assertLessEqual(len(response.data['results']), 2)
+            seen.extend(conversation['id'] for conversation in response.data['results'])
+            if not response.data['next']:
+                break
+            response = self.client.get(response.data['next'])
+        self.assertEqual(seen, expected)
+
+    def test_invalid_messages_param(self):
+        self.assertEqual(self.get(messages='all').status_code, 400)
+
+    def test_unknown_user(self):
+        self.assertEqual(self.client.get(self.url, {'user': 999999}).status_code, 404)
+
+
+class ConversationSaveTests(TestCase):
+    def test_new_conversation_without_title(self):
+        user = User.objects.create_user('save')
+        conversation = APIConversation.objects.create(user=user)
+        self.assertEqual(conversation.title, "New Conversation")
+
+    def test_title_from_first_message(self):
+        user = User.objects.create_user('save')
+        conversation = create_conversation(user, "Old", messages=2)
+        conversation.title = ""
+        conversation.save()
+        self.assertEqual(conversation.title, "Old message 0")
+
+
+class FakeEmbeddings:
+    model = 'fake'
+
+    def embed_query(self, text):
+        return [1.0, 0.0, 0.0, 0.0]
+
+
+class FailingOnceLLM(FakeStreamingLLM):
+    """Fails its first call like a rate-limited API; the streaming call fails after one token."""
+
+    failures = 1
+
+    def _fail(self):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("429 Too Many Requests")
+
+    def invoke(self, messages):
+        self._fail()
+        return super().invoke(messages)
+
+    __call__ = invoke
+
+    def stream(self, messages):
+        tokens = super().stream(messages)
+        yield next(tokens)
+        self._fail()
+        yield from tokens
+
+
+@override_settings(LEXICAL_SEARCH=False)
+class RetrievalQueryCountTests(TestCase):
+    def setUp(self):
+        override_provider("embeddings", FakeEmbeddings())
+        self.addCleanup(reset_providers)
+        user = User.objects.create_user('retrieval')
+        self.conversation = create_conversation(user, "Retrieval")
+        document = APIDocument.objects.create(
+            user=user, title="Doc", conversation=self.conversation, status=APIDocument.STATUS_COMPLETED,
+        )
+        rng = np.random.default_rng(0)
+        APIChunk.objects.bulk_create([
+            APIChunk(
+                document=document, content=f"chunk {i}", ordinal=i,
+                embedding=encode_embedding(rng.standard_normal(4)), embedding_model='fake', embedding_dim=4,
+            )
+            for i in range(20)
+        ])
+        self.addCleanup(get_vector_index().remove, document.id)
+
+    def test_query_count_does_not_depend_on_top_k(self):
+        retrieve_relevant_chunks("question", self.conversation, top_k=1)  # Carga el índice vectorial
+        for top_k in (1, 5, 10):
+            # Documento de la conversación + contenido de los chunks elegidos
+            with self.assertNumQueries(2):
+                chunks = retrieve_relevant_chunks("question", self.conversation, top_k=top_k).chunks
+            self.assertEqual(len(chunks), top_k)
+            self.assertTrue(all(chunk['document'] == "Doc" for chunk in chunks))
+
+    def test_retrieval_returns_the_query_embedding(self):
+        chunks, query_embedding = retrieve_relevant_chunks("question", self.conversation)
+        self.assertEqual(len(chunks), 3)
+        np.testing.assert_array_equal(query_embedding, [1.0, 0.0, 0.0, 0.0])
+        self.assertTrue(all(chunk['index_version'] == 0 for chunk in chunks))
+
+    def test_chat_reads_the_query_cache_once_per_message(self):
+        override_provider("llm", FakeStreamingLLM("Answer."))
+        get_answer_cache().clear()
+        client = APIClient()
+        client.force_authenticate(self.conversation.user)
+
+        def lookups():
+            stats = get_query_cache().stats()
+            return stats['hits'] + stats['misses']
+
+        data = {"user": self.conversation.user_id, "conversation": self.conversation.id, "message": "What changed?"}
+        for cached in (False, True):
+            before = lookups()
+            response = client.post('/api/api_conversation/send/', data, format='json')
+            self.assertEqual(response.data['cached'], cached)
+            self.assertEqual(lookups() - before, 1)
+
+    def test_llm_errors_are_not_cached(self):
+        get_answer_cache().clear()
+        client = APIClient()
+        client.force_authenticate(self.conversation.user)
+        data = {"user": self.conversation.user_id, "conversation": self.conversation.id, "message": "What changed?"}
+
+        override_provider("llm", FailingOnceLLM("The price changed."))
+        response = client.post('/api/api_conversation/send/', data, format='json')
+        self.assertEqual(response.data['assistant_response'], LLM_ERROR_MESSAGE)
+        response = client.post('/api/api_conversation/send/', data, format='json')
+        self.assertEqual((response.data['cached'], response.data['assistant_response']), (False, "The price changed."))
+
+        # En streaming el error llega como último token y tampoco se guarda
+        get_answer_cache().clear()
+        override_provider("llm", FailingOnceLLM("The price changed."))
+        response = client.post('/api/api_conversation/send/', {**data, "stream": True}, format='json')
+        events = parse_sse(b"".join(response.streaming_content).decode())
+        self.assertEqual(events[-2][1]["token"], LLM_ERROR_MESSAGE)
+        self.assertEqual(events[-1][1]["assistant_response"], f"The {LLM_ERROR_MESSAGE}")
+        response = client.post('/api/api_conversation/send/', {**data, "stream": True}, format='json')
+        events = parse_sse(b"".join(response.streaming_content).decode())
+        self.assertFalse(events[0][1]["cached"])
+        self.assertEqual(events[-1][1]["assistant_response"], "The price changed.")
+
+    def test_invalid_corpus_filters_do_not_save_the_message(self):
+        client = APIClient()
+        client.force_authenticate(self.conversation.user)
+        data = {"user": self.conversation.user_id, "conversation": self.conversation.id, "message": "What changed?", "scope": "corpus"}
+        for filters in ({"file_types": [1]}, {"documents": ["first"]}, {"uploaded_after": "yesterday"}):
+            response = client.post('/api/api_conversation/send/', {**data, **filters}, format='json')
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(APIMessage.objects.filter(conversation=self.conversation).exists())
+
+    def test_corpus_file_types_are_normalized(self):
+        self.assertEqual(corpus_filters({"file_types": [" PDF", ".md"]}), {"file_types": ["pdf", "md"]})
+        self.assertEqual(corpus_filters({"file_types": "Docx,.TXT"}), {"file_types": ["docx", "txt"]})
+
+
+@override_settings(LEXICAL_FAST_PATH=True, LEXICAL_FAST_PATH_MIN_COVERAGE=1.0, LEXICAL_FAST_PATH_MARGIN=2.0,
+                   LEXICAL_FAST_PATH_MIN_TERMS=3)
+class HybridRetrievalTests(TestCase):
+    conclusive = [(1, 9.0, 1.0), (2, 3.0, 0.5)]
+
+    def test_fast_path_needs_an_identifier_or_several_terms(self):
+        self.assertFalse(_lexical_fast_path("What is the deadline?", self.conclusive))
+        self.assertTrue(_lexical_fast_path("What does clause 12.3 say?", self.conclusive))
+        self.assertTrue(_lexical_fast_path("Status of ACC-0042", self.conclusive))
+        self.assertTrue(_lexical_fast_path("supplier payment deadline penalties", self.conclusive))
+
+    def test_fast_path_needs_full_coverage_and_margin(self):
+        self.assertFalse(_lexical_fast_path("clause 12.3", [(1, 9.0, 0.5), (2, 3.0, 0.5)]))
+        self.assertFalse(_lexical_fast_path("clause 12.3", [(1, 5.0, 1.0), (2, 3.0, 1.0)]))
+        self.assertTrue(_lexical_fast_path("clause 12.3", [(1, 5.0, 1.0)]))
+        self.assertFalse(_lexical_fast_path("clause 12.3", []))
+        with override_settings(LEXICAL_FAST_PATH=False):
+            self.assertFalse(_lexical_fast_path("clause 12.3", self.conclusive))
+
+    def test_reciprocal_rank_fusion(self):
+        vector = [(1, 0.9), (2, 0.8), (3, 0.7)]
+        lexical = [(3, 12.0, 1.0), (1, 4.0, 0.5), (4, 1.0, 0.5)]
+        fused = reciprocal_rank_fusion([vector, lexical], k=60, top_k=3)
+        # 1 queda primero y segundo en las listas; 3 primero y tercero; 4 solo aparece una vez
+        self.assertEqual([chunk_id for chunk_id, _ in fused], [1, 3, 2])
+        self.assertAlmostEqual(fused[0][1], 1 / 61 + 1 / 62)
+        self.assertEqual(len(reciprocal_rank_fusion([vector, lexical], top_k=10)), 4)
+
+
+class EmbeddingCodecTests(TestCase):
+    vector = np.random.default_rng(2).standard_normal(1536).astype(np.float32)
+
+    def test_float32_round_trip_is_exact(self):
+        data = encode_embedding(self.vector, 'f32')
+        self.assertEqual(len(data), 1536 * 4)
+        np.testing.assert_array_equal(decode_embedding(data, 'f32'), self.vector)
+
+    def test_float16_round_trip(self):
+        data = encode_embedding(self.vector, 'f16')
+        self.assertEqual(len(data), 1536 * 2)
+        np.testing.assert_allclose(decode_embedding(data, 'f16'), self.vector, rtol=1e-3, atol=1e-4)
+
+    def test_int8_round_trip(self):
+        data = encode_embedding(self.vector, 'i8')
+        self.assertEqual(len(data), 4 + 1536)
+        decoded = decode_embedding(data, 'i8')
+        scale = np.abs(self.vector).max() / 127
+        self.assertLessEqual(np.abs(decoded - self.vector).max(), scale / 2 + 1e-6)
+        cosine = decoded @ self.vector / (np.linalg.norm(decoded) * np.linalg.norm(self.vector))
+        self.assertGreater(cosine, 0.999)
+        np.testing.assert_array_equal(decode_embedding(encode_embedding(np.zeros(8), 'i8'), 'i8'), np.zeros(8))
+
+    def test_decode_matrix_mixes_formats(self):
+        vectors = np.random.default_rng(3).standard_normal((3, 8)).astype(np.float32)
+        formats = ['f32', 'f16', 'i8']
+        matrix = decode_matrix([encode_embedding(v, fmt) for v, fmt in zip(vectors, formats)], formats)
+        self.assertEqual((matrix.shape, matrix.dtype), ((3, 8), np.float32))
+        np.testing.assert_array_equal(matrix[0], vectors[0])
+        np.testing.assert_allclose(matrix, vectors, atol=0.05)
+        self.assertEqual(decode_matrix([], []).shape, (0, 0))
+
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            encode_embedding(self.vector, 'f64')
+        with self.assertRaises(ValueError):
+            decode_embedding(b"", 'f64')
+
+
+class LRUCacheTests(TestCase):
+    def test_evicts_least_recently_used_within_the_byte_budget(self):
+        cache = LRUCache(max_bytes=100)
+        cache.set('a', 'A', 40)
+        cache.set('b', 'B', 40)
+        cache.get('a')  # 'b' pasa a ser el menos usado
+        cache.set('c', 'C', 40)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual((cache.get('a'), cache.get('c')), ('A', 'C'))
+        stats = cache.stats()
+        self.assertEqual((stats['bytes'], stats['entries'], stats['evictions']), (80, 2, 1))
+
+    def test_replacing_a_key_updates_its_size(self):
+        cache = LRUCache(max_bytes=100)
+        cache.set('a', 'A', 90)
+        cache.set('a', 'A2', 10)
+        cache.set('b', 'B', 90)
+        self.assertEqual((cache.get('a'), cache.current_bytes), ('A2', 100))
+
+    def test_value_larger_than_the_budget_is_refused(self):
+        cache = LRUCache(max_bytes=100)
+        cache.set('a', 'A', 50)
+        self.assertFalse(cache.set('big', 'B', 101))
+        self.assertEqual((cache.get('a'), cache.get('big')), ('A', None))
+
+    def test_entries_expire_after_the_ttl(self):
+        cache = LRUCache(max_bytes=100, ttl=10)
+        with mock.patch('rag_app_apis.cache.time.monotonic', return_value=1000.0):
+            cache.set('a', 'A', 10)
+        with mock.patch('rag_app_apis.cache.time.monotonic', return_value=1009.0):
+            self.assertEqual(cache.get('a'), 'A')
+        with mock.patch('rag_app_apis.cache.time.monotonic', return_value=1011.0):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.current_bytes, cache.stats()['expirations']), (0, 1))
+
+    def test_document_matrix_cache_keeps_one_version_per_document(self):
+        cache = DocumentMatrixCache(max_bytes=1024 * 1024)
+        ids, matrix = np.arange(4), np.ones((4, 8), dtype=np.float32)
+        cache.put(1, 0, ids, matrix)
+        cache.put(1, 1, ids, matrix * 2)
+        cache.put(2, 0, ids, matrix)
+        self.assertIsNone(cache.get(1, 0))
+        self.assertEqual(cache.get(1, 1)[1][0, 0], 2.0)
+        self.assertEqual(cache.stats()['bytes'], 2 * (ids.nbytes + matrix.nbytes))
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1, 1))
+        self.assertIsNotNone(cache.get(2, 0))
+
+
+class VectorIndexTests(TestCase):
+    def setUp(self):
+        override_provider("embeddings", FakeEmbeddings())
+        self.addCleanup(reset_providers)
+        user = User.objects.create_user('vectors')
+        self.document = APIDocument.objects.create(user=user, title="Doc", status=APIDocument.STATUS_COMPLETED)
+        self.vectors = np.random.default_rng(1).standard_normal((30, 4)).astype(np.float32)
+        self.chunks = APIChunk.objects.bulk_create([
+            APIChunk(document=self.document, content=f"chunk {i}", ordinal=i,
+                     embedding=encode_embedding(vector), embedding_model='fake', embedding_dim=4)
+            for i, vector in enumerate(self.vectors)
+        ])
+        self.index = NumpyVectorIndex(max_bytes=1024 * 1024)
+
+    def test_search_matches_brute_force_cosine(self):
+        query = np.array([0.3, -1.0, 0.5, 2.0], dtype=np.float32)
+        scores = self.vectors @ query / (np.linalg.norm(self.vectors, axis=1) * np.linalg.norm(query))
+        expected = [self.chunks[i].id for i in np.argsort(-scores)[:5]]
+
+        hits = self.index.search(self.document.id, query, top_k=5)
+        self.assertEqual([chunk_id for chunk_id, _ in hits], expected)
+        self.assertAlmostEqual(hits[0][1], float(scores.max()), places=5)
+        self.assertEqual(len(self.index.search(self.document.id, query, top_k=100)), 30)
+
+    def test_new_version_reloads_the_document(self):
+        query = [1.0, 0.0, 0.0, 0.0]
+        self.index.search(self.document.id, query, top_k=1)
+        best = APIChunk.objects.create(document=self.document, content="best", ordinal=30,
+                                       embedding=encode_embedding(query), embedding_model='fake', embedding_dim=4)
+        with self.assertNumQueries(0):
+            self.assertNotEqual(self.index.search(self.document.id, query, top_k=1)[0][0], best.id)
+        self.assertEqual(self.index.search(self.document.id, query, top_k=1, version=1)[0][0], best.id)
+
+    def test_chunks_of_another_model_are_ignored(self):
+        APIChunk.objects.filter(document=self.document).update(embedding_model='other')
+        self.assertEqual(self.index.search(self.document.id, [1.0, 0.0, 0.0, 0.0]), [])
+
+
+class CorpusIndexTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('corpus')
+        self.first = self.add_document("First")
+
+    def add_document(self, title, chunks=10):
+        document = APIDocument.objects.create(user=self.user, title=title, status=APIDocument.STATUS_COMPLETED)
+        rng = np.random.default_rng(document.id)
+        APIChunk.objects.bulk_create([
+            APIChunk(
+                document=document, content=f"{title} {i}", ordinal=i,
+                embedding=encode_embedding(rng.standard_normal(4)), embedding_model='fake', embedding_dim=4,
+            )
+            for i in range(chunks)
+        ])
+        return document
+
+    def search(self, index):
+        return index.search(self.user.id, [1.0, 0.0, 0.0, 0.0], top_k=3)
+
+    def test_signature_is_cached_until_a_document_changes(self):
+        override_provider("embeddings", FakeEmbeddings())
+        self.addCleanup(reset_providers)
+        index = CorpusIndex(signature_ttl=60)
+        self.search(index)
+        with self.assertNumQueries(0):
+            self.search(index)
+
+        # Un documento completado en este proceso invalida la firma
+        document = self.add_document("Second")
+        index.remove(self.user.id)
+        results = index.search(self.user.id, [1.0, 0.0, 0.0, 0.0], top_k=20)
+        self.assertEqual({doc_id for _, doc_id, _ in results}, {self.first.id, document.id})
+
+    def test_oversized_entry_stays_resident(self):
+        override_provider("embeddings", FakeEmbeddings())
+        self.addCleanup(reset_providers)
+        index = CorpusIndex(max_bytes=100, signature_ttl=60)
+        with self.assertLogs(level='WARNING'):
+            first = self.search(index)
+        # Ni firma ni reconstrucción: la entrada sigue residente aunque no quepa en el LRU
+        with self.assertNumQueries(0):
+            self.assertEqual(self.search(index), first)
+
+
+class CountingEmbeddings:
+    model = 'counting'
+
+    def __init__(self, fail_on_call=None, error=RuntimeError):
+        self.fail_on_call = fail_on_call
+        self.error = error
+        self.calls = 0
+        self.texts = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        if self.calls == self.fail_on_call:
+            raise self.error("rate limit")
+        self.texts += len(texts)
+        return [[float(len(text)), 1.0, 0.0, 0.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class TokenChunkerTests(TestCase):
+    sentences = [f"Clause {i} says the supplier ships batch {i} within {i % 9 + 1} days." for i in range(60)]
+
+    def chunk(self, segments, chunker=None, **kwargs):
+        chunker = chunker or TokenChunker(max_tokens=60, overlap_tokens=20)
+        return [piece for piece, _ in chunker.iter_chunks(segments, **kwargs)]
+
+    def test_chunks_fit_the_budget_and_overlap(self):
+        text = " ".join(self.sentences)
+        pieces = self.chunk([TextSegment(text, None, 1.0)])
+        self.assertGreater(len(pieces), 5)
+        for piece, following in zip(pieces, pieces[1:]):
+            self.assertLessEqual(piece.token_count, 60)
+            self.assertEqual(piece.token_count, count_tokens(piece.text))
+            self.assertEqual(text[piece.offset:piece.offset + len(piece.text)], piece.text)
+            # El siguiente chunk empieza con la última oración de este
+            last_sentence = piece.text.rsplit(". ", 1)[-1]
+            self.assertTrue(following.text.startswith(last_sentence.rstrip(".")))
+        self.assertTrue(pieces[0].text.startswith(self.sentences[0]))
+        self.assertTrue(pieces[-1].text.endswith(self.sentences[-1]))
+
+    def test_pages_and_headings_close_the_chunk(self):
+        segments = [
+            TextSegment("Intro sentence one. Intro sentence two.\n", 1, 0.3, 'page'),
+            TextSegment("# Terms\nThe terms start here.\n", 1, 0.6, 'heading'),
+            TextSegment("Second page text.\n", 2, 1.0, 'page'),
+        ]
+        pieces = self.chunk(segments)
+        self.assertEqual([piece.text for piece in pieces], [
+            "Intro sentence one. Intro sentence two.", "# Terms\nThe terms start here.", "Second page text.",
+        ])
+        self.assertEqual([piece.page for piece in pieces], [1, 1, 2])
+        document = "".join(segment.text for segment in segments)
+        self.assertTrue(all(document[piece.offset:].startswith(piece.text) for piece in pieces))
+
+    def test_small_window_gives_the_same_chunks(self):
+        segments = [TextSegment(sentence + " ", None, (i + 1) / 60) for i, sentence in enumerate(self.sentences)]
+        self.assertEqual(self.chunk(segments, window_chars=300), self.chunk(segments, window_chars=10 ** 6))
+
+    def test_long_sentence_is_cut(self):
+        text = "word " * 2000
+        pieces = self.chunk([TextSegment(text, None, 1.0)], TokenChunker(max_tokens=100, overlap_tokens=10))
+        self.assertGreater(len(pieces), 10)
+        self.assertTrue(all(piece.token_count <= 100 for piece in pieces))
+
+    def test_overlap_must_be_smaller_than_the_chunk(self):
+        with self.assertRaises(ImproperlyConfigured):
+            TokenChunker(max_tokens=50, overlap_tokens=50)
+
+
+class QueryEmbeddingCacheTests(TestCase):
+    def setUp(self):
+        self.embeddings = CountingEmbeddings()
+        override_provider("embeddings", self.embeddings)
+        self.addCleanup(reset_providers)
+        self.cache = QueryEmbeddingCache(LRUCache(1024 * 1024), 'counting')
+        patcher = mock.patch('rag_app_apis.utils.get_query_cache', return_value=self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_key_ignores_case_and_whitespace_but_not_the_model(self):
+        self.assertEqual(self.cache.key("What is the  Deadline?\n"), self.cache.key("what is the deadline?"))
+        self.assertNotEqual(self.cache.key("what is the deadline?"), self.cache.key("what is a deadline?"))
+        other_model = QueryEmbeddingCache(LRUCache(1024 * 1024), 'other')
+        self.assertNotEqual(other_model.key("deadline"), self.cache.key("deadline"))
+
+    def test_round_trip(self):
+        self.cache.set("deadline", [0.5, -1.0, 2.0])
+        cached = self.cache.get("  DEADLINE ")
+        self.assertEqual(cached.dtype, np.float32)
+        np.testing.assert_array_equal(cached, [0.5, -1.0, 2.0])
+
+    def test_normalized_repeats_are_embedded_once(self):
+        vectors = embed_queries(["Payment terms", "payment   TERMS", "Penalties"])
+        self.assertEqual((self.embeddings.calls, self.embeddings.texts), (1, 2))
+        np.testing.assert_array_equal(vectors[0], vectors[1])
+
+        np.testing.assert_array_equal(embed_query("PENALTIES"), vectors[2])
+        self.assertEqual(self.embeddings.calls, 1)
+
+
+class ContentDedupTests(TestCase):
+    def setUp(self):
+        self.embeddings = CountingEmbeddings()
+        override_provider("embeddings", self.embeddings)
+        self.addCleanup(reset_providers)
+        self.user = User.objects.create_user('dedup')
+
+    def create_document(self, content_hash='abc', strategy='default', status=APIDocument.STATUS_COMPLETED, model='counting'):
+        document = APIDocument.objects.create(
+            user=self.user, title="Doc", content_hash=content_hash, chunking_strategy=strategy, status=status,
+        )
+        APIChunk.objects.create(document=document, content="chunk", ordinal=0, embedding=encode_embedding([1.0]),
+                                embedding_model=model, embedding_dim=1)
+        return document
+
+    def test_file_hash_matches_sha256_of_the_content(self):
+        self.assertEqual(hash_file_chunks([b'ab', b'', b'cd']), hashlib.sha256(b'abcd').hexdigest())
+
+    def test_duplicate_must_be_completed_with_same_chunking_and_model(self):
+        self.create_document(status=APIDocument.STATUS_PROCESSING)
+        self.create_document(strategy='fine')
+        self.create_document(model='other')
+        self.assertIsNone(find_duplicate_document('abc', 'default'))
+
+        source = self.create_document()
+        self.assertEqual(find_duplicate_document('abc', 'default'), source)
+        self.assertIsNone(find_duplicate_document('abc', 'default', exclude_id=source.id))
+        self.assertIsNone(find_duplicate_document('other', 'default'))
+        self.assertIsNone(find_duplicate_document('', 'default'))
+
+    def test_chunk_embeddings_are_shared_by_content_hash(self):
+        hashes, embeddings = get_chunk_embeddings(["alpha", "beta", "alpha"])
+        self.assertEqual(hashes, [hash_text("alpha"), hash_text("beta"), hash_text("alpha")])
+        self.assertEqual(self.embeddings.texts, 2)
+        self.assertEqual(embeddings[0], embeddings[2])
+
+        # Otro documento con los mismos chunks no vuelve a llamar al proveedor
+        get_chunk_embeddings(["beta", "alpha"])
+        self.assertEqual(self.embeddings.texts, 2)
+        self.assertEqual(APIEmbedding.objects.filter(model='counting').count(), 2)
+
+        # Pero otro modelo sí
+        get_chunk_embeddings(["alpha"], model_name='other')
+        self.assertEqual(self.embeddings.texts, 3)
+
+
+@override_settings(INGEST_CHUNK_WINDOW=4, EMBEDDING_MAX_RETRIES=0)
+class ResumableIngestionTests(TestCase):
+    def setUp(self):
+        self.addCleanup(reset_providers)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "doc.txt")
+        self.write_file("first")
+        user = User.objects.create_user('ingest')
+        self.document = APIDocument.objects.create(user=user, title="Doc", local_path=self.path, chunking_strategy='default')
+        self.addCleanup(get_vector_index().remove, self.document.id)
+        self.addCleanup(get_lexical_index().remove, self.document.id)
+
+    def write_file(self, prefix):
+        with open(self.path, "w") as f:
+            for i in range(40):
+                f.write(f"{prefix} paragraph {i}. " + " ".join(f"term{i}x{j}" for j in range(80)) + "\n\n")
+
+    def expected_hashes(self):
+        return [hash_text(piece.text) for piece, _ in get_chunker('default').iter_chunks(iter_text_segments(self.path))]
+
+    def saved_hashes(self):
+        return list(APIChunk.objects.filter(document=self.document).order_by('ordinal').values_list('content_hash', flat=True))
+
+    def process(self, embeddings, **kwargs):
+        override_provider("embeddings", embeddings)
+        process_document(self.document, **kwargs)
+        self.document.refresh_from_db()
+
+    def test_failed_batch_resumes_without_embedding_again(self):
+        expected = self.expected_hashes()
+        self.assertGreater(len(expected), 12)
+
+        # Las dos primeras ventanas se confirman, la tercera falla
+        self.process(CountingEmbeddings(fail_on_call=3))
+        self.assertEqual(self.document.status, APIDocument.STATUS_FAILED)
+        self.assertEqual(self.saved_hashes(), expected[:8])
+        self.assertIsNotNone(self.document.checkpoint_at)
+
+        embeddings = CountingEmbeddings()
+        self.process(embeddings)
+        self.assertEqual(self.document.status, APIDocument.STATUS_COMPLETED)
+        self.assertIsNone(self.document.error)
+        self.assertEqual(embeddings.texts, len(expected) - 8)
+        self.assertEqual(self.saved_hashes(), expected)
+
+        # Otra corrida sobre el documento completo no duplica ni embebe nada
+        embeddings = CountingEmbeddings()
+        self.process(embeddings)
+        self.assertEqual(embeddings.calls, 0)
+        self.assertEqual(self.saved_hashes(), expected)
+
+    def test_changed_file_discards_unverified_chunks(self):
+        self.process(CountingEmbeddings(fail_on_call=3))
+        self.write_file("second")
+        self.process(CountingEmbeddings())
+        self.assertEqual(self.document.status, APIDocument.STATUS_COMPLETED)
+        self.assertEqual(self.saved_hashes(), self.expected_hashes())
+
+    def test_chunks_of_another_model_are_not_reused(self):
+        self.process(HashEmbeddings(16))
+        self.assertEqual(set(APIChunk.objects.filter(document=self.document).values_list('embedding_model', 'embedding_dim')), {('hash-16', 16)})
+
+        embeddings = CountingEmbeddings()
+        self.process(embeddings)
+        self.assertEqual(embeddings.texts, len(self.expected_hashes()))
+        self.assertEqual(set(APIChunk.objects.filter(document=self.document).values_list('embedding_model', 'embedding_dim')), {('counting', 4)})
+
+    def test_task_retries_transient_errors_from_the_checkpoint(self):
+        expected = self.expected_hashes()
+        # 429 en la tercera ventana: la tarea se reintenta y sigue desde las dos ventanas confirmadas
+        embeddings = CountingEmbeddings(fail_on_call=3, error=RateLimitError)
+        override_provider("embeddings", embeddings)
+        self.addCleanup(reset_rate_limits)
+        result = process_document_task.apply(args=[self.document.id])
+
+        self.document.refresh_from_db()
+        self.assertEqual(result.get(), APIDocument.STATUS_COMPLETED)
+        self.assertEqual(self.saved_hashes(), expected)
+        self.assertEqual(embeddings.texts, len(expected))
+
+    @override_settings(INGEST_TASK_MAX_RETRIES=2)
+    def test_task_fails_the_document_when_retries_run_out(self):
+        embeddings = ThrottledEmbeddings(throttled=100)
+        override_provider("embeddings", embeddings)
+        self.addCleanup(reset_rate_limits)
+        process_document_task.apply(args=[self.document.id])
+
+        self.document.refresh_from_db()
+        self.assertEqual(self.document.status, APIDocument.STATUS_FAILED)
+        self.assertIn("429", self.document.error)
+        self.assertEqual(embeddings.throttled, 100 - 3)  # Intento inicial y dos reintentos
+
+    def test_reindex_starts_over(self):
+        self.process(CountingEmbeddings())
+        first_ids = set(APIChunk.objects.filter(document=self.document).values_list('id', flat=True))
+        self.process(CountingEmbeddings(), resume=False)
+        self.assertEqual(self.saved_hashes(), self.expected_hashes())
+        self.assertFalse(first_ids & set(APIChunk.objects.filter(document=self.document).values_list('id', flat=True)))
+
+
+class HashEmbeddingsTests(TestCase):
+    def test_deterministic_and_word_based(self):
+        embeddings = HashEmbeddings(64)
+        a, b, c = np.array(embeddings.embed_documents(["clause 12.3 deadline", "deadline of clause 12.3", "payment terms"]))
+        self.assertEqual(embeddings.embed_query("clause 12.3 deadline"), a.tolist())
+        self.assertEqual(a.shape, (64,))
+        self.assertAlmostEqual(float(np.linalg.norm(a)), 1.0, places=5)
+        self.assertGreater(a @ b, a @ c)
+
+    def test_model_name_does_not_build_the_client(self):
+        reset_providers()
+        self.addCleanup(reset_providers)
+        with override_settings(EMBEDDING_BACKEND='openai', EMBEDDING_MODEL_NAME='text-embedding-3-large'):
+            self.assertEqual(get_embedding_model_name(), 'text-embedding-3-large')
+        with override_settings(EMBEDDING_BACKEND='local', LOCAL_EMBEDDING_MODEL='all-MiniLM-L6-v2'):
+            self.assertEqual(get_embedding_model_name(), 'all-MiniLM-L6-v2')
+        self.assertFalse(provider_instances)
+        with override_settings(EMBEDDING_BACKEND='fake', FAKE_EMBEDDING_DIM=32):
+            self.assertEqual(get_embedding_model_name(), 'hash-32')
+
+
+class RateLimitError(Exception):
+    pass
+
+
+class ThrottledEmbeddings:
+    """Answers 429 to the first `throttled` calls."""
+    model = 'throttled'
+
+    def __init__(self, throttled):
+        self.throttled = throttled
+
+    def embed_documents(self, texts):
+        if self.throttled:
+            self.throttled -= 1
+            raise RateLimitError("429 Too Many Requests")
+        return [[1.0, 0.0] for _ in texts]
+
+
+class FailingEmbeddings:
+    """Fails every call; the calls after the first one take `delay` seconds."""
+    model = 'failing'
+
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.calls = 0
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        if self.calls > 1:
+            time.sleep(self.delay)
+        raise RuntimeError("embedding failed")
+
+
+class RateLimitTests(TestCase):
+    def test_buckets_limit_requests_and_tokens(self):
+        # 60 RPM / 600 TPM con 1 s de ráfaga: 1 request y 10 tokens por segundo
+        limiter = LocalRateLimiter(60, 600, burst_seconds=1)
+        self.assertEqual(limiter.try_acquire(tokens=4), 0)
+        self.assertAlmostEqual(limiter.try_acquire(tokens=4), 1.0, delta=0.05)
+
+        limiter = LocalRateLimiter(0, 600, burst_seconds=1)
+        self.assertEqual(limiter.try_acquire(tokens=8), 0)
+        self.assertAlmostEqual(limiter.try_acquire(tokens=8), 0.6, delta=0.05)
+        # Más grande que el bucket: pasa con el bucket lleno y lo deja en deuda
+        self.assertAlmostEqual(limiter.try_acquire(tokens=1000), 0.8, delta=0.05)
+        limiter._levels[1] = 10
+        self.assertEqual(limiter.try_acquire(tokens=30), 0)
+        self.assertAlmostEqual(limiter.try_acquire(tokens=1), 2.1, delta=0.05)
+
+    def test_adaptive_concurrency(self):
+        gate = AdaptiveConcurrency('test', initial=4, maximum=8, cooldown=60)
+        gate.acquire()
+        gate.release(throttled=True)
+        self.assertEqual(gate.limit, 2)
+        # Los 429 de llamadas que ya estaban en vuelo no vuelven a reducirla
+        gate.acquire()
+        gate.release(throttled=True)
+        self.assertEqual(gate.limit, 2)
+        for _ in range(2):
+            gate.acquire()
+            gate.release()
+        self.assertEqual(gate.limit, 3)
+
+    @override_settings(EMBEDDING_RETRY_BASE_DELAY=0.01, EMBEDDING_INITIAL_CONCURRENCY=4)
+    def test_embedding_batches_back_off_on_429(self):
+        reset_rate_limits()
+        self.addCleanup(reset_rate_limits)
+        override_provider("embeddings", ThrottledEmbeddings(throttled=2))
+        self.addCleanup(reset_providers)
+        self.assertEqual(embed_chunks(["a", "b"]), [[1.0, 0.0], [1.0, 0.0]])
+        self.assertEqual(get_embedding_concurrency().limit, 2)
+
+    @override_settings(EMBEDDING_MAX_RETRIES=0, EMBEDDING_MAX_CONCURRENCY=1, EMBEDDING_BATCH_MAX_ITEMS=1)
+    def test_failed_batch_cancels_the_pending_ones(self):
+        reset_rate_limits()
+        self.addCleanup(reset_rate_limits)
+        embeddings = FailingEmbeddings()
+        override_provider("embeddings", embeddings)
+        self.addCleanup(reset_providers)
+        with self.assertRaises(RuntimeError):
+            embed_chunks([f"chunk {i}" for i in range(10)])
+        # Solo el batch que falló y el que ya estaba en vuelo llegaron a la API
+        self.assertLessEqual(embeddings.calls, 2)
+
+
+class StreamingUploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('uploader')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.bucket = os.path.join(media.name, settings.GCP_BUCKET_NAME)
+        self.documents = os.path.join(media.name, 'documents')
+        # Sustituto local de GCS
+        storages = {**settings.STORAGES, 'default': {'BACKEND': 'rag_app_apis.storage.LocalUniqueFilenameStorage'}}
+        # Embeddings falsos: la subida no depende de una clave de OpenAI
+        overrides = override_settings(
+            MEDIA_ROOT=media.name, STORAGES=storages, MAX_UPLOAD_SIZE_MB=1, EMBEDDING_BACKEND='fake',
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        reset_providers()
+        reset_rate_limits()
+        self.addCleanup(reset_providers)
+        self.addCleanup(reset_rate_limits)
+        enqueue = mock.patch('rag_app_apis.views.enqueue_document', return_value='job')
+        enqueue.start()
+        self.addCleanup(enqueue.stop)
+
+    def upload(self, content, name='notes.txt', user=None):
+        user = user or self.user
+        self.client.force_authenticate(user)
+        return self.client.post('/api/api_upload/', {
+            'user': user.id, 'document': SimpleUploadedFile(name, content, 'text/plain'),
+        }, format='multipart')
+
+    def stored_files(self):
+        return sorted(os.listdir(self.bucket)) if os.path.isdir(self.bucket) else []
+
+    def test_upload_is_stored_and_hashed_in_one_pass(self):
+        content = os.urandom(300 * 1024)  # Varios chunks del handler
+        response = self.upload(content)
+        self.assertEqual(response.status_code, 202)
+
+        document = APIDocument.objects.get(id=response.data['document_id'])
+        self.assertEqual(document.content_hash, hashlib.sha256(content).hexdigest())
+        self.assertEqual(self.stored_files(), [document.file.name])
+        with open(os.path.join(self.bucket, document.file.name), 'rb') as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.path.dirname(document.local_path), self.documents)
+        with open(document.local_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_stored_file_is_only_shared_with_the_same_user(self):
+        content = b'The supplier delivers within 30 days.'
+        first = APIDocument.objects.get(id=self.upload(content).data['document_id'])
+        first.status = APIDocument.STATUS_COMPLETED
+        first.save()
+        APIChunk.objects.create(document=first, content="chunk", ordinal=0, embedding=encode_embedding([1.0]),
+                                embedding_model=get_embedding_model_name(), embedding_dim=1)
+
+        again = self.upload(content)
+        self.assertTrue(again.data['deduplicated'])
+        document = APIDocument.objects.get(id=again.data['document_id'])
+        self.assertEqual((document.file.name, document.local_path), (first.file.name, first.local_path))
+        self.assertEqual(self.stored_files(), [first.file.name])
+
+        # Otro usuario: se copiarán los chunks, pero guarda su propio archivo
+        other = self.upload(content, user=User.objects.create_user('other uploader'))
+        self.assertFalse(other.data['deduplicated'])
+        document = APIDocument.objects.get(id=other.data['document_id'])
+        self.assertNotEqual(document.file.name, first.file.name)
+        self.assertNotEqual(document.local_path, first.local_path)
+        self.assertEqual(self.stored_files(), sorted([first.file.name, document.file.name]))
+        with open(document.local_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def test_response_does_not_reveal_other_users_uploads(self):
+        content = b'Confidential merger terms.'
+        first = APIDocument.objects.get(id=self.upload(content).data['document_id'])
+        first.status = APIDocument.STATUS_COMPLETED
+        first.save()
+        APIChunk.objects.create(document=first, content="chunk", ordinal=0, embedding=encode_embedding([1.0]),
+                                embedding_model=get_embedding_model_name(), embedding_dim=1)
+
+        other = User.objects.create_user('curious')
+        duplicate = self.upload(content, user=other).data
+        unseen = self.upload(b'Never uploaded before.', user=other).data
+        self.assertFalse(duplicate['deduplicated'])
+        self.assertEqual(set(duplicate), set(unseen))
+        for field in ('status', 'progress', 'deduplicated', 'chunking_strategy'):
+            self.assertEqual(duplicate[field], unseen[field])
+
+    def test_rejected_uploads_leave_no_files(self):
+        response = self.upload(b'x' * (1024 * 1024 + 1))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('too large', response.data['error'])
+
+        response = self.client.post('/api/api_upload/', {
+            'document': SimpleUploadedFile('notes.txt', b'no user'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(self.upload(b'binary', name='image.png').status_code, 400)
+        self.assertEqual(self.stored_files(), [])
+        self.assertEqual(os.listdir(self.documents), [])
+        self.assertFalse(APIDocument.objects.exists())
+
+
+class EagerIngestionTests(TestCase):
+    """Upload -> Celery task -> processed document, with the task run in-process (CELERY_TASK_ALWAYS_EAGER)."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('eager')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        storages = {**settings.STORAGES, 'default': {'BACKEND': 'rag_app_apis.storage.LocalUniqueFilenameStorage'}}
+        overrides = override_settings(
+            MEDIA_ROOT=media.name, STORAGES=storages, EMBEDDING_BACKEND='fake', CELERY_TASK_ALWAYS_EAGER=True,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        reset_providers()
+        self.addCleanup(reset_providers)
+        # La app lee CELERY_* de settings una sola vez; sin broker la tarea tiene que correr en el proceso
+        previous = celery_app.conf.task_always_eager
+        celery_app.conf.update(task_always_eager=True)
+        self.addCleanup(celery_app.conf.update, task_always_eager=previous)
+
+    def test_upload_is_processed_by_the_task(self):
+        content = "\n\n".join(f"Clause {i}. The supplier delivers batch {i} within {i} days." for i in range(30))
+        response = self.client.post('/api/api_upload/', {
+            'user': self.user.id, 'document': SimpleUploadedFile('contract.txt', content.encode(), 'text/plain'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, 202)
+        self.assertTrue(response.data['job_id'])
+        self.assertEqual(response.data['status'], APIDocument.STATUS_COMPLETED)
+        document_id = response.data['document_id']
+        self.addCleanup(get_vector_index().remove, document_id)
+        self.addCleanup(get_lexical_index().remove, document_id)
+
+        status = self.client.get('/api/api_upload/status/', {'user': self.user.id, 'document': document_id})
+        self.assertEqual(status.data['status'], APIDocument.STATUS_COMPLETED)
+        self.assertEqual(status.data['progress'], 100)
+        self.assertEqual(status.data['job_id'], response.data['job_id'])
+        self.assertTrue(APIChunk.objects.filter(document_id=document_id, embedding_model='hash-256').exists())
+        self.assertTrue(APIMessage.objects.filter(conversation_id=response.data['conversation_id'], text__contains='procesado').exists())
+
+
+class GoogleCloudStorageTests(TestCase):
+    def setUp(self):
+        bucket = tempfile.TemporaryDirectory()
+        self.addCleanup(bucket.cleanup)
+        # Bucket falso en disco; cuenta los requests que harían falta a GCS
+        self.client = LocalGCSClient(bucket.name)
+        self.storage = UniqueFilenameGoogleCloudStorage(client=self.client)
+
+    def save(self, content, name='documents/notes.txt'):
+        return self.storage.save(name, ContentFile(content, name=name))
+
+    def test_metadata_is_cached(self):
+        name = self.save(b'hello world')
+        self.assertEqual(self.client.requests, 1)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.storage.size(name), 11)
+        self.assertEqual(self.storage.metadata(name).content_type, 'text/plain')
+        self.assertEqual(self.client.requests, 1)
+
+        # Sin caché (expirado u otro proceso): un solo request trae el tamaño
+        self.storage.metadata_cache.clear()
+        self.assertEqual(self.storage.size(name), 11)
+        self.assertTrue(self.storage.exists(name))
+        self.assertEqual(self.client.requests, 2)
+
+        self.assertFalse(self.storage.exists('missing.txt'))
+        self.assertEqual(self.storage.size('missing.txt'), 0)
+
+        self.storage.delete(name)
+        requests = self.client.requests
+        self.assertFalse(self.storage.exists(name))
+        self.assertEqual(self.client.requests, requests)
+
+    def test_bulk_operations_use_one_batch(self):
+        names = [self.save(f'file {i}'.encode()) for i in range(3)]
+        self.storage.metadata_cache.clear()
+        requests = self.client.requests
+
+        exists = self.storage.bulk_exists(names + ['missing.txt'])
+        self.assertEqual(exists, {**{name: True for name in names}, 'missing.txt': False})
+        self.assertEqual(self.client.requests, requests + 1)
+        self.assertEqual(self.storage.size(names[0]), 6)
+        self.assertEqual(self.client.requests, requests + 1)
+
+        self.assertEqual(self.storage.bulk_delete([names[0], names[1], 'missing.txt']), names[:2])
+        self.assertEqual(self.client.requests, requests + 2)
+        self.assertEqual(self.storage.bulk_exists(names), {names[0]: False, names[1]: False, names[2]: True})
+        self.assertEqual(self.client.requests, requests + 2)
+
+
+def make_chunk(chunk_id, content, score, page=None):
+    return {"content": content, "document": "Contract", "document_id": 1, "chunk_id": chunk_id, "page": page, "score": score}
+
+
+class ContextBuilderTests(TestCase):
+    filler = " ".join(f"Section {i} covers unrelated administrative matters in detail." for i in range(40))
+
+    def test_chunks_that_fit_are_kept_best_first(self):
+        context = build_context("When is the deadline?", [
+            make_chunk(1, "The office is in Madrid.", 0.2),
+            make_chunk(2, "The deadline is March 1.", 0.9, page=3),
+        ], max_tokens=500)
+        self.assertEqual(context.chunk_ids, [2, 1])
+        self.assertEqual((context.trimmed, context.dropped), (0, 0))
+        self.assertIn("Chunk 2 (page 3):\nThe deadline is March 1.", context.prompt)
+        self.assertTrue(context.prompt.endswith("User Query: When is the deadline?"))
+        self.assertLess(context.context_tokens, context.prompt_tokens)
+
+    def test_overlapping_sentences_are_sent_once(self):
+        context = build_context("deadline", [
+            make_chunk(1, "The deadline is March 1. Late delivery costs 2% per week.", 0.9),
+            make_chunk(2, "Late delivery costs 2% per week. Penalties are capped at 10%.", 0.8),
+        ], max_tokens=500)
+        self.assertEqual(context.prompt.count("Late delivery costs 2% per week."), 1)
+        self.assertIn("Chunk 2:\nPenalties are capped at 10%.", context.prompt)
+
+    def test_budget_trims_to_sentences_about_the_query(self):
+        content = f"{self.filler} The payment deadline is March 1. {self.filler}"
+        context = build_context("What is the payment deadline?", [make_chunk(1, content, 0.9)], max_tokens=100)
+        self.assertEqual((context.chunk_ids, context.trimmed), ([1], 1))
+        self.assertIn("Chunk 1:\nThe payment deadline is March 1.", context.prompt)
+        self.assertNotIn("unrelated", context.prompt)
+
+    def test_context_stays_within_the_budget(self):
+        chunks = [
+            make_chunk(i, " ".join(f"Deadline {i}.{j} falls on day {j} of the term." for j in range(20)), 1.0 - i / 10)
+            for i in range(6)
+        ]
+        builder = ContextBuilder(max_tokens=300)
+        context = builder.build("deadline", chunks)
+        self.assertLessEqual(context.context_tokens, 300)
+        self.assertEqual(len(context.chunk_ids) + context.dropped, 6)
+        self.assertEqual(context.chunk_ids[0], 0)
+        self.assertGreater(context.dropped, 0)
+
+    def test_without_chunks(self):
+        context = build_context("Hello?", [], max_tokens=100)
+        self.assertEqual((context.chunk_ids, context.context_tokens), ([], 0))
+        self.assertIn("No context available.", context.prompt)
+
+
+class AnswerCacheTests(TestCase):
+    chunks = [make_chunk(1, "The deadline is March 1.", 0.9), make_chunk(2, "Penalties apply.", 0.5)]
+
+    def setUp(self):
+        self.cache = AnswerCache(max_bytes=1024 * 1024, ttl=60, min_similarity=0.95)
+
+    def answer(self, question, embedding=None, chunks=None):
+        lookup = self.cache.lookup(chunks or self.chunks, question, embedding)
+        self.cache.store(lookup, f"Answer to {question}")
+        return lookup
+
+    def test_same_normalized_question_hits_without_embedding(self):
+        self.assertIsNone(self.answer("When is the deadline?").answer)
+        lookup = self.cache.lookup(self.chunks, "  when is the DEADLINE? ")
+        self.assertEqual((lookup.answer, lookup.similarity), ("Answer to When is the deadline?", 1.0))
+        self.assertEqual(self.cache.stats()['exact_hits'], 1)
+
+    def test_similarity_threshold(self):
+        self.answer("When is the deadline?", [1.0, 0.0])
+        close = [np.cos(0.2), np.sin(0.2)]  # Coseno 0.980
+        far = [np.cos(0.35), np.sin(0.35)]  # Coseno 0.939, casi acierto
+        self.assertEqual(self.cache.lookup(self.chunks, "What is the due date?", close).answer, "Answer to When is the deadline?")
+        self.assertIsNone(self.cache.lookup(self.chunks, "What is the due date?", far).answer)
+        stats = self.cache.stats()
+        self.assertEqual((stats['semantic_hits'], stats['near_misses'], stats['lookups']), (1, 1, 3))
+
+    def test_other_chunks_or_versions_do_not_match(self):
+        self.answer("When is the deadline?", [1.0, 0.0])
+        self.assertIsNone(self.cache.lookup(self.chunks[:1], "When is the deadline?", [1.0, 0.0]).answer)
+        reprocessed = [{**chunk, "index_version": 1} for chunk in self.chunks]
+        self.assertIsNone(self.cache.lookup(reprocessed, "When is the deadline?", [1.0, 0.0]).answer)
+        self.assertIsNone(self.cache.lookup([], "When is the deadline?").key)
+
+    def test_remove_document_and_ttl(self):
+        self.answer("When is the deadline?")
+        other = [make_chunk(3, "Other.", 0.9)]
+        self.answer("When is the deadline?", chunks=[{**other[0], "document_id": 2}])
+        self.cache.remove_document(1)
+        self.assertIsNone(self.cache.lookup(self.chunks, "When is the deadline?").answer)
+        self.assertIsNotNone(self.cache.lookup([{**other[0], "document_id": 2}], "When is the deadline?").answer)
+
+        with mock.patch('rag_app_apis.answer_cache.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(self.cache.lookup([{**other[0], "document_id": 2}], "When is the deadline?").answer)
+
+    def test_only_missed_lookups_with_an_answer_are_stored(self):
+        self.answer("When is the deadline?")
+        self.cache.store(self.cache.lookup(self.chunks, "When is the deadline?"), "Another answer")
+        self.cache.store(self.cache.lookup(self.chunks, "Penalties?"), "")
+        self.assertEqual(self.cache.stats()['stores'], 1)
+        self.assertEqual(self.cache.lookup(self.chunks, "When is the deadline?").answer, "Answer to When is the deadline?")
+
+
+class ClosingStreamingLLM(FakeStreamingLLM):
+    closed = False
+
+    async def astream(self, messages):
+        try:
+            async for chunk in super().astream(messages):
+                yield chunk
+        finally:
+            self.closed = True
+
+
+def parse_sse(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines.get("event", "message"), json.loads(lines["data"])))
+    return events
+
+
+class AsyncChatStreamTests(TestCase):
+    url = '/api/api_conversation/send_async/'
+
+    def setUp(self):
+        self.llm = ClosingStreamingLLM("The deadline is the first of March.")
+        override_provider("llm", self.llm)
+        self.addCleanup(reset_providers)
+        reset_rate_limits()
+        self.addCleanup(reset_rate_limits)
+        self.user = User.objects.create_user('stream')
+        self.conversation = create_conversation(self.user, "Stream")
+        self.token = Token.objects.create(user=self.user)
+
+    async def test_stream_sends_tokens_and_saves_the_answer(self):
+        response = await AsyncClient().post(self.url, {
+            "user": self.user.id, "conversation": self.conversation.id, "message": "When is the deadline?", "stream": True,
+        }, content_type="application/json", headers={"Authorization": f"Token {self.token.key}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join([part async for part in response.streaming_content]).decode()
+
+        events = parse_sse(body)
+        self.assertEqual([name for name, _ in events], ["start"] + ["message"] * 7 + ["done"])
+        self.assertEqual(events[0][1]["user_message"], "When is the deadline?")
+        self.assertEqual("".join(data["token"] for _, data in events[1:-1]), "The deadline is the first of March.")
+        done = events[-1][1]
+        self.assertEqual(done["assistant_response"], "The deadline is the first of March.")
+        message = await APIMessage.objects.aget(id=done["assistant_message_id"])
+        self.assertEqual((message.role, message.text), ("assistant", done["assistant_response"]))
+
+    async def test_disconnect_closes_the_llm_stream(self):
+        question = "When is the deadline?"
+        message = await APIMessage.objects.acreate(conversation=self.conversation, sender=self.user, role="user", text=question)
+        stream = astream_assistant_response(
+            self.conversation, self.user, message, build_context(question, []), get_answer_cache().lookup([], question),
+        )
+        self.assertIn("event: start", await anext(stream))
+        self.assertIn("The ", await anext(stream))
+        await stream.aclose()  # Lo que hace el servidor cuando el cliente se desconecta
+
+        self.assertTrue(self.llm.closed)
+        # Se conserva la respuesta parcial
+        partial = await APIMessage.objects.filter(conversation=self.conversation, role="assistant").aget()
+        self.assertEqual(partial.text, "The")
+
+    async def test_invalid_corpus_filters_do_not_save_the_message(self):
+        response = await AsyncClient().post(self.url, {
+            "user": self.user.id, "conversation": self.conversation.id, "message": "When is the deadline?",
+            "scope": "corpus", "file_types": [1],
+        }, content_type="application/json", headers={"Authorization": f"Token {self.token.key}"})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(await APIMessage.objects.filter(conversation=self.conversation).aexists())
+
+
+class MetricsViewTests(TestCase):
+    def test_request_id_is_propagated_and_counted(self):
+        response = self.client.get('/api/api_upload/status/', HTTP_X_REQUEST_ID='abc-123')
+        self.assertEqual(response['X-Request-ID'], 'abc-123')
+
+        metrics = self.client.get('/metrics')
+        self.assertEqual(metrics.status_code, 200)
+        body = metrics.content.decode()
+        self.assertIn('rag_http_requests_total{view="api_document_status",method="GET",status="401"}', body)
+        self.assertIn('rag_ingestion_queue_depth{state="pending"} 0', body)
+
+    def test_invalid_request_id_is_replaced(self):
+        response = self.client.get('/metrics', HTTP_X_REQUEST_ID='not valid\n')
+        self.assertRegex(response['X-Request-ID'], r'^[0-9a-f]{32}$')
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+def create_conversation(user, title, messages=0):
+    conversation = APIConversation.objects.create(user=user, title=title)
+    APIMessage.objects.bulk_create([
+        APIMessage(conversation=conversation, sender=user, role='user', text=f"{title} message {i}")
+        for i in range(messages)
+    ])
+    return conversation
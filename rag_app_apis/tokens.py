@@ -0,0 +1,25 @@
+from functools import lru_cache
+import logging
+
+
+@lru_cache(maxsize=1)
+def get_token_encoding():
+    """Returns the tiktoken encoding used by the OpenAI models, or None if it cannot be loaded.
+
+    tiktoken downloads the BPE file on first use; offline hosts without a cached
+    copy fall back to the character estimate instead of retrying on every call.
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning(f"tiktoken no disponible, se estiman los tokens por caracteres: {e}")
+        return None
+
+
+def count_tokens(text):
+    """Counts tokens with tiktoken, falling back to ~4 characters per token."""
+    encoding = get_token_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,88 @@
+"""Per-request trace ids and sampled logging.
+
+TraceMiddleware gives every request a trace id (the incoming X-Request-ID or
+a new one), returns it in the X-Request-ID header and records the request in
+the HTTP metrics. TraceIdFilter adds it to every log record, and the ingestion
+task receives the id of the upload that queued it.
+
+Whether the hot-path messages of a trace are logged is decided once per trace
+(LOG_SAMPLE_RATE), so a sampled request keeps all its lines.
+"""
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+import contextvars
+import logging
+import random
+import re
+import time
+import uuid
+
+_trace = contextvars.ContextVar("trace", default=("-", True))
+
+_VALID_TRACE_ID = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def start_trace(trace_id=None):
+    """Sets the trace id of the current request or task; returns it."""
+    if not trace_id or not _VALID_TRACE_ID.match(trace_id):
+        trace_id = uuid.uuid4().hex
+    _trace.set((trace_id, random.random() < settings.LOG_SAMPLE_RATE))
+    return trace_id
+
+
+def get_trace_id():
+    return _trace.get()[0]
+
+
+def log_sampled(level, message):
+    """Logs a hot-path message only for sampled traces; warnings and errors are always logged."""
+    if level < logging.WARNING and not _trace.get()[1]:
+        return
+    logging.log(level, message)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds record.trace_id for the log format."""
+
+    def filter(self, record):
+        record.trace_id = _trace.get()[0]
+        return True
+
+
+class TraceMiddleware:
+    """Trace id per request plus request count and latency metrics; works under WSGI and ASGI."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        start = self.start(request)
+        response = self.get_response(request)
+        return self.finish(request, response, start)
+
+    async def __acall__(self, request):
+        start = self.start(request)
+        response = await self.get_response(request)
+        return self.finish(request, response, start)
+
+    def start(self, request):
+        request.trace_id = start_trace(request.headers.get("X-Request-ID"))
+        return time.perf_counter()
+
+    def finish(self, request, response, start):
+        from .metrics import HTTP_REQUESTS, HTTP_SECONDS
+
+        # Por nombre de vista y no por URL, para no crear una serie por id
+        match = getattr(request, "resolver_match", None)
+        view = match.view_name if match else "unmatched"
+        HTTP_REQUESTS.inc(view=view, method=request.method, status=response.status_code)
+        HTTP_SECONDS.observe(time.perf_counter() - start, view=view, method=request.method)
+        response["X-Request-ID"] = request.trace_id
+        return response
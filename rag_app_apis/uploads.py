@@ -0,0 +1,214 @@
+"""Single-pass document uploads.
+
+TeeUploadHandler receives the multipart body of the upload view and writes
+every chunk to object storage and to the local copy in media/documents while
+it arrives, hashing and counting it on the way. The view then only records
+names: the file is not read again, uploaded a second time or copied to disk.
+
+Storage writes run in a background thread, so the next chunks of the request
+are read while the previous ones are sent. Storages with an open_upload
+method (GCS and its local stand-in in storage.py) stream the object directly;
+any other Django storage gets the file once it is complete.
+"""
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers
+from .models import APIDocument, VALID_FILE_EXTENSIONS
+from .storage import LocalUploadWriter, unique_filename
+import hashlib
+import io
+import logging
+import os
+import queue
+import tempfile
+import threading
+
+
+class SpooledStorageWriter:
+    """Writer for storages without open_upload: spools the file and saves it when complete."""
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self._file = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+
+    def write(self, data):
+        self._file.write(data)
+
+    def close(self):
+        self._file.seek(0)
+        self.name = self.storage.save(self.name, File(self._file, name=self.name))
+        self._file.close()
+        return self.name
+
+    def abort(self):
+        self._file.close()
+
+
+class BackgroundWriter:
+    """Runs the writes of another writer in a thread, keeping at most max_pending chunks queued."""
+
+    def __init__(self, writer, max_pending):
+        self.writer = writer
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def name(self):
+        return self.writer.name
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            if self._error is None:
+                try:
+                    self.writer.write(data)
+                except Exception as e:
+                    self._error = e
+
+    def write(self, data):
+        if self._error is not None:
+            raise self._error
+        self._queue.put(data)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            self.writer.abort()
+            raise self._error
+        return self.writer.close()
+
+    def abort(self):
+        self._queue.put(None)
+        self._thread.join()
+        self.writer.abort()
+
+
+def open_storage_upload(storage, name, content_type=None):
+    """Returns a writer that streams a new file to storage; close() returns its final name."""
+    if hasattr(storage, 'open_upload'):
+        return storage.open_upload(name, content_type)
+    return SpooledStorageWriter(storage, name)
+
+
+class StreamedUploadedFile(UploadedFile):
+    """A document already stored by TeeUploadHandler; reading it reads the local copy."""
+
+    def __init__(self, file, name, content_type, size, charset, content_type_extra=None,
+                 content_hash=None, storage=None, storage_name=None, local_path=None):
+        super().__init__(file, name, content_type, size, charset, content_type_extra)
+        self.content_hash = content_hash
+        self.storage = storage
+        self.storage_name = storage_name
+        self.local_path = local_path
+
+    def discard(self):
+        """Deletes the stored object and the local copy (rejected or duplicate upload)."""
+        self.close()
+        if self.storage_name:
+            self.storage.delete(self.storage_name)
+        if self.local_path and os.path.exists(self.local_path):
+            os.remove(self.local_path)
+        self.storage_name = self.local_path = None
+
+
+class TeeUploadHandler(FileUploadHandler):
+    """Upload handler that tees the 'document' field to storage and to the local copy in one pass.
+
+    Files with another extension are left to the default handlers, so the
+    view rejects them as before. A file that goes over MAX_UPLOAD_SIZE_MB
+    stops being written and its partial copies are deleted; the rest of the
+    body is only counted, so the view can report the size.
+    """
+
+    field_name = 'document'
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.active = False
+
+    def new_file(self, field_name, file_name, content_type, content_length, charset=None, content_type_extra=None):
+        super().new_file(field_name, file_name, content_type, content_length, charset, content_type_extra)
+        ext = os.path.splitext(file_name)[1].lower()
+        if field_name != self.field_name or ext not in VALID_FILE_EXTENSIONS:
+            return
+
+        field = APIDocument._meta.get_field('file')
+        self.storage = field.storage
+        self.limit = getattr(settings, 'MAX_UPLOAD_SIZE_MB', 10) * 1024 * 1024
+        documents_dir = os.path.join(settings.MEDIA_ROOT, 'documents')
+        self.local_path = os.path.join(documents_dir, unique_filename(file_name))
+        self.local_writer = LocalUploadWriter(self.local_path, self.local_path)
+        # Una parte de GCS en cola mientras se envía la anterior
+        max_pending = max(1, settings.GCS_UPLOAD_CHUNK_SIZE // self.chunk_size)
+        try:
+            self.storage_writer = BackgroundWriter(
+                open_storage_upload(self.storage, field.generate_filename(None, file_name), content_type), max_pending
+            )
+        except Exception:
+            self.local_writer.abort()
+            raise
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.active = True
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+        self.size += len(raw_data)
+        if self.local_writer is None:
+            return None
+        if self.size > self.limit:
+            logging.warning(f"Upload {self.file_name} exceeds {self.limit} bytes, discarding it")
+            self._abort()
+            return None
+        self.digest.update(raw_data)
+        try:
+            self.local_writer.write(raw_data)
+            self.storage_writer.write(raw_data)
+        except Exception:
+            self._abort()
+            raise
+        return None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+        self.active = False
+        if self.local_writer is None:
+            return StreamedUploadedFile(io.BytesIO(), self.file_name, self.content_type, self.size, self.charset,
+                                        self.content_type_extra)
+        try:
+            self.local_writer.close()
+            storage_name = self.storage_writer.close()
+        except Exception as e:
+            logging.error(f"Error storing upload {self.file_name}: {e}", exc_info=True)
+            self._abort()
+            if os.path.exists(self.local_path):
+                os.remove(self.local_path)
+            raise
+        return StreamedUploadedFile(
+            open(self.local_path, 'rb'), self.file_name, self.content_type, self.size, self.charset,
+            self.content_type_extra, content_hash=self.digest.hexdigest(), storage=self.storage,
+            storage_name=storage_name, local_path=self.local_path,
+        )
+
+    def upload_interrupted(self):
+        if self.active and self.local_writer is not None:
+            self._abort()
+
+    def _abort(self):
+        for writer in (self.local_writer, self.storage_writer):
+            try:
+                writer.abort()
+            except Exception as e:
+                logging.warning(f"Error discarding upload {self.file_name}: {e}")
+        self.local_writer = self.storage_writer = None
@@ -1,8 +1,11 @@
 from django.urls import path
-from .views import UploadDocumentView, ConversationHistoryView, SendMessageView
+from .views import UploadDocumentView, DocumentStatusView, ConversationHistoryView, SendMessageView, AsyncSendMessageView, CacheStatsView
 
 urlpatterns = [
     path('api_upload/', UploadDocumentView.as_view(), name='api_upload_document'),
+    path('api_upload/status/', DocumentStatusView.as_view(), name='api_document_status'),
     path('api_conversation/history/', ConversationHistoryView.as_view(), name='api_conversation_history'),
-    path('api_conversation/send/', SendMessageView.as_view(), name='api_send_message')
+    path('api_conversation/send/', SendMessageView.as_view(), name='api_send_message'),
+    path('api_conversation/send_async/', AsyncSendMessageView.as_view(), name='api_send_message_async'),
+    path('api_cache/stats/', CacheStatsView.as_view(), name='api_cache_stats'),
 ]
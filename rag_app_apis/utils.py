@@ -1,195 +1,702 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-import PyPDF2  # Alternative PDF reader
-from langchain.embeddings.openai import OpenAIEmbeddings
-from langchain.vectorstores import Chroma
 import os
-import mmap
 import chardet
+import codecs
+import hashlib
+import re
+from collections import namedtuple
 import logging
 import tracemalloc
-from concurrent.futures import ThreadPoolExecutor
-from .models import APIChunk
-from docx import Document
-import traceback
-
-# Configurar logging
-logging.basicConfig(
-    filename="document_processing.log",
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s"
-)
-
-# Inicializar embeddings de OpenAI
-embedding_model = OpenAIEmbeddings(model="text-embedding-3-small")
-
-# Definir chunking más eficiente
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=10000, chunk_overlap=2000)
-
-# Iniciar medición de memoria
-tracemalloc.start()
+import random
+import threading
+import time
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+from .models import APIChunk, APIDocument, APIEmbedding, APILexicalIndex
+from .vector_index import get_vector_index
+from .lexical_index import LexicalIndexBuilder, get_lexical_index, save_lexical_index
+from .answer_cache import get_answer_cache
+from .corpus_index import get_corpus_index
+from .embedding_codec import FORMAT_FLOAT32, decode_embedding, encode_embedding
+from .cache import LRUCache, RedisCache, QueryEmbeddingCache
+from .pdf_extraction import count_pdf_pages, iter_pdf_pages_parallel
+from .providers import get_embedding_model, get_embedding_model_name, get_llm
+from .tokens import count_tokens
+from .chunking import get_chunker, resolve_chunking_strategy
+from .metrics import CHUNKS, DOCUMENTS, RATE_LIMITED, RESUMED_CHUNKS, Stopwatch, count_model_tokens, observe_stage, timed
+from .tracing import log_sampled
+from .rate_limit import get_embedding_concurrency, get_rate_limiter, is_rate_limit_error
+
+# El logging se configura en settings.LOGGING; los clientes de OpenAI se crean
+# la primera vez que se usan (ver providers.py)
 
 def log_memory_usage():
-    """Muestra las 5 líneas que más memoria consumen."""
+    """Muestra las 5 líneas que más memoria consumen (solo con MEMORY_PROFILING)."""
+    if not tracemalloc.is_tracing():
+        return
     snapshot = tracemalloc.take_snapshot()
     top_stats = snapshot.statistics("lineno")
     logging.info("Top 5 Memory Usage Lines:")
     for stat in top_stats[:5]:
         logging.info(stat)
 
-def process_chunk(index, chunk, document):
-    """Procesa y guarda un chunk en la base de datos."""
-    try:
-        chunk_embedding = embedding_model.embed_documents([chunk])[0]
-        APIChunk.objects.create(document=document, content=chunk, embedding=chunk_embedding)
-        return f"Chunk {index + 1} procesado"
-    except Exception as e:
-        return f"Error en chunk {index + 1}: {e}"
+def make_token_batches(chunks, max_tokens, max_items):
+    """Groups consecutive chunks into (start, end, tokens) ranges bounded by a token budget."""
+    batches = []
+    start, batch_tokens = 0, 0
+    for i, chunk in enumerate(chunks):
+        tokens = count_tokens(chunk)
+        if i > start and (batch_tokens + tokens > max_tokens or i - start >= max_items):
+            batches.append((start, i, batch_tokens))
+            start, batch_tokens = i, 0
+        batch_tokens += tokens
+    if start < len(chunks):
+        batches.append((start, len(chunks), batch_tokens))
+    return batches
+
+def embed_batch(texts, tokens=None, max_retries=None):
+    """Embeds one batch, retrying with exponential backoff and jitter.
+
+    Every attempt first waits for the RPM/TPM limiter and a slot of the
+    adaptive concurrency gate, which shrinks when the API answers 429.
+    """
+    max_retries = max_retries if max_retries is not None else settings.EMBEDDING_MAX_RETRIES
+    tokens = tokens if tokens is not None else sum(count_tokens(text) for text in texts)
+    limiter, gate = get_rate_limiter('embeddings'), get_embedding_concurrency()
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens=tokens)
+        gate.acquire()
+        throttled = False
+        try:
+            with timed('ingest', 'embed_batch'):
+                return get_embedding_model().embed_documents(texts)
+        except Exception as e:
+            throttled = is_rate_limit_error(e)
+            if throttled:
+                RATE_LIMITED.inc(api='embeddings')
+            if attempt == max_retries:
+                raise
+            delay = min(settings.EMBEDDING_RETRY_MAX_DELAY, settings.EMBEDDING_RETRY_BASE_DELAY * 2 ** attempt)
+            delay *= random.uniform(0.5, 1.0)
+            logging.warning(f"Error embedding batch ({len(texts)} chunks), retry {attempt + 1}/{max_retries} in {delay:.1f}s: {e}")
+        finally:
+            gate.release(throttled)
+        time.sleep(delay)
+
+def embed_chunks(chunks, on_progress=None):
+    """Embeds all chunks once, running a bounded number of token-sized batches concurrently."""
+    batches = make_token_batches(chunks, settings.EMBEDDING_BATCH_MAX_TOKENS, settings.EMBEDDING_BATCH_MAX_ITEMS)
+    embeddings = [None] * len(chunks)
+    done = 0
+
+    with ThreadPoolExecutor(max_workers=settings.EMBEDDING_MAX_CONCURRENCY) as executor:
+        futures = {
+            executor.submit(embed_batch, chunks[start:end], tokens): (start, end, tokens)
+            for start, end, tokens in batches
+        }
+        try:
+            for future in as_completed(futures):
+                start, end, tokens = futures[future]
+                # Si un batch agota los reintentos, la excepción cancela la ingesta completa
+                embeddings[start:end] = future.result()
+                count_model_tokens('embedding', tokens)
+                done += end - start
+                logging.debug(f"Batch {start}-{end} embebido ({done}/{len(chunks)} chunks)")
+                if on_progress:
+                    on_progress(done, len(chunks))
+        except BaseException:
+            # Los batches que aún no empezaron no llegan a llamar a la API; solo se esperan los que están en vuelo
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    return embeddings
+
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+def get_query_cache():
+    """Returns the process-wide query embedding cache (memory or Redis, per settings)."""
+    global _query_cache
+    if _query_cache is None:
+        with _query_cache_lock:
+            if _query_cache is None:
+                if settings.QUERY_CACHE_BACKEND == 'redis':
+                    backend = RedisCache(settings.QUERY_CACHE_REDIS_URL, 'rag:query', ttl=settings.QUERY_CACHE_TTL)
+                else:
+                    backend = LRUCache(settings.QUERY_CACHE_MAX_BYTES, ttl=settings.QUERY_CACHE_TTL)
+                _query_cache = QueryEmbeddingCache(backend, get_embedding_model_name())
+    return _query_cache
+
+def _pending_queries(cache, texts, vectors):
+    """Distinct cache misses keyed by cache key (same normalized text = one embedding call)."""
+    pending = {}
+    for text, vector in zip(texts, vectors):
+        if vector is None:
+            pending.setdefault(cache.key(text), text)
+    return pending
+
+def _merge_queries(cache, texts, vectors, pending, embedded):
+    """Stores freshly embedded queries and fills them into the result list."""
+    fresh = {}
+    for key, vector in zip(pending, embedded):
+        cache.set(pending[key], vector)
+        fresh[key] = np.asarray(vector, dtype=np.float32)
+    return [vector if vector is not None else fresh[cache.key(text)] for text, vector in zip(texts, vectors)]
+
+def embed_queries(texts):
+    """Embeds search queries, serving repeated ones from the cache and batching the misses."""
+    cache = get_query_cache()
+    vectors = [cache.get(text) for text in texts]
+    pending = _pending_queries(cache, texts, vectors)
+
+    if pending:
+        tokens = sum(count_tokens(text) for text in pending.values())
+        get_rate_limiter('embeddings').acquire(tokens=tokens)
+        with timed('chat', 'embed_query'):
+            if len(pending) == 1:
+                embedded = [get_embedding_model().embed_query(next(iter(pending.values())))]
+            else:
+                embedded = get_embedding_model().embed_documents(list(pending.values()))
+        count_model_tokens('query_embedding', tokens)
+        vectors = _merge_queries(cache, texts, vectors, pending, embedded)
+
+    return vectors
+
+def embed_query(text):
+    """Embeds a single search query through the query cache."""
+    return embed_queries([text])[0]
+
+async def aembed_queries(texts):
+    """Async version of embed_queries using the async embedding client."""
+    cache = get_query_cache()
+    if cache.is_local:
+        vectors = [cache.get(text) for text in texts]
+    else:
+        # Redis bloquea; se consulta fuera del event loop
+        vectors = await sync_to_async(lambda: [cache.get(text) for text in texts], thread_sensitive=False)()
+    pending = _pending_queries(cache, texts, vectors)
+
+    if pending:
+        tokens = sum(count_tokens(text) for text in pending.values())
+        await get_rate_limiter('embeddings').aacquire(tokens=tokens)
+        with timed('chat', 'embed_query'):
+            if len(pending) == 1:
+                embedded = [await get_embedding_model().aembed_query(next(iter(pending.values())))]
+            else:
+                embedded = await get_embedding_model().aembed_documents(list(pending.values()))
+        count_model_tokens('query_embedding', tokens)
+        if cache.is_local:
+            vectors = _merge_queries(cache, texts, vectors, pending, embedded)
+        else:
+            vectors = await sync_to_async(_merge_queries, thread_sensitive=False)(cache, texts, vectors, pending, embedded)
 
-def try_utf8_read(file_path):
-    """Intenta leer el archivo en UTF-8, y si falla, detecta la codificación."""
+    return vectors
+
+async def aembed_query(text):
+    """Async version of embed_query."""
+    return (await aembed_queries([text]))[0]
+
+# Un fragmento del documento fuente; progress es la fracción del archivo ya leída (0-1)
+# boundary: 'page' o 'heading' cuando el segmento abre una unidad estructural
+TextSegment = namedtuple("TextSegment", ["text", "page", "progress", "boundary"], defaults=[None])
+
+# Encabezados Markdown (# Título) al inicio de una línea
+MARKDOWN_HEADING = re.compile(r"^#{1,6}\s", re.MULTILINE)
+
+def detect_encoding(file_path, sample_size=65536):
+    """Guesses a text file encoding from a sample, preferring UTF-8."""
+    with open(file_path, "rb") as f:
+        raw_data = f.read(sample_size)
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            return f.read().strip(), "utf-8"
+        # final=False tolera un carácter multibyte cortado al final de la muestra
+        codecs.getincrementaldecoder("utf-8")().decode(raw_data, final=False)
+        return "utf-8"
     except UnicodeDecodeError:
         logging.warning(f"Error al leer {file_path} en UTF-8. Intentando detectar encoding...")
-        
-        with open(file_path, "rb") as f:
-            raw_data = f.read(10000)  # Leer muestra para detectar encoding
-            result = chardet.detect(raw_data)
-            encoding = result.get("encoding", "latin1")  # Fallback a latin1 si falla
-
+        encoding = chardet.detect(raw_data).get("encoding") or "latin1"  # Fallback a latin1 si falla
         logging.info(f"Encoding detectado: {encoding}")
+        return encoding
 
-        with open(file_path, "r", encoding=encoding, errors="replace") as f:
-            return f.read().strip(), encoding
+def iter_pdf_pages(file_path, workers=None, total_pages=None):
+    """Yields (page_number, text) for every page, in parallel when the PDF is large enough."""
+    workers = settings.PDF_EXTRACT_WORKERS if workers is None else workers
+    total_pages = total_pages or count_pdf_pages(file_path)
 
-def extract_text(file_path):
-    """Extracts text based on file type."""
-    file_ext = os.path.splitext(file_path)[1].lower()
+    if workers > 1 and total_pages >= settings.PDF_PARALLEL_MIN_PAGES:
+        yield from iter_pdf_pages_parallel(file_path, workers, settings.PDF_PAGES_PER_TASK, total_pages)
+        return
 
-    print(file_ext)
+    import PyPDF2
+    with open(file_path, 'rb') as file:
+        pdf_reader = PyPDF2.PdfReader(file)
+        for number, page in enumerate(pdf_reader.pages, start=1):
+            yield number, page.extract_text() or ""
 
-    try:
-        if file_ext == ".pdf":
-            logging.info(f"Extracting text from PDF: {file_path}")
-            text = ""
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-            return text.strip()
-
-        elif file_ext in [".docx"]:
-            logging.info(f"Extracting text from Word document: {file_path}")
-            doc = Document(file_path)
-            return "\n".join([para.text for para in doc.paragraphs]).strip()
-
-        elif file_ext == ".txt":
-            logging.info(f"Reading text file: {file_path}")
-            return try_utf8_read(file_path)[0]
+def iter_text_segments(file_path, block_size=65536):
+    """Yields the text of a document page by page (PDF), paragraph by paragraph (DOCX) or in blocks (TXT/MD)."""
+    file_ext = os.path.splitext(file_path)[1].lower()
 
-        else:
-            logging.warning(f"Unsupported file type: {file_ext}")
-            return None
+    if file_ext == ".pdf":
+        logging.info(f"Extracting text from PDF: {file_path}")
+        total_pages = count_pdf_pages(file_path)
+        for number, text in iter_pdf_pages(file_path, total_pages=total_pages):
+            yield TextSegment(text + "\n", number, number / total_pages, 'page')
+
+    elif file_ext in [".docx"]:
+        logging.info(f"Extracting text from Word document: {file_path}")
+        from docx import Document
+        paragraphs = Document(file_path).paragraphs
+        for number, para in enumerate(paragraphs, start=1):
+            style = para.style.name if para.style is not None else ""
+            boundary = 'heading' if style.startswith("Heading") or style == "Title" else None
+            yield TextSegment(para.text + "\n", None, number / len(paragraphs), boundary)
+
+    elif file_ext in [".txt", ".md"]:
+        logging.info(f"Reading text file: {file_path}")
+        total_bytes = os.path.getsize(file_path) or 1
+        with open(file_path, "r", encoding=detect_encoding(file_path), errors="replace") as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                progress = min(1.0, f.buffer.tell() / total_bytes)
+                if file_ext != ".md":
+                    yield TextSegment(block, None, progress)
+                    continue
+                # Cada encabezado Markdown abre una sección nueva
+                start, boundary = 0, None
+                for match in MARKDOWN_HEADING.finditer(block):
+                    if match.start() > start:
+                        yield TextSegment(block[start:match.start()], None, progress, boundary)
+                    start, boundary = match.start(), 'heading'
+                yield TextSegment(block[start:], None, progress, boundary)
+
+    else:
+        logging.warning(f"Unsupported file type: {file_ext}")
 
+def extract_text(file_path):
+    """Extracts text based on file type."""
+    try:
+        return "".join(segment.text for segment in iter_text_segments(file_path)).strip() or None
     except Exception as e:
         logging.error(f"Error extracting text from {file_path}: {e}", exc_info=True)
-        traceback.print_exc()
         return None
 
-def process_document(document):
-    """Procesa un documento: lectura, chunking, embedding y almacenamiento."""
-    try:
-        print("Iniciando procesamiento del documento...")
-        
-        if not document.local_path:
-            logging.error(f"No local path found for document: {document.title}")
-            print(f"No local path found for document: {document.title}")
-            return
-            
-        if not os.path.exists(document.local_path):
-            logging.error(f"Local file not found at {document.local_path}")
-            print(f"Local file not found at {document.local_path}")
-            return
-            
-        file_path = document.local_path
-        logging.info(f"Procesando documento: {document.title} ({file_path})")
-        print(f"Using local path: {file_path}")
-        # Extraer texto del documento
-        text = extract_text(file_path)
-
-        if not text or len(text.strip()) == 0:
-            logging.warning(f"Documento '{document.title}' no tiene contenido legible.")
-            print(f"Documento '{document.title}' no tiene contenido legible.")
-            return
+def hash_text(text):
+    """SHA-256 hex digest of a text, used as the content address of chunks."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def hash_file_chunks(chunks):
+    """SHA-256 hex digest of a file given as an iterable of byte chunks."""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
 
-        logging.info(f"Documento leído, longitud: {len(text)} caracteres")
+def find_duplicate_document(content_hash, chunking_strategy, exclude_id=None):
+    """Returns an already processed document with the same file contents, chunking and embedding model, if any."""
+    if not content_hash:
+        return None
+    same_model = APIChunk.objects.filter(document=OuterRef('pk'), embedding_model=get_embedding_model_name())
+    return (
+        APIDocument.objects.filter(
+            content_hash=content_hash, chunking_strategy=chunking_strategy, status=APIDocument.STATUS_COMPLETED
+        )
+        .filter(Exists(same_model))
+        .exclude(id=exclude_id).order_by('id').first()
+    )
+
+def clone_document_chunks(source, document, batch_size=500):
+    """Copies the chunks and embeddings of an identical document instead of re-processing it."""
+    total = 0
+    fields = ['content', 'embedding', 'embedding_format', 'embedding_model', 'embedding_dim', 'content_hash', 'page', 'char_offset', 'token_count', 'ordinal']
+    rows = APIChunk.objects.filter(document=source).order_by('ordinal').values(*fields)
+    batch = []
+    for row in rows.iterator(chunk_size=batch_size):
+        batch.append(APIChunk(document=document, **row))
+        if len(batch) >= batch_size:
+            APIChunk.objects.bulk_create(batch)
+            total += len(batch)
+            batch = []
+    if batch:
+        APIChunk.objects.bulk_create(batch)
+        total += len(batch)
+
+    # Las postings usan la posición del chunk, así que el índice léxico se copia tal cual
+    lexical = APILexicalIndex.objects.filter(document=source).first()
+    if lexical is not None:
+        APILexicalIndex.objects.update_or_create(document=document, defaults={
+            'data': lexical.data, 'chunk_count': lexical.chunk_count, 'term_count': lexical.term_count,
+        })
+    return total
+
+def get_chunk_embeddings(chunks, model_name=None):
+    """Returns (hashes, float32 embedding bytes) for chunks, calling the provider only for unseen texts.
+
+    Embeddings are looked up in the shared APIEmbedding store by (model, chunk hash);
+    the misses are embedded once and added to the store.
+    """
+    model_name = model_name or get_embedding_model_name()
+    hashes = [hash_text(chunk) for chunk in chunks]
+    stored = dict(
+        APIEmbedding.objects.filter(model=model_name, content_hash__in=set(hashes))
+        .values_list('content_hash', 'embedding')
+    )
+
+    missing = {}
+    for content_hash, chunk in zip(hashes, chunks):
+        if content_hash not in stored:
+            missing.setdefault(content_hash, chunk)
+
+    if missing:
+        vectors = embed_chunks(list(missing.values()))
+        new_rows = [
+            APIEmbedding(model=model_name, content_hash=content_hash, embedding=encode_embedding(vector))
+            for content_hash, vector in zip(missing, vectors)
+        ]
+        # Otro worker pudo guardar el mismo chunk en paralelo
+        APIEmbedding.objects.bulk_create(new_rows, batch_size=500, ignore_conflicts=True)
+        stored.update((row.content_hash, row.embedding) for row in new_rows)
+
+    logging.debug(f"Embeddings reutilizados: {len(chunks) - len(missing)}/{len(chunks)} chunks")
+    return hashes, [stored[content_hash] for content_hash in hashes]
+
+def store_chunks(document, pieces, first_ordinal=0, progress=None):
+    """Embeds a window of ChunkPieces and saves them in one bulk insert, numbered from first_ordinal.
+
+    The chunks and the document checkpoint are committed in one transaction, so
+    an interrupted ingestion leaves only whole windows behind.
+    """
+    model_name = get_embedding_model_name()
+    hashes, embeddings = get_chunk_embeddings([piece.text for piece in pieces], model_name)
+    embedding_format = settings.EMBEDDING_STORAGE_FORMAT
+    rows = [
+        APIChunk(
+            document=document,
+            content=piece.text,
+            page=piece.page,
+            char_offset=piece.offset,
+            token_count=piece.token_count,
+            embedding=bytes(embedding) if embedding_format == FORMAT_FLOAT32
+            else encode_embedding(decode_embedding(embedding), embedding_format),
+            embedding_format=embedding_format,
+            embedding_model=model_name,
+            embedding_dim=len(embedding) // 4,
+            content_hash=content_hash,
+            ordinal=first_ordinal + i,
+        )
+        for i, (piece, content_hash, embedding) in enumerate(zip(pieces, hashes, embeddings))
+    ]
+    checkpoint = {'checkpoint_at': timezone.now()}
+    if progress is not None:
+        checkpoint['progress'] = document.progress = progress
+    with timed('ingest', 'db_write'), transaction.atomic():
+        APIChunk.objects.bulk_create(rows, batch_size=500)
+        APIDocument.objects.filter(id=document.id).update(**checkpoint)
+    document.checkpoint_at = checkpoint['checkpoint_at']
+    CHUNKS.inc(len(pieces))
+    return len(pieces)
+
+def load_checkpoint(document):
+    """Content hashes of the chunks committed by an earlier run of the document, by ordinal.
+
+    Windows are committed whole, so the saved chunks are numbered 0..n-1; rows
+    after a gap, without a hash or embedded by another model cannot be reused
+    and are deleted.
+    """
+    model_name = get_embedding_model_name()
+    rows = list(
+        APIChunk.objects.filter(document=document).order_by('ordinal')
+        .values_list('ordinal', 'content_hash', 'embedding_model')
+    )
+    hashes = []
+    for ordinal, content_hash, embedding_model in rows:
+        if ordinal != len(hashes) or not content_hash or embedding_model != model_name:
+            break
+        hashes.append(content_hash)
+    if len(hashes) < len(rows):
+        discard_chunks(document, len(hashes))
+    return hashes
+
+def discard_chunks(document, first_ordinal):
+    """Deletes the chunks of a document from first_ordinal on."""
+    APIChunk.objects.filter(document=document, ordinal__gte=first_ordinal).delete()
+
+def ingest_file(document, file_path, chunker=None, checkpoint=()):
+    """Extracts, splits, embeds and stores a file; returns the number of chunks saved.
+
+    The BM25 postings are accumulated chunk by chunk and saved with the chunks.
+    checkpoint holds the hashes of the chunks an interrupted run already saved
+    (see load_checkpoint): chunks that match are kept instead of embedded again,
+    and the saved ones are discarded from the first mismatch on.
+    """
+    chunker = chunker or get_chunker(document.chunking_strategy or None)
+    lexical = LexicalIndexBuilder()
+    committed = list(checkpoint)
+    window = []
+    total_chunks = 0
+    # Extracción y chunking corren encadenados; se mide el tiempo dentro de cada generador
+    extract, split = Stopwatch(), Stopwatch()
+    for piece, progress in split.wrap(chunker.iter_chunks(extract.wrap(iter_text_segments(file_path)))):
+        lexical.add(piece.text)
+        if total_chunks < len(committed):
+            if hash_text(piece.text) == committed[total_chunks]:
+                total_chunks += 1
+                continue
+            # El archivo o la estrategia de chunking cambiaron desde la corrida anterior
+            logging.warning(f"Documento {document.id}: el chunk {total_chunks} no coincide con el guardado, se descarta desde ahí")
+            discard_chunks(document, total_chunks)
+            committed = committed[:total_chunks]
+        window.append(piece)
+        if len(window) >= settings.INGEST_CHUNK_WINDOW:
+            total_chunks += store_chunks(document, window, total_chunks, progress=int(95 * progress))
+            window = []
+    if window:
+        total_chunks += store_chunks(document, window, total_chunks)
+    if len(committed) > total_chunks:
+        discard_chunks(document, total_chunks)
+    resumed = min(len(committed), total_chunks)
+    if resumed:
+        RESUMED_CHUNKS.inc(resumed)
+        logging.info(f"Documento {document.id} reanudado: {resumed}/{total_chunks} chunks ya estaban guardados")
+    observe_stage('ingest', 'extract', extract.seconds)
+    observe_stage('ingest', 'split', split.seconds - extract.seconds)
+    with timed('ingest', 'lexical_index'):
+        save_lexical_index(document.id, lexical)
+    return total_chunks
+
+# Errores de la API que se resuelven solos (por nombre: openai 0.x/1.x y httpx)
+_TRANSIENT_API_ERRORS = {
+    'APIConnectionError', 'APITimeoutError', 'InternalServerError', 'ServiceUnavailableError',
+    'Timeout', 'ConnectError', 'ReadTimeout', 'RemoteProtocolError',
+}
+
+def is_transient_error(error):
+    """True for failures worth retrying later: rate limits, timeouts, lost connections to the API or the DB."""
+    if is_rate_limit_error(error) or isinstance(error, (OperationalError, InterfaceError, ConnectionError, TimeoutError)):
+        return True
+    return type(error).__name__ in _TRANSIENT_API_ERRORS
+
+def process_document(document, resume=True, raise_transient=False):
+    """Procesa un documento: lectura, chunking, embedding y almacenamiento.
+
+    Extraction, splitting and embedding are chained as generators, so memory is
+    bounded by EXTRACTION_WINDOW_CHARS plus INGEST_CHUNK_WINDOW chunks rather
+    than by the size of the document. A file already processed for any user is
+    not read again: its chunks are copied from the existing document.
+
+    Running it again is safe: with resume the chunks committed by an earlier,
+    interrupted run are verified and kept; without it they are deleted and the
+    document is processed from scratch.
+
+    Errors mark the document as failed. With raise_transient, transient errors
+    (is_transient_error) leave it pending and are raised instead, so the
+    caller can retry it later.
+    """
+    started = time.perf_counter()
+    status = APIDocument.STATUS_FAILED
+    try:
+        logging.info(f"Procesando documento {document.id}: {document.title}")
+        document.set_progress(status=APIDocument.STATUS_PROCESSING, progress=0)
+
+        # Los índices se reconstruyen al final; los chunks ya confirmados se conservan si se reanuda
+        get_vector_index().remove(document.id)
+        get_lexical_index().remove(document.id)
+        get_answer_cache().remove_document(document.id)
+        if not resume:
+            APIChunk.objects.filter(document=document).delete()
+        APILexicalIndex.objects.filter(document=document).delete()
+
+        if not document.chunking_strategy:
+            document.chunking_strategy = resolve_chunking_strategy(document.user_id)
+            document.save(update_fields=['chunking_strategy'])
+
+        source = find_duplicate_document(document.content_hash, document.chunking_strategy, exclude_id=document.id)
+        if source:
+            logging.info(f"Documento '{document.title}' idéntico a {source.id}, copiando chunks")
+            with timed('ingest', 'clone'), transaction.atomic():
+                APIChunk.objects.filter(document=document).delete()
+                total_chunks = clone_document_chunks(source, document)
+        else:
+            if not document.local_path:
+                logging.error(f"No local path found for document: {document.title}")
+                document.set_progress(status=APIDocument.STATUS_FAILED, error="No local path found")
+                return
 
-        # División en chunks
-        chunks = text_splitter.split_text(text)
-        logging.info(f"Documento dividido en {len(chunks)} chunks")
-        print(f"Documento dividido en {len(chunks)} chunks")
+            if not os.path.exists(document.local_path):
+                logging.error(f"Local file not found at {document.local_path}")
+                document.set_progress(status=APIDocument.STATUS_FAILED, error="Local file not found")
+                return
 
-        # Procesamiento en batch
-        batch_size = 10  # Ajustable según rendimiento
-        for i in range(0, len(chunks), batch_size):
-            batch_chunks = chunks[i:i + batch_size]
-            batch_embeddings = embedding_model.embed_documents(batch_chunks)
+            file_path = document.local_path
+            logging.debug(f"Using local path: {file_path}")
 
-            # Guardado en batch
-            APIChunk.objects.bulk_create([
-                APIChunk(document=document, content=batch_chunks[j], embedding=batch_embeddings[j])
-                for j in range(len(batch_chunks))
-            ])
-            print(f"Batch {i//batch_size + 1} procesado")
+            # Extracción -> chunking -> embeddings por ventanas de chunks
+            total_chunks = ingest_file(document, file_path, checkpoint=load_checkpoint(document) if resume else ())
 
-        # Procesamiento paralelo con ThreadPoolExecutor
-        with ThreadPoolExecutor(max_workers=4) as executor:
-            results = list(executor.map(lambda i: process_chunk(i, chunks[i], document), range(len(chunks))))
+        if total_chunks == 0:
+            logging.warning(f"Documento '{document.title}' no tiene contenido legible.")
+            document.set_progress(status=APIDocument.STATUS_FAILED, error="No readable content")
+            return
 
-        # Mostrar resultados de la ejecución
-        for res in results:
-            print(res)
+        # Construir el índice vectorial con los chunks recién guardados
+        APIDocument.objects.filter(id=document.id).update(index_version=F('index_version') + 1)
+        document.refresh_from_db(fields=['index_version'])
+        with timed('ingest', 'vector_index'):
+            get_vector_index().build(document.id, document.index_version)
 
         # Marcar documento como procesado
         document.processed = True
-        document.save()
-        logging.info(f"Documento '{document.title}' procesado con éxito")
-        print(f"Documento '{document.title}' procesado con éxito!")
+        document.status = status = APIDocument.STATUS_COMPLETED
+        document.progress = 100
+        document.error = None
+        document.save(update_fields=['processed', 'status', 'progress', 'error'])
+        get_corpus_index().remove(document.user_id)
+        logging.info(f"Documento '{document.title}' procesado: {total_chunks} chunks en {time.perf_counter() - started:.1f}s")
+        log_memory_usage()
 
     except Exception as e:
+        if raise_transient and is_transient_error(e):
+            logging.warning(f"Error transitorio procesando documento '{document.title}', se reintentará: {e}")
+            status = 'retry'
+            document.set_progress(status=APIDocument.STATUS_PENDING, error=str(e))
+            raise
         logging.error(f"Error procesando documento '{document.title}': {e}", exc_info=True)
-        print(f"Error procesando documento '{document.title}': {e}")
-        traceback.print_exc()
+        document.set_progress(status=APIDocument.STATUS_FAILED, error=str(e))
+
+    finally:
+        observe_stage('ingest', 'total', time.perf_counter() - started)
+        DOCUMENTS.inc(status=status)
+
+
+LLM_ERROR_MESSAGE = "Error processing request. Please try again later."
+
 
+class LLMError(Exception):
+    """Raised by the LLM helpers when the model call fails; the views answer LLM_ERROR_MESSAGE instead."""
 
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import SystemMessage, HumanMessage
+def build_llm_messages(user_input):
+    """Formats the system and user messages sent to the LLM."""
+    from langchain.schema import SystemMessage, HumanMessage
+    return [
+        SystemMessage(content="You are an AI assistant that provides helpful responses."),
+        HumanMessage(content=user_input)
+    ]
 
-# Initialize LLM
-llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.7)
+def _count_llm_tokens(user_input, response_text):
+    count_model_tokens('prompt', count_tokens(user_input))
+    count_model_tokens('completion', count_tokens(response_text))
+
+def _llm_quota_tokens(user_input):
+    """Tokens a chat call takes from the TPM quota: the prompt plus the expected completion."""
+    return count_tokens(user_input) + settings.LLM_COMPLETION_TOKENS_ESTIMATE
+
+def _log_llm_error(e, action):
+    if is_rate_limit_error(e):
+        RATE_LIMITED.inc(api='llm')
+    logging.error(f"Error {action} LLM: {str(e)}", exc_info=True)
 
 def query_llm(user_input):
-    """Handles sending a query to the LLM and returning a response."""
+    """Handles sending a query to the LLM and returning a response; raises LLMError if the call fails."""
     try:
-        logging.info(f"Sending query to LLM: {user_input}")
+        logging.debug(f"Sending query to LLM: {user_input}")
 
         # Format messages
-        messages = [
-            SystemMessage(content="You are an AI assistant that provides helpful responses."),
-            HumanMessage(content=user_input)
-        ]
+        messages = build_llm_messages(user_input)
 
         # Get response from LLM
-        response = llm(messages)
+        get_rate_limiter('llm').acquire(tokens=_llm_quota_tokens(user_input))
+        started = time.perf_counter()
+        with timed('chat', 'llm'):
+            response = get_llm()(messages)
 
         # Extract text response
         response_text = response.content.strip()
 
-        logging.info(f"LLM response: {response_text}")
+        logging.debug(f"LLM response: {response_text}")
+        _count_llm_tokens(user_input, response_text)
+        log_sampled(logging.INFO, f"LLM: {len(user_input)} chars in, {len(response_text)} chars out in {time.perf_counter() - started:.2f}s")
 
         return response_text
 
     except Exception as e:
-        logging.error(f"Error querying LLM: {str(e)}", exc_info=True)
-        return "Error processing request. Please try again later."
\ No newline at end of file
+        _log_llm_error(e, "querying")
+        raise LLMError(str(e)) from e
+
+def stream_llm(user_input):
+    """Yields the LLM answer token by token as it is generated.
+
+    Closing the generator (e.g. when the client disconnects) closes the
+    underlying stream, which stops the generation request. A failed stream
+    raises LLMError after the tokens already yielded.
+    """
+    logging.debug(f"Streaming query to LLM: {user_input}")
+    get_rate_limiter('llm').acquire(tokens=_llm_quota_tokens(user_input))
+    started = time.perf_counter()
+    parts = []
+    token_stream = get_llm().stream(build_llm_messages(user_input))
+    try:
+        for chunk in token_stream:
+            if chunk.content:
+                if not parts:
+                    observe_stage('chat', 'llm_first_token', time.perf_counter() - started)
+                parts.append(chunk.content)
+                yield chunk.content
+    except Exception as e:
+        _log_llm_error(e, "streaming from")
+        raise LLMError(str(e)) from e
+    finally:
+        token_stream.close()
+        _finish_llm_stream(user_input, parts, started)
+
+async def aquery_llm(user_input):
+    """Async version of query_llm; the request waits on the event loop instead of a thread."""
+    try:
+        logging.debug(f"Sending async query to LLM: {user_input}")
+        await get_rate_limiter('llm').aacquire(tokens=_llm_quota_tokens(user_input))
+        started = time.perf_counter()
+        with timed('chat', 'llm'):
+            response = await get_llm().ainvoke(build_llm_messages(user_input))
+        response_text = response.content.strip()
+        logging.debug(f"LLM response: {response_text}")
+        _count_llm_tokens(user_input, response_text)
+        log_sampled(logging.INFO, f"LLM: {len(user_input)} chars in, {len(response_text)} chars out in {time.perf_counter() - started:.2f}s")
+        return response_text
+
+    except Exception as e:
+        _log_llm_error(e, "querying")
+        raise LLMError(str(e)) from e
+
+async def astream_llm(user_input):
+    """Async version of stream_llm."""
+    logging.debug(f"Streaming async query to LLM: {user_input}")
+    await get_rate_limiter('llm').aacquire(tokens=_llm_quota_tokens(user_input))
+    started = time.perf_counter()
+    parts = []
+    token_stream = get_llm().astream(build_llm_messages(user_input))
+    try:
+        async for chunk in token_stream:
+            if chunk.content:
+                if not parts:
+                    observe_stage('chat', 'llm_first_token', time.perf_counter() - started)
+                parts.append(chunk.content)
+                yield chunk.content
+    except Exception as e:
+        _log_llm_error(e, "streaming from")
+        raise LLMError(str(e)) from e
+    finally:
+        await token_stream.aclose()
+        _finish_llm_stream(user_input, parts, started)
+
+def _finish_llm_stream(user_input, parts, started):
+    """Records a finished (or cancelled) stream: total time and the tokens actually generated."""
+    elapsed = time.perf_counter() - started
+    observe_stage('chat', 'llm', elapsed)
+    response_text = "".join(parts)
+    _count_llm_tokens(user_input, response_text)
+    logging.debug(f"LLM response: {response_text}")
+    log_sampled(logging.INFO, f"LLM stream: {len(parts)} chunks, {len(response_text)} chars in {elapsed:.2f}s")
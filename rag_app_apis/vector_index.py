@@ -0,0 +1,190 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+from .models import APIChunk
+from .embedding_codec import decode_matrix
+from .cache import DocumentMatrixCache, LRUCache, RedisMatrixStore
+from .providers import get_embedding_model_name
+import numpy as np
+import threading
+import logging
+
+try:
+    import hnswlib  # Backend ANN opcional
+except ImportError:
+    hnswlib = None
+
+
+def normalize_rows(matrix):
+    """Returns float32 rows scaled to unit length so a dot product is the cosine similarity."""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.ndim == 1:
+        matrix = matrix.reshape(1, -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def load_document_vectors(document_id):
+    """Reads chunk ids and embeddings of a document from the database.
+
+    Only chunks embedded by the current model are read: a query vector is never
+    compared with vectors of another model.
+    """
+    rows = list(
+        APIChunk.objects.filter(document_id=document_id, embedding_model=get_embedding_model_name()).order_by('ordinal')
+        .values_list('id', 'embedding', 'embedding_format')
+    )
+    if not rows:
+        if APIChunk.objects.filter(document_id=document_id).exists():
+            logging.warning(f"Documento {document_id} embebido con otro modelo; hay que reindexarlo (manage.py resume_ingestion --outdated-embeddings)")
+        return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+    ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+    return ids, normalize_rows(decode_matrix([row[1] for row in rows], [row[2] for row in rows]))
+
+
+class VectorIndex:
+    """Per-document vector index kept in step with the APIChunk rows.
+
+    Entries are tagged with ``APIDocument.index_version``; a search with a newer
+    version reloads the document from the database, so processes that did not run
+    the ingestion never serve stale vectors.
+    """
+
+    def build(self, document_id, version=0):
+        """(Re)builds the index of a document from the database."""
+        ids, vectors = load_document_vectors(document_id)
+        entry = self._put(document_id, version, ids, vectors)
+        logging.info(f"Índice vectorial construido para documento {document_id}: {len(ids)} chunks")
+        return entry
+
+    def search(self, document_id, query_embedding, top_k=3, version=0):
+        """Returns up to top_k (chunk_id, score) pairs ordered by cosine similarity."""
+        entry = self._get(document_id, version)
+        if entry is None:
+            entry = self.build(document_id, version)
+        query = normalize_rows(query_embedding)[0]
+        return self._search(entry, query, top_k)
+
+    def remove(self, document_id):
+        """Drops a document from the index."""
+        self._drop(document_id)
+
+    def stats(self):
+        """Returns the cache counters of the backend."""
+        return {}
+
+    # Métodos que implementa cada backend
+    def _get(self, document_id, version):
+        raise NotImplementedError
+
+    def _put(self, document_id, version, ids, vectors):
+        raise NotImplementedError
+
+    def _drop(self, document_id):
+        raise NotImplementedError
+
+    def _search(self, entry, query, top_k):
+        raise NotImplementedError
+
+
+class NumpyVectorIndex(VectorIndex):
+    """Exact search over one contiguous float32 matrix per document.
+
+    Matrices live in a DocumentMatrixCache bounded by DOCUMENT_CACHE_MAX_BYTES,
+    optionally shared between processes through Redis.
+    """
+
+    def __init__(self, max_bytes=None, redis_url=None):
+        max_bytes = max_bytes or getattr(settings, 'DOCUMENT_CACHE_MAX_BYTES', 256 * 1024 * 1024)
+        redis_url = redis_url or getattr(settings, 'DOCUMENT_CACHE_REDIS_URL', None)
+        shared = RedisMatrixStore(redis_url) if redis_url else None
+        self.cache = DocumentMatrixCache(max_bytes, shared=shared)
+
+    def _get(self, document_id, version):
+        return self.cache.get(document_id, version)
+
+    def _put(self, document_id, version, ids, vectors):
+        entry = (ids, np.ascontiguousarray(vectors, dtype=np.float32))
+        self.cache.put(document_id, version, *entry)
+        return entry
+
+    def _drop(self, document_id):
+        self.cache.invalidate(document_id)
+
+    def _search(self, entry, query, top_k):
+        ids, vectors = entry
+        if len(ids) == 0:
+            return []
+        scores = vectors @ query
+        k = min(top_k, len(ids))
+        # argpartition es O(n); solo se ordenan los k mejores
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class HNSWVectorIndex(VectorIndex):
+    """Approximate search with one hnswlib graph per document."""
+
+    def __init__(self, ef_construction=200, m=16, ef_search=64, max_bytes=None):
+        if hnswlib is None:
+            raise ImproperlyConfigured("VECTOR_INDEX_BACKEND 'hnsw' requires the hnswlib package.")
+        self.ef_construction = ef_construction
+        self.m = m
+        self.ef_search = ef_search
+        self.graphs = LRUCache(max_bytes or getattr(settings, 'DOCUMENT_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+
+    def _get(self, document_id, version):
+        return self.graphs.get((document_id, version))
+
+    def _put(self, document_id, version, ids, vectors):
+        graph = None
+        if len(ids):
+            graph = hnswlib.Index(space='ip', dim=vectors.shape[1])  # Vectores normalizados: producto interno = coseno
+            graph.init_index(max_elements=len(ids), ef_construction=self.ef_construction, M=self.m)
+            graph.set_ef(self.ef_search)
+            graph.add_items(vectors, ids)
+        # Vectores más los enlaces del grafo (~2*M por nodo)
+        size = vectors.nbytes + len(ids) * (8 + 2 * self.m * 4)
+        self.graphs.discard(lambda key: key[0] == document_id)
+        self.graphs.set((document_id, version), graph, size)
+        return graph
+
+    def _drop(self, document_id):
+        self.graphs.discard(lambda key: key[0] == document_id)
+
+    def _search(self, graph, query, top_k):
+        if graph is None:
+            return []
+        k = min(top_k, graph.get_current_count())
+        labels, distances = graph.knn_query(query, k=k)
+        # hnswlib devuelve 1 - producto interno como distancia
+        return [(int(label), float(1.0 - distance)) for label, distance in zip(labels[0], distances[0])]
+
+    def stats(self):
+        return self.graphs.stats()
+
+
+VECTOR_INDEX_BACKENDS = {
+    'numpy': NumpyVectorIndex,
+    'hnsw': HNSWVectorIndex,
+}
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_vector_index():
+    """Returns the process-wide index selected by settings.VECTOR_INDEX_BACKEND."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                backend = getattr(settings, 'VECTOR_INDEX_BACKEND', 'numpy')
+                index_class = VECTOR_INDEX_BACKENDS.get(backend) or import_string(backend)
+                _index = index_class(**getattr(settings, 'VECTOR_INDEX_OPTIONS', {}))
+    return _index
@@ -3,82 +3,187 @@ from rest_framework.response import Response
 from rest_framework import status, permissions
 from django.contrib.auth.models import User
 from django.shortcuts import get_object_or_404
-from .models import APIDocument, APIConversation, APIMessage
-from .serializers import DocumentSerializer, MessageSerializer, ConversationSerializer
-from .utils import process_document, query_llm
-from .retriever import retrieve_relevant_chunks
+from django.db.models import Prefetch
+from django.core.exceptions import ValidationError
+from .models import APIDocument, APIConversation, APIMessage, validate_file_extension, validate_file_size
+from .serializers import DocumentStatusSerializer, ConversationSerializer, ConversationHistorySerializer
+from .pagination import ConversationCursorPagination
+from .utils import hash_file_chunks, find_duplicate_document, query_llm, stream_llm, aquery_llm, astream_llm, get_query_cache
+from .utils import LLM_ERROR_MESSAGE, LLMError
+from .chunking import resolve_chunking_strategy
+from .tasks import enqueue_document
+from .retriever import retrieve_relevant_chunks, aretrieve_relevant_chunks, retrieve_corpus_chunks, aretrieve_corpus_chunks
+from .context_builder import build_context
+from .vector_index import get_vector_index
+from .lexical_index import get_lexical_index
+from .corpus_index import get_corpus_index
+from .answer_cache import get_answer_cache
+from .metrics import CONTENT_TYPE, render_metrics, timed
+from .uploads import StreamedUploadedFile, TeeUploadHandler
 import logging
+import json
 import os
 from django.conf import settings
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views import View
+from django.utils.dateparse import parse_date, parse_datetime
+from rest_framework.authtoken.models import Token
 
 
 # Upload Document API
 class UploadDocumentView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
+    def initialize_request(self, request, *args, **kwargs):
+        # El handler se instala antes de que se lea el cuerpo de la petición
+        if settings.UPLOAD_STREAMING:
+            request.upload_handlers.insert(0, TeeUploadHandler(request))
+        return super().initialize_request(request, *args, **kwargs)
+
     def post(self, request):
         if 'document' not in request.FILES:
             return Response({"error": "No file provided"}, status=status.HTTP_400_BAD_REQUEST)
 
         uploaded_file = request.FILES["document"]
         document_name = uploaded_file.name
+        # Subida en una sola pasada: el archivo ya está en el storage y en disco, con su hash
+        streamed = isinstance(uploaded_file, StreamedUploadedFile)
+
+        def reject(message, code):
+            if streamed:
+                uploaded_file.discard()
+            return Response({"error": message}, status=code)
+
+        try:
+            validate_file_extension(uploaded_file)
+            validate_file_size(uploaded_file)
+        except ValidationError as e:
+            return reject(e.messages[0], status.HTTP_400_BAD_REQUEST)
 
         # Get user ID from the request body
         user_id = request.data.get("user")
         if not user_id:
-            return Response({"error": "User ID is required"}, status=status.HTTP_400_BAD_REQUEST)
+            return reject("User ID is required", status.HTTP_400_BAD_REQUEST)
 
         try:
             user = get_object_or_404(User, id=user_id)
-        except User.DoesNotExist:
-            return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
-
-        # Create conversation
-        conversation = APIConversation.objects.create(user=user, title=document_name.split('.')[0])
-
-        # Save document using the storage backend (GCS)
-        document = APIDocument.objects.create(
-            user=user,
-            file=uploaded_file,  # This will use the configured storage backend
-            title=document_name.split('.')[0],
-            conversation=conversation
-        )
+        except Http404:
+            if streamed:
+                uploaded_file.discard()
+            raise
 
-        # Save file locally in media/documents
-        media_root = getattr(settings, 'MEDIA_ROOT', 'media')
-        documents_dir = os.path.join(media_root, 'documents')
-        os.makedirs(documents_dir, exist_ok=True)
-
-        local_path = os.path.join(documents_dir, document.file.name.split('/')[-1])
-
-        with open(local_path, 'wb+') as destination:
-            for chunk in uploaded_file.chunks():
-                destination.write(chunk)
+        # Estrategia de chunking: la pedida en la subida, la del usuario o la por defecto
+        try:
+            chunking_strategy = resolve_chunking_strategy(user.id, request.data.get("chunking_strategy"))
+        except ValueError as e:
+            return reject(str(e), status.HTTP_400_BAD_REQUEST)
 
-        # Store local path in document model
-        document.local_path = local_path
-        document.save()
+        # Hash del contenido: si el mismo archivo ya fue procesado, no se procesa de nuevo
+        content_hash = uploaded_file.content_hash if streamed else hash_file_chunks(uploaded_file.chunks())
+        duplicate = find_duplicate_document(content_hash, chunking_strategy)
+        # Los chunks y embeddings se copian de cualquier usuario, pero el archivo solo se comparte
+        # con documentos del mismo usuario: otro usuario podría borrar el suyo
+        shared_file = duplicate if duplicate and duplicate.user_id == user.id else None
 
-        # Process document asynchronously
-        process_document(document)
+        # Create conversation
+        conversation = APIConversation.objects.create(user=user, title=document_name.split('.')[0])
 
-        # Save system message
-        APIMessage.objects.create(
-            conversation=conversation,
-            sender=user,
-            text=f"Documento '{document_name}' procesado y listo para consultas."
-        )
+        if shared_file:
+            # Reutilizar el archivo ya almacenado; el worker copiará sus chunks y embeddings.
+            # En una sola pasada el hash se conoce cuando el archivo ya se subió: esa copia sobra
+            if streamed:
+                uploaded_file.discard()
+            document = APIDocument.objects.create(
+                user=user,
+                file=shared_file.file.name,
+                local_path=shared_file.local_path,
+                title=document_name.split('.')[0],
+                conversation=conversation,
+                content_hash=content_hash,
+                chunking_strategy=chunking_strategy,
+                file_type=os.path.splitext(document_name)[1].lower().lstrip('.'),
+            )
+            local_path = document.local_path
+        elif streamed:
+            uploaded_file.close()
+            local_path = uploaded_file.local_path
+            document = APIDocument.objects.create(
+                user=user,
+                file=uploaded_file.storage_name,
+                local_path=local_path,
+                title=document_name.split('.')[0],
+                conversation=conversation,
+                content_hash=content_hash,
+                chunking_strategy=chunking_strategy,
+                file_type=os.path.splitext(document_name)[1].lower().lstrip('.'),
+            )
+        else:
+            # Save document using the storage backend (GCS)
+            document = APIDocument.objects.create(
+                user=user,
+                file=uploaded_file,  # This will use the configured storage backend
+                title=document_name.split('.')[0],
+                conversation=conversation,
+                content_hash=content_hash,
+                chunking_strategy=chunking_strategy,
+                file_type=os.path.splitext(document_name)[1].lower().lstrip('.'),
+            )
+
+            # Save file locally in media/documents
+            media_root = getattr(settings, 'MEDIA_ROOT', 'media')
+            documents_dir = os.path.join(media_root, 'documents')
+            os.makedirs(documents_dir, exist_ok=True)
+
+            local_path = os.path.join(documents_dir, document.file.name.split('/')[-1])
+
+            with open(local_path, 'wb+') as destination:
+                for chunk in uploaded_file.chunks():
+                    destination.write(chunk)
+
+            # Store local path in document model
+            document.local_path = local_path
+            document.save()
+
+        # Encolar el procesamiento; el worker guarda el mensaje del sistema al terminar
+        job_id = enqueue_document(document)
+        document.refresh_from_db(fields=['status', 'progress'])
 
         return Response({
             "success": True,
-            "response": f"Documento '{document_name}' subido y procesado.",
+            "response": f"Documento '{document_name}' recibido, procesamiento en cola.",
             "conversation_id": conversation.id,
+            "document_id": document.id,
+            "job_id": job_id,
+            "status": document.status,
+            "progress": document.progress,
+            "deduplicated": shared_file is not None,  # Solo documentos propios: no revela subidas de otros usuarios
+            "chunking_strategy": chunking_strategy,
             "file_url": document.file.url,  # GCS URL
             "local_path": local_path  # Local file path
-        }, status=status.HTTP_201_CREATED)
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class DocumentStatusView(APIView):
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        user_id = request.query_params.get("user")
+        document_id = request.query_params.get("document")
+
+        if not user_id or not document_id:
+            return Response({"error": "User ID and Document ID are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        document = get_object_or_404(APIDocument, id=document_id, user_id=user_id)
+        serializer = DocumentStatusSerializer(document)
+        return Response(serializer.data, status=status.HTTP_200_OK)
 
 
 class ConversationHistoryView(APIView):
+    """Paginated conversations of a user, newest first.
+
+    Query params: user, cursor and page_size (see ConversationCursorPagination),
+    and messages=N to embed the N latest messages of each conversation.
+    """
     permission_classes = [permissions.IsAuthenticated]
 
     def get(self, request):
@@ -89,14 +194,123 @@ class ConversationHistoryView(APIView):
             return Response({"error": "User ID is required"}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            user = get_object_or_404(User, id=user_id)
-        except User.DoesNotExist:
-            return Response({"error": "User not found"}, status=status.HTTP_404_NOT_FOUND)
-
-        # Retrieve conversations for the specified user
-        conversations = APIConversation.objects.filter(user=user).order_by("-created_at")
-        serializer = ConversationSerializer(conversations, many=True)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+            message_count = min(int(request.query_params.get("messages", 0)), settings.HISTORY_MAX_MESSAGES)
+        except ValueError:
+            return Response({"error": "messages must be an integer"}, status=status.HTTP_400_BAD_REQUEST)
+
+        user = get_object_or_404(User.objects.only("id"), id=user_id)
+
+        # Solo las columnas que se serializan
+        conversations = APIConversation.objects.filter(user=user).only("id", "user_id", "title", "created_at")
+        serializer_class = ConversationSerializer
+        if message_count > 0:
+            # Los últimos mensajes de todas las conversaciones de la página en una sola consulta
+            latest = APIMessage.objects.only(
+                "id", "conversation_id", "sender_id", "role", "text", "timestamp"
+            ).order_by("-timestamp", "-id")[:message_count]
+            conversations = conversations.prefetch_related(Prefetch("messages_api", queryset=latest, to_attr="latest_messages"))
+            serializer_class = ConversationHistorySerializer
+
+        paginator = ConversationCursorPagination()
+        page = paginator.paginate_queryset(conversations, request, view=self)
+        serializer = serializer_class(page, many=True)
+        return paginator.get_paginated_response(serializer.data)
+
+
+def corpus_filters(data):
+    """Reads the corpus retrieval filters of a chat request; raises ValueError on invalid values."""
+    filters = {}
+    documents = data.get("documents")
+    if documents:
+        values = documents if isinstance(documents, list) else str(documents).split(",")
+        try:
+            filters["document_ids"] = [int(value) for value in values]
+        except (TypeError, ValueError):
+            raise ValueError("documents must be a list of document IDs")
+    for key in ("uploaded_after", "uploaded_before"):
+        value = data.get(key)
+        if value:
+            parsed = parse_datetime(str(value)) or parse_date(str(value))
+            if parsed is None:
+                raise ValueError(f"Invalid date for {key}: {value}")
+            filters[key] = parsed
+    file_types = data.get("file_types")
+    if file_types:
+        values = file_types if isinstance(file_types, list) else str(file_types).split(",")
+        if not all(isinstance(value, str) for value in values):
+            raise ValueError("file_types must be a list of file extensions")
+        filters["file_types"] = [value.strip().lower().lstrip(".") for value in values]
+    return filters
+
+
+def wants_corpus(data):
+    """True when the chat should search the user's documents instead of the conversation's one."""
+    return data.get("scope") == "corpus" or bool(data.get("documents"))
+
+
+async def aiter_answer(answer):
+    yield answer
+
+
+def sse_event(data, event=None):
+    """Formats one Server-Sent Event."""
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_assistant_response(conversation, user, message, context, lookup):
+    """Streams LLM tokens as SSE and saves the assistant message when the stream ends.
+
+    If the client disconnects the server closes this generator, which closes
+    the LLM stream and stops the generation; the partial answer is kept. A
+    cached answer is sent as a single token. If the LLM fails, LLM_ERROR_MESSAGE
+    is sent as the last token and the answer is not cached.
+    """
+    tokens = []
+    if lookup.answer is not None:
+        token_stream = (token for token in [lookup.answer])
+    else:
+        token_stream = stream_llm(context.prompt)
+    completed = failed = False
+    try:
+        yield sse_event({
+            "conversation_id": conversation.id,
+            "user_message": message.text,
+            "context_tokens": context.context_tokens,
+            "prompt_tokens": context.prompt_tokens,
+            "cached": lookup.answer is not None,
+        }, event="start")
+        try:
+            for token in token_stream:
+                tokens.append(token)
+                yield sse_event({"token": token})
+            completed = True
+        except LLMError:
+            failed = True
+            tokens.append(LLM_ERROR_MESSAGE)
+            yield sse_event({"token": LLM_ERROR_MESSAGE})
+    finally:
+        token_stream.close()
+        text = "".join(tokens).strip()
+        assistant_message = None
+        if text:
+            assistant_message = APIMessage.objects.create(
+                conversation=conversation,
+                sender=user,
+                role="assistant",
+                text=text
+            )
+        if completed:
+            get_answer_cache().store(lookup, text)  # Solo respuestas completas
+        elif not failed:
+            logging.info(f"Cliente desconectado, generación detenida en la conversación {conversation.id}")
+
+    yield sse_event({
+        "user_id": user.id,
+        "conversation_id": conversation.id,
+        "assistant_message_id": assistant_message.id if assistant_message else None,
+        "assistant_response": text,
+    }, event="done")
 
 
 class SendMessageView(APIView):
@@ -119,6 +333,14 @@ class SendMessageView(APIView):
         if not user_message:
             return Response({"error": "Message cannot be empty"}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Validar los filtros antes de guardar nada: un 400 no deja el mensaje del usuario huérfano
+        filters = None
+        if wants_corpus(request.data):
+            try:
+                filters = corpus_filters(request.data)
+            except ValueError as e:
+                return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
         # Guardar mensaje del usuario
         message = APIMessage.objects.create(
             conversation=conversation,
@@ -127,19 +349,42 @@ class SendMessageView(APIView):
             text=user_message
         )
 
-        # Recuperar chunks relevantes
-        relevant_chunks = retrieve_relevant_chunks(user_message, conversation, top_k=3)
-
-        # Formatear prompt
-        context_text = "\n\n".join([
-            f"Document: {c['document']}\nChunk {c['chunk_id']}:\n{c['content']}" 
-            for c in relevant_chunks
-        ]) if relevant_chunks else "No context available."
-
-        prompt = f"Context:\n{context_text}\n\nUser Query: {user_message}"
+        # Recuperar chunks relevantes: del documento de la conversación o de todo el corpus del usuario
+        if filters is not None:
+            with timed('chat', 'retrieve'):
+                relevant_chunks, query_embedding = retrieve_corpus_chunks(user_message, user.id, top_k=settings.CONTEXT_CANDIDATES, **filters)
+        else:
+            with timed('chat', 'retrieve'):
+                relevant_chunks, query_embedding = retrieve_relevant_chunks(user_message, conversation, top_k=settings.CONTEXT_CANDIDATES)
+
+        # Armar el prompt dentro del presupuesto de tokens
+        with timed('chat', 'context'):
+            context = build_context(user_message, relevant_chunks)
+
+        # Misma pregunta (o casi) sobre los mismos chunks: se reutiliza la respuesta sin llamar al LLM.
+        # Se compara con el embedding que ya calculó la recuperación
+        with timed('chat', 'answer_cache'):
+            lookup = get_answer_cache().lookup(relevant_chunks, user_message, query_embedding)
+
+        # Modo streaming: los tokens se envían como Server-Sent Events a medida que llegan
+        if str(request.data.get("stream", request.query_params.get("stream", ""))).lower() in ("1", "true"):
+            response = StreamingHttpResponse(
+                stream_assistant_response(conversation, user, message, context, lookup),
+                content_type="text/event-stream",
+            )
+            response["Cache-Control"] = "no-cache"
+            response["X-Accel-Buffering"] = "no"  # Evita que nginx acumule la respuesta
+            return response
 
         # Consultar al LLM
-        llm_response = query_llm(prompt)
+        llm_response = lookup.answer
+        if llm_response is None:
+            try:
+                llm_response = query_llm(context.prompt)
+            except LLMError:
+                llm_response = LLM_ERROR_MESSAGE  # El error no se guarda en el caché
+            else:
+                get_answer_cache().store(lookup, llm_response)
 
         # Guardar respuesta del asistente
         assistant_message = APIMessage.objects.create(
@@ -153,5 +398,184 @@ class SendMessageView(APIView):
             "user_id": user.id,
             "conversation_id": conversation.id,
             "user_message": message.text,
-            "assistant_response": assistant_message.text
+            "assistant_response": assistant_message.text,
+            "context_tokens": context.context_tokens,
+            "prompt_tokens": context.prompt_tokens,
+            "cached": lookup.answer is not None,
         }, status=status.HTTP_200_OK)
+
+
+async def astream_assistant_response(conversation, user, message, context, lookup):
+    """Async version of stream_assistant_response for the ASGI chat view."""
+    tokens = []
+    token_stream = aiter_answer(lookup.answer) if lookup.answer is not None else astream_llm(context.prompt)
+    completed = failed = False
+    try:
+        yield sse_event({
+            "conversation_id": conversation.id,
+            "user_message": message.text,
+            "context_tokens": context.context_tokens,
+            "prompt_tokens": context.prompt_tokens,
+            "cached": lookup.answer is not None,
+        }, event="start")
+        try:
+            async for token in token_stream:
+                tokens.append(token)
+                yield sse_event({"token": token})
+            completed = True
+        except LLMError:
+            failed = True
+            tokens.append(LLM_ERROR_MESSAGE)
+            yield sse_event({"token": LLM_ERROR_MESSAGE})
+    finally:
+        await token_stream.aclose()
+        text = "".join(tokens).strip()
+        assistant_message = None
+        if text:
+            assistant_message = await APIMessage.objects.acreate(
+                conversation=conversation,
+                sender=user,
+                role="assistant",
+                text=text
+            )
+        if completed:
+            get_answer_cache().store(lookup, text)  # Solo respuestas completas
+        elif not failed:
+            logging.info(f"Cliente desconectado, generación detenida en la conversación {conversation.id}")
+
+    yield sse_event({
+        "user_id": user.id,
+        "conversation_id": conversation.id,
+        "assistant_message_id": assistant_message.id if assistant_message else None,
+        "assistant_response": text,
+    }, event="done")
+
+
+class AsyncSendMessageView(View):
+    """ASGI version of SendMessageView.
+
+    DRF's APIView is sync-only, so token authentication and body parsing are
+    done here directly; the same request/response contract as SendMessageView
+    is kept. Embedding, retrieval and the LLM call are awaited, so a single
+    ASGI worker can hold many chats in flight.
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True  # Autenticación por token, igual que las vistas de DRF
+        return view
+
+    async def authenticate(self, request):
+        auth = request.headers.get("Authorization", "").split()
+        if len(auth) != 2 or auth[0].lower() != "token":
+            return None
+        token = await Token.objects.select_related("user").filter(key=auth[1]).afirst()
+        if token is None or not token.user.is_active:
+            return None
+        return token.user
+
+    async def post(self, request):
+        if await self.authenticate(request) is None:
+            return JsonResponse({"detail": "Authentication credentials were not provided."}, status=status.HTTP_401_UNAUTHORIZED)
+
+        try:
+            data = json.loads(request.body or b"{}")
+        except ValueError:
+            return JsonResponse({"error": "Invalid JSON body"}, status=status.HTTP_400_BAD_REQUEST)
+
+        user_id = data.get("user")
+        conversation_id = data.get("conversation")
+
+        if not user_id or not conversation_id:
+            return JsonResponse({"error": "User ID and Conversation ID are required"}, status=status.HTTP_400_BAD_REQUEST)
+
+        user = await User.objects.filter(id=user_id).afirst()
+        conversation = await APIConversation.objects.filter(id=conversation_id, user_id=user_id).afirst() if user else None
+        if conversation is None:
+            return JsonResponse({"detail": "Not found."}, status=status.HTTP_404_NOT_FOUND)
+
+        user_message = data.get("message")
+        if not user_message:
+            return JsonResponse({"error": "Message cannot be empty"}, status=status.HTTP_400_BAD_REQUEST)
+
+        filters = None
+        if wants_corpus(data):
+            try:
+                filters = corpus_filters(data)
+            except ValueError as e:
+                return JsonResponse({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        message = await APIMessage.objects.acreate(
+            conversation=conversation,
+            sender=user,
+            role="user",
+            text=user_message
+        )
+
+        if filters is not None:
+            with timed('chat', 'retrieve'):
+                relevant_chunks, query_embedding = await aretrieve_corpus_chunks(user_message, user.id, top_k=settings.CONTEXT_CANDIDATES, **filters)
+        else:
+            with timed('chat', 'retrieve'):
+                relevant_chunks, query_embedding = await aretrieve_relevant_chunks(user_message, conversation, top_k=settings.CONTEXT_CANDIDATES)
+        with timed('chat', 'context'):
+            context = build_context(user_message, relevant_chunks)
+        with timed('chat', 'answer_cache'):
+            lookup = get_answer_cache().lookup(relevant_chunks, user_message, query_embedding)
+
+        if str(data.get("stream", request.GET.get("stream", ""))).lower() in ("1", "true"):
+            response = StreamingHttpResponse(
+                astream_assistant_response(conversation, user, message, context, lookup),
+                content_type="text/event-stream",
+            )
+            response["Cache-Control"] = "no-cache"
+            response["X-Accel-Buffering"] = "no"
+            return response
+
+        llm_response = lookup.answer
+        if llm_response is None:
+            try:
+                llm_response = await aquery_llm(context.prompt)
+            except LLMError:
+                llm_response = LLM_ERROR_MESSAGE  # El error no se guarda en el caché
+            else:
+                get_answer_cache().store(lookup, llm_response)
+
+        assistant_message = await APIMessage.objects.acreate(
+            conversation=conversation,
+            sender=user,
+            role="assistant",
+            text=llm_response
+        )
+
+        return JsonResponse({
+            "user_id": user.id,
+            "conversation_id": conversation.id,
+            "user_message": message.text,
+            "assistant_response": assistant_message.text,
+            "context_tokens": context.context_tokens,
+            "prompt_tokens": context.prompt_tokens,
+            "cached": lookup.answer is not None,
+        }, status=status.HTTP_200_OK)
+
+
+class CacheStatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        # Contadores del caché de matrices por documento, para dimensionarlo
+        return Response({
+            "document_cache": get_vector_index().stats(),
+            "lexical_cache": get_lexical_index().stats(),
+            "corpus_cache": get_corpus_index().stats(),
+            "query_cache": get_query_cache().stats(),
+            "answer_cache": get_answer_cache().stats(),
+        }, status=status.HTTP_200_OK)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint; with METRICS_TOKEN set it requires "Authorization: Bearer <token>"."""
+    if settings.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {settings.METRICS_TOKEN}":
+        return HttpResponse(status=status.HTTP_401_UNAUTHORIZED)
+    return HttpResponse(render_metrics(), content_type=CONTENT_TYPE)